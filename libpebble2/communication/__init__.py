@@ -3,7 +3,7 @@ from __future__ import absolute_import
 __author__ = 'katharine'
 
 from binascii import hexlify
-from collections import namedtuple
+from collections import namedtuple, Counter
 from enum import Enum
 import logging
 import struct
@@ -11,16 +11,19 @@ import threading
 
 from .transports import BaseTransport, MessageTargetWatch
 from libpebble2.events.threaded import ThreadedEventHandler
-from libpebble2.exceptions import PacketDecodeError, ConnectionError, IncompleteMessage
+from libpebble2.exceptions import PacketDecodeError, ConnectionError
 from libpebble2.protocol.base import PebblePacket, PacketType
 from libpebble2.protocol.system import (PhoneAppVersion, AppVersionResponse, WatchVersion, WatchVersionRequest,
                                         WatchVersionResponse, WatchModel, ModelRequest, Model)
+from libpebble2.util.buffer import ReceiveBuffer
 from libpebble2.util.hardware import PebbleHardware
 
 logger = logging.getLogger("libpebble2.communication")
 
 _EventType = Enum('_EventType', ('Watch', 'Transport'))
 
+_frame_header = struct.Struct('!HH')
+
 FirmwareVersion = namedtuple('FirmwareVersion', ('major', 'minor', 'patch', 'suffix'))
 """
 Represents a firmware version, in the format ``major.minor.patch-suffix``.
@@ -37,17 +40,27 @@ class PebbleConnection(object):
     :type log_packet_level: int
     :param log_protocol_level: int If not None, the log level at which to log raw messages sent and received.
     :type log_protocol_level: int
+    :param lazy_decode: If True, messages from the watch are decoded lazily: only their leading fixed-width fields
+                        are decoded up front, and the rest are decoded when first accessed by a handler. Decoding
+                        errors in those fields are then raised in the handler. See :meth:`.PebblePacket.parse`.
+    :type lazy_decode: bool
     """
-    def __init__(self, transport, log_protocol_level=None, log_packet_level=None):
+    def __init__(self, transport, log_protocol_level=None, log_packet_level=None, lazy_decode=False):
         assert isinstance(transport, BaseTransport)
+        self._init_connection(transport, ThreadedEventHandler(), log_protocol_level, log_packet_level, lazy_decode)
+
+    def _init_connection(self, transport, event_handler, log_protocol_level, log_packet_level, lazy_decode):
+        # Shared with subclasses that need a different transport type or event handler.
         self.transport = transport
-        self.pending_bytes = b''
-        self.event_handler = ThreadedEventHandler()
+        self._receive_buffer = ReceiveBuffer()
+        self._skipped_frames = Counter()
+        self.event_handler = event_handler
         self._register_internal_handlers()
         self._watch_info = None
         self._watch_model = None
         self.log_protocol_level = log_protocol_level
         self.log_packet_level = log_packet_level
+        self.lazy_decode = lazy_decode
 
     def connect(self):
         """
@@ -62,6 +75,25 @@ class PebbleConnection(object):
         """
         return self.transport.connected
 
+    @property
+    def pending_bytes(self):
+        """
+        :return: Any bytes received from the watch that do not yet make up a complete message.
+        :rtype: bytes
+        """
+        return self._receive_buffer.peek()
+
+    @property
+    def skipped_frames(self):
+        """
+        Messages from the watch are not decoded if nothing is subscribed to their endpoint, though they are still
+        passed to raw inbound handlers. This property counts how many messages have been skipped in this way.
+
+        :return: A mapping from endpoint ID to the number of messages skipped for that endpoint.
+        :rtype: dict
+        """
+        return dict(self._skipped_frames)
+
     def pump_reader(self):
         """
         Synchronously reads one message from the watch, blocking until a message is available.
@@ -71,6 +103,16 @@ class PebbleConnection(object):
            You usually don't need to invoke this method manually; instead, see :meth:`run_sync` and :meth:`run_async`.
         """
         origin, message = self.transport.read_packet()
+        self._handle_transport_message(origin, message)
+
+    def _handle_transport_message(self, origin, message):
+        """
+        Processes a message read from the transport, which may or may not be from the watch.
+
+        :param origin: The origin of the message, as returned by :meth:`.BaseTransport.read_packet`.
+        :type origin: .MessageTarget
+        :param message: The message.
+        """
         if isinstance(origin, MessageTargetWatch):
             self._handle_watch_message(message)
         else:
@@ -111,35 +153,31 @@ class PebbleConnection(object):
         """
         if self.log_protocol_level is not None:
             logger.log(self.log_protocol_level, "<- %s", hexlify(message).decode())
-        message = self.pending_bytes + message
+        buffer = self._receive_buffer
+        buffer.append(message)
 
-        while len(message) >= 4:
-            try:
-                packet, length = PebblePacket.parse_message(message)
-            except IncompleteMessage:
-                self.pending_bytes = message
+        while len(buffer) >= 4:
+            length, endpoint = buffer.unpack_from(_frame_header)
+            length += 4
+            if len(buffer) < length:
                 break
-            except:
-                # At this point we've failed to deconstruct the message via normal means, but we don't want to end
-                # up permanently desynced (because we wiped a partial message), nor do we want to get stuck (because
-                # we didn't wipe anything). We therefore parse the packet length manually and skip ahead that far.
-                # If the expected length is 0, we wipe everything to ensure forward motion (but we are quite probably
-                # screwed).
-                expected_length, = struct.unpack('!H', message[:2])
-                if expected_length == 0:
-                    self.pending_bytes = b''
-                else:
-                    self.pending_bytes = message[expected_length + 4:]
-                raise
-
-            self.event_handler.broadcast_event("raw_inbound", message[:length])
+            # We take the message out of the buffer before trying to decode it. If decoding fails, we have still
+            # moved past it, so we neither end up permanently desynced nor stuck retrying the same message.
+            frame = buffer.read(length)
+            if self.event_handler.has_handlers("raw_inbound"):
+                self.event_handler.broadcast_event("raw_inbound", frame)
+
+            # There's no point decoding a message that nobody is going to look at.
+            packet_type = PebblePacket.packet_for_endpoint(endpoint)
+            if (packet_type is not None and self.log_packet_level is None
+                    and not self.event_handler.has_handlers((_EventType.Watch, packet_type))):
+                self._skipped_frames[endpoint] += 1
+                continue
+
+            packet, length = PebblePacket.parse_message(frame, lazy=self.lazy_decode)
             if self.log_packet_level is not None:
                 logger.log(self.log_packet_level, "<- %s", packet)
-            message = message[length:]
             self.event_handler.broadcast_event((_EventType.Watch, type(packet)), packet)
-            if length == 0:
-                break
-        self.pending_bytes = message
 
     def _broadcast_transport_message(self, origin, message):
         """
@@ -262,7 +300,8 @@ class PebbleConnection(object):
         if self.log_packet_level:
             logger.log(self.log_packet_level, "-> %s", packet)
         serialised = packet.serialise_packet()
-        self.event_handler.broadcast_event("raw_outbound", serialised)
+        if self.event_handler.has_handlers("raw_outbound"):
+            self.event_handler.broadcast_event("raw_outbound", serialised)
         self.send_raw(serialised)
 
     def send_and_read(self, packet, endpoint, timeout=15):
@@ -304,7 +343,10 @@ class PebbleConnection(object):
             self.register_endpoint(PhoneAppVersion, self._app_version_response)
 
     def _app_version_response(self, packet):
-        packet = PhoneAppVersion(message=AppVersionResponse(
+        self.send_packet(self._app_version_response_packet())
+
+    def _app_version_response_packet(self):
+        return PhoneAppVersion(message=AppVersionResponse(
             protocol_version=0xFFFFFFFF,
             session_caps=0x80000000,
             platform_flags=50,
@@ -314,7 +356,6 @@ class PebbleConnection(object):
             bugfix_version=0,
             protocol_caps=0xFFFFFFFFFFFFFFFF
         ))
-        self.send_packet(packet)
 
     def fetch_watch_info(self):
         """
@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import asyncio
+from binascii import hexlify
+import logging
+import struct
+
+from . import PebbleConnection
+from .transports.aio import BaseAsyncTransport
+from libpebble2.events.aio import AsyncEventHandler
+from libpebble2.exceptions import PacketDecodeError, ConnectionError, PebbleError
+from libpebble2.protocol.system import WatchVersion, WatchVersionRequest, WatchModel, ModelRequest, Model
+
+__all__ = ["AsyncPebbleConnection"]
+
+logger = logging.getLogger("libpebble2.communication")
+
+
+class AsyncPebbleConnection(PebbleConnection):
+    """
+    The :mod:`asyncio` counterpart of :class:`.PebbleConnection`. Rather than dedicating a thread to each connection,
+    any number of connections can share a single event loop.
+
+    The interface is the same as that of :class:`.PebbleConnection`, except that methods that would block are
+    coroutines, and methods that return events return awaitables (:meth:`read_from_endpoint`,
+    :meth:`read_transport_message`) or asynchronous queues (:meth:`get_endpoint_queue`). Endpoint handlers are
+    still plain callables, and are called on the event loop.
+
+    Because they would block, :attr:`watch_info` and :attr:`watch_model` are only available after awaiting
+    :meth:`fetch_watch_info` and :meth:`fetch_watch_model` respectively.
+
+    The services in :mod:`libpebble2.services` require a :class:`.PebbleConnection`.
+
+    :param transport: The underlying transport layer to communicate with the Pebble.
+    :type transport: .BaseAsyncTransport
+    :param log_packet_level: If not None, the log level at which to log decoded messages sent and received.
+    :type log_packet_level: int
+    :param log_protocol_level: int If not None, the log level at which to log raw messages sent and received.
+    :type log_protocol_level: int
+    :param lazy_decode: If True, messages from the watch are decoded lazily, as described in :class:`.PebbleConnection`.
+    :type lazy_decode: bool
+    """
+    def __init__(self, transport, log_protocol_level=None, log_packet_level=None, lazy_decode=False):
+        assert isinstance(transport, BaseAsyncTransport)
+        self._tasks = set()
+        self._init_connection(transport, AsyncEventHandler(), log_protocol_level, log_packet_level, lazy_decode)
+
+    async def connect(self):
+        """
+        Initialises a connection to the Pebble. Once it completes, a valid connection will be open.
+        """
+        await self.transport.connect()
+
+    async def pump_reader(self):
+        """
+        Reads one message from the watch, waiting until a message is available. All events caused by the message read
+        will be processed before this coroutine completes.
+        """
+        origin, message = await self.transport.read_packet()
+        self._handle_transport_message(origin, message)
+
+    async def run_sync(self):
+        """
+        Runs the message loop until the Pebble disconnects.
+        """
+        while self.connected:
+            try:
+                await self.pump_reader()
+            except PacketDecodeError as e:
+                logger.warning("Packet decode failed: %s", e)
+            except ConnectionError:
+                break
+
+    async def run_async(self):
+        """
+        Starts a task that runs the message loop until the Pebble disconnects, then calls :meth:`fetch_watch_info` on
+        your behalf.
+
+        :return: The message loop task.
+        :rtype: asyncio.Task
+        """
+        task = self._spawn(self.run_sync())
+        await self.fetch_watch_info()
+        return task
+
+    def _spawn(self, coroutine):
+        # The event loop only keeps weak references to tasks, so we hold on to them until they finish.
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def send_packet(self, packet):
+        """
+        Sends a message to the Pebble.
+
+        :param packet: The message to send.
+        :type packet: .PebblePacket
+        """
+        if self.log_packet_level:
+            logger.log(self.log_packet_level, "-> %s", packet)
+        serialised = packet.serialise_packet()
+        if self.event_handler.has_handlers("raw_outbound"):
+            self.event_handler.broadcast_event("raw_outbound", serialised)
+        await self.send_raw(serialised)
+
+    async def send_and_read(self, packet, endpoint, timeout=15):
+        """
+        Sends a packet, then returns the next response received from that endpoint. This method sets up a listener
+        before it actually sends the message, avoiding a potential race.
+
+        :param packet: The message to send.
+        :type packet: .PebblePacket
+        :param endpoint: The endpoint to read from
+        :type endpoint: .PacketType
+        :param timeout: The maximum time to wait before raising :exc:`.TimeoutError`.
+        :return: The message read from the endpoint; of the same type as passed to ``endpoint``.
+        """
+        queue = self.get_endpoint_queue(endpoint)
+        try:
+            await self.send_packet(packet)
+            return await queue.get(timeout=timeout)
+        finally:
+            queue.close()
+
+    async def send_raw(self, message):
+        """
+        Sends a raw binary message to the Pebble. No processing will be applied, but any transport framing should be
+        omitted.
+
+        :param message: The message to send to the pebble.
+        :type message: bytes
+        """
+        if self.log_protocol_level:
+            logger.log(self.log_protocol_level, "-> %s", hexlify(message).decode())
+        await self.transport.send_packet(message)
+
+    def _app_version_response(self, packet):
+        # Handlers can't wait, so send the response in the background.
+        self._spawn(self.send_packet(self._app_version_response_packet()))
+
+    async def fetch_watch_info(self):
+        """
+        Fetches the information required by :attr:`watch_info`, :attr:`firmware_version` and :attr:`watch_platform`.
+        """
+        self._watch_info = (await self.send_and_read(WatchVersion(data=WatchVersionRequest()), WatchVersion)).data
+
+    async def fetch_watch_model(self):
+        """
+        Fetches the information required by :attr:`watch_model`.
+
+        :return: The model of the watch.
+        :rtype: ~libpebble2.protocol.system.Model
+        """
+        info_bytes = (await self.send_and_read(WatchModel(data=ModelRequest()), WatchModel)).data.data
+        if len(info_bytes) == 4:
+            self._watch_model, = struct.unpack('>I', info_bytes)
+        else:
+            self._watch_model = Model.Unknown
+        return self._watch_model
+
+    @property
+    def watch_info(self):
+        """
+        Returns information on the connected Pebble, including its firmware version, language, capabilities, etc.
+        :meth:`fetch_watch_info` must have completed first.
+
+        :rtype: .WatchVersionResponse
+        """
+        if self._watch_info is None:
+            raise PebbleError("Watch info has not been fetched; await fetch_watch_info() first.")
+        return self._watch_info
+
+    @property
+    def watch_model(self):
+        """
+        The model of the watch. :meth:`fetch_watch_model` must have completed first.
+
+        :rtype: ~libpebble2.protocol.system.Model
+        """
+        if self._watch_model is None:
+            raise PebbleError("Watch model has not been fetched; await fetch_watch_model() first.")
+        return self._watch_model
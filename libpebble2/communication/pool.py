@@ -0,0 +1,231 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+from collections import namedtuple
+import logging
+import threading
+import time
+
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
+from libpebble2.exceptions import PacketDecodeError, ConnectionError
+
+__all__ = ["ConnectionPool", "PoolStats"]
+
+logger = logging.getLogger("libpebble2.communication.pool")
+
+
+class PoolStats(namedtuple('PoolStats', ('connections', 'messages_received', 'bytes_received', 'messages_sent',
+                                         'bytes_sent', 'elapsed', 'mean_latency', 'max_latency'))):
+    """
+    Aggregate statistics for every connection in a :class:`ConnectionPool`, as returned by
+    :attr:`ConnectionPool.stats`. Counts cover the period since the pool was created or
+    :meth:`~ConnectionPool.reset_stats` was last called, which is ``elapsed`` seconds.
+
+    Latencies are the time, in seconds, between a message being ready to read and its handlers having finished
+    running. This includes any time spent waiting for messages from other connections to be handled first.
+    """
+    __slots__ = ()
+
+    @property
+    def receive_throughput(self):
+        """
+        The average number of bytes received from the watches per second.
+        """
+        return self.bytes_received / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def send_throughput(self):
+        """
+        The average number of bytes sent to the watches per second.
+        """
+        return self.bytes_sent / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class ConnectionPool(object):
+    """
+    Reads from any number of connections on a single thread, in place of the thread per connection started by
+    :meth:`~.PebbleConnection.run_async`. Messages are dispatched to each connection's own handlers as usual.
+
+    Connections must already be connected, and must have a transport that supports polling by providing ``fileno()``
+    and ``read_ready()``, such as :class:`.QemuTransport` and :class:`.WebsocketTransport`. Connections are removed
+    from the pool automatically when they disconnect. ::
+
+        pool = ConnectionPool()
+        pool.run_async()
+        for port in ports:
+            pebble = PebbleConnection(QemuTransport(port=port))
+            pebble.connect()
+            pool.add(pebble)
+            pebble.fetch_watch_info()
+
+    Handlers are called on the pool's thread, so should avoid blocking: while one handler is running, no other
+    connection in the pool can receive messages. Exceptions raised by handlers are logged and otherwise ignored.
+    Connections whose transports raise an exception are removed from the pool.
+    """
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._running = False
+        self.reset_stats()
+
+    def add(self, connection):
+        """
+        Adds a connection to the pool. From then on, messages received by the connection are handled by the pool.
+
+        :param connection: The connection to add.
+        :type connection: .PebbleConnection
+        """
+        with self._lock:
+            fd = connection.transport.fileno()
+            self._selector.register(fd, selectors.EVENT_READ, connection)
+            handle = connection.register_raw_outbound_handler(self._count_sent)
+            self._connections[connection] = (fd, handle)
+
+    def remove(self, connection):
+        """
+        Removes a connection from the pool. The connection is not disconnected.
+
+        :param connection: The connection to remove.
+        :type connection: .PebbleConnection
+        """
+        with self._lock:
+            if connection not in self._connections:
+                return
+            fd, handle = self._connections.pop(connection)
+            self._selector.unregister(fd)
+            connection.unregister_endpoint(handle)
+
+    @property
+    def connections(self):
+        """
+        The connections currently in the pool.
+
+        :rtype: list[.PebbleConnection]
+        """
+        with self._lock:
+            return list(self._connections)
+
+    def poll(self, timeout=None):
+        """
+        Waits for at least one connection to have data to read, then reads and handles whatever is available on every
+        connection that does.
+
+        :param timeout: The maximum time to wait, in seconds. If ``None``, waits indefinitely.
+        :type timeout: float
+        :return: The number of messages handled.
+        :rtype: int
+        """
+        if not self._connections:
+            # Some selectors don't support waiting on nothing.
+            if timeout:
+                time.sleep(timeout)
+            return 0
+        handled = 0
+        for key, mask in self._selector.select(timeout):
+            ready = time.time()
+            connection = key.data
+            try:
+                messages = connection.transport.read_ready()
+            except ConnectionError:
+                logger.info("Connection %s closed.", connection)
+                self.remove(connection)
+                continue
+            except PacketDecodeError as e:
+                logger.warning("Packet decode failed: %s", e)
+                continue
+            except Exception:
+                # Whatever went wrong, it only affects this connection, so don't let it stop the others.
+                logger.exception("Reading from %s failed; removing it from the pool.", connection)
+                self.remove(connection)
+                continue
+            for origin, message in messages:
+                try:
+                    connection._handle_transport_message(origin, message)
+                except PacketDecodeError as e:
+                    logger.warning("Packet decode failed: %s", e)
+                except Exception:
+                    logger.exception("Handling a message from %s failed.", connection)
+                self._count_received(message, time.time() - ready)
+            handled += len(messages)
+        return handled
+
+    def run_sync(self, poll_interval=0.5):
+        """
+        Handles messages for every connection in the pool until :meth:`stop` is called.
+
+        :param poll_interval: How often to check whether :meth:`stop` has been called, in seconds.
+        :type poll_interval: float
+        """
+        self._running = True
+        while self._running:
+            self.poll(timeout=poll_interval)
+
+    def run_async(self, poll_interval=0.5):
+        """
+        Spawns a new thread that handles messages for every connection in the pool until :meth:`stop` is called.
+
+        :param poll_interval: How often to check whether :meth:`stop` has been called, in seconds.
+        :type poll_interval: float
+        """
+        self._running = True
+        thread = threading.Thread(target=self.run_sync, args=(poll_interval,))
+        thread.daemon = True
+        thread.name = "ConnectionPool"
+        thread.start()
+
+    def stop(self):
+        """
+        Stops :meth:`run_sync` or the thread started by :meth:`run_async` after it next polls.
+        """
+        self._running = False
+
+    def _count_received(self, message, latency):
+        with self._lock:
+            self._messages_received += 1
+            if isinstance(message, bytes):
+                self._bytes_received += len(message)
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+
+    def _count_sent(self, message):
+        with self._lock:
+            self._messages_sent += 1
+            self._bytes_sent += len(message)
+
+    def reset_stats(self):
+        """
+        Resets the statistics reported by :attr:`stats`.
+        """
+        with self._lock:
+            self._stats_start = time.time()
+            self._messages_received = 0
+            self._bytes_received = 0
+            self._messages_sent = 0
+            self._bytes_sent = 0
+            self._total_latency = 0.0
+            self._max_latency = 0.0
+
+    @property
+    def stats(self):
+        """
+        Aggregate throughput and latency statistics for the pool.
+
+        :rtype: PoolStats
+        """
+        with self._lock:
+            received = self._messages_received
+            return PoolStats(
+                connections=len(self._connections),
+                messages_received=received,
+                bytes_received=self._bytes_received,
+                messages_sent=self._messages_sent,
+                bytes_sent=self._bytes_sent,
+                elapsed=time.time() - self._stats_start,
+                mean_latency=self._total_latency / received if received else 0.0,
+                max_latency=self._max_latency,
+            )
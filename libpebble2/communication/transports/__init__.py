@@ -29,6 +29,15 @@ class BaseTransport(with_metaclass(ABCMeta)):
         """
         pass
 
+    @property
+    def preferred_payload_size(self):
+        """
+        :return: The length of the largest message, including Pebble Protocol framing, that the transport can send to
+                 the watch without splitting it up; or ``None`` if the transport never needs to split messages.
+        :rtype: int
+        """
+        return None
+
     @abstractmethod
     def connect(self):
         """
@@ -0,0 +1,61 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+from six import with_metaclass
+
+from abc import ABCMeta, abstractmethod, abstractproperty
+
+from . import MessageTargetWatch
+
+__all__ = ["BaseAsyncTransport"]
+
+
+class BaseAsyncTransport(with_metaclass(ABCMeta)):
+    """
+    The :mod:`asyncio` counterpart of :class:`.BaseTransport`, for use with :class:`.AsyncPebbleConnection`. The
+    methods are the same, except that :meth:`connect`, :meth:`read_packet` and :meth:`send_packet` are coroutines.
+    """
+    @abstractproperty
+    def must_initialise(self):
+        """
+        :return: ``True`` if libpebble2 is responsible for negotiating the connection; otherwise ``False``.
+        """
+        pass
+
+    @abstractproperty
+    def connected(self):
+        """
+        :return: ``True`` if the transport is currently connected; otherwise ``False``.
+        """
+        pass
+
+    @abstractmethod
+    async def connect(self):
+        """
+        Connect to the Pebble. Once this coroutine completes, libpebble2 should be able to safely send messages to the
+        connected Pebble.
+
+        Ordinarily, this method should only be called by :class:`.AsyncPebbleConnection`.
+        """
+        pass
+
+    @abstractmethod
+    async def read_packet(self):
+        """
+        Read a message, as described in :meth:`.BaseTransport.read_packet`.
+
+        :return: (:class:`.MessageTarget`, :class:`libpebble2.protocol.base.PebblePacket`)
+        """
+        pass
+
+    @abstractmethod
+    async def send_packet(self, message, target=MessageTargetWatch()):
+        """
+        Send a message, as described in :meth:`.BaseTransport.send_packet`.
+
+        :param message: Message to send.
+        :type message: PebblePacket
+        :param target: Target for the message
+        :type target: MessageTarget
+        """
+        pass
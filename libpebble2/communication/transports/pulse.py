@@ -2,7 +2,6 @@ from __future__ import absolute_import
 __author__ = 'Liam McLoughlin'
 
 import time
-import struct
 
 try:
     from pebble import pulse2
@@ -11,6 +10,7 @@ except ImportError:
 
 from . import BaseTransport, MessageTargetWatch
 from libpebble2.exceptions import ConnectionError, PebbleError
+from libpebble2.util.buffer import ReceiveBuffer
 
 
 class PULSETransport(BaseTransport):
@@ -32,7 +32,7 @@ class PULSETransport(BaseTransport):
     def __init__(self, link):
         self.link = link
         self.connection = None
-        self.buffer = b''
+        self.buffer = ReceiveBuffer()
 
     @staticmethod
     def _chunks(list_items, chunk_length):
@@ -66,21 +66,23 @@ class PULSETransport(BaseTransport):
     def connected(self):
         return self.connection is not None
 
+    @property
+    def preferred_payload_size(self):
+        # Each PULSE packet carries an opcode byte as well as the message.
+        return self.connection.mtu - 1 if self.connected else None
+
     def read_packet(self):
         while self.connected:
             if len(self.buffer) >= 2:
-                length, = struct.unpack('!H', self.buffer[:2])
+                length, = self.buffer.unpack_from('!H')
                 length += 4
 
                 if len(self.buffer) >= length:
-                    msg_data = self.buffer[:length]
-                    self.buffer = self.buffer[length:]
-
-                    return MessageTargetWatch(), msg_data
+                    return MessageTargetWatch(), self.buffer.read(length)
 
             opcode, data = self._recv_with_opcode()
             if opcode == self.OPCODE_PROTOCOL_DATA:
-                self.buffer += data
+                self.buffer.append(data)
 
     def send_packet(self, message, target=MessageTargetWatch()):
         assert isinstance(target, MessageTargetWatch)
@@ -2,11 +2,17 @@ from __future__ import absolute_import
 __author__ = 'katharine'
 
 import socket
+import struct
 
 from .. import BaseTransport, MessageTarget, MessageTargetWatch
 from .protocol import QemuPacket, QemuInboundPacket, QemuSPP, QemuRawPacket, HEADER_SIGNATURE, FOOTER_SIGNATURE
 from libpebble2.exceptions import ConnectionError
 from libpebble2.protocol.base.types import PacketDecodeError
+from libpebble2.util.buffer import ReceiveBuffer
+
+# signature, protocol, length
+_qemu_header = struct.Struct('!HHH')
+_qemu_overhead = _qemu_header.size + 2
 
 
 class MessageTargetQemu(MessageTarget):
@@ -42,7 +48,7 @@ class QemuTransport(BaseTransport):
         self.host = host
         self.port = port
         self.socket = None
-        self.assembled_data = b''
+        self.assembled_data = ReceiveBuffer()
         self._connected = False
 
     def connect(self):
@@ -57,57 +63,103 @@ class QemuTransport(BaseTransport):
     def connected(self):
         return self.socket is not None and self._connected
 
+    @property
+    def preferred_payload_size(self):
+        return self.BUFFER_SIZE
+
     def read_packet(self):
         while True:
-            if len(self.assembled_data) > 0:
-                try:
-                    packet, length = QemuInboundPacket.parse(self.assembled_data)
-                except PacketDecodeError:
-                    pass
-                else:
-                    self.assembled_data = self.assembled_data[length:]
-                    if packet.signature == HEADER_SIGNATURE and packet.footer == FOOTER_SIGNATURE:
-                        if isinstance(packet.data, QemuSPP):
-                            return MessageTargetWatch(), packet.data.payload
-                        else:
-                            return MessageTargetQemu(packet.protocol), packet.data
-                    else:
-                        raise PacketDecodeError("QemuTransport: signature mismatch ({:x} = {:x}, {:x} = {:x})".format(
-                            packet.signature,
-                            HEADER_SIGNATURE,
-                            packet.footer,
-                            FOOTER_SIGNATURE,
-                        ))
+            result = _read_buffered_packet(self.assembled_data)
+            if result is not None:
+                return result
             try:
                 received = self.socket.recv(self.BUFFER_SIZE)
                 if len(received) == 0:
                     self._connected = False
                     raise ConnectionError("Disconnected.")
-                self.assembled_data += received
+                self.assembled_data.append(received)
             except socket.error:
                 self._connected = False
                 raise ConnectionError("Disconnected.")
 
+    def fileno(self):
+        """
+        :return: The file descriptor of the socket connected to QEMU, for use with :class:`.ConnectionPool`.
+        """
+        return self.socket.fileno()
+
+    def read_ready(self):
+        """
+        Reads whatever data is available from the socket, which should be known to be readable, without blocking.
+
+        :return: A list of ``(target, message)`` tuples, as returned by :meth:`read_packet`, for each message
+                 completed by the data read.
+        """
+        try:
+            received = self.socket.recv(self.BUFFER_SIZE)
+        except socket.error:
+            received = b''
+        if len(received) == 0:
+            self._connected = False
+            raise ConnectionError("Disconnected.")
+        self.assembled_data.append(received)
+        messages = []
+        result = _read_buffered_packet(self.assembled_data)
+        while result is not None:
+            messages.append(result)
+            result = _read_buffered_packet(self.assembled_data)
+        return messages
+
     def send_packet(self, message, target=MessageTargetWatch()):
         try:
-            if isinstance(target, MessageTargetWatch):
-                start_idx = 0
-                bytes_left = len(message)
-                while bytes_left:
-                    bytes_to_send = bytes_left
-                    if bytes_to_send > self.BUFFER_SIZE:
-                        bytes_to_send = self.BUFFER_SIZE
-                    chunk = message[start_idx:start_idx+bytes_to_send]
-                    self.socket.send(QemuPacket(data=QemuSPP(payload=chunk)).serialise())
-                    bytes_left -= bytes_to_send
-                    start_idx += bytes_to_send
-            elif isinstance(target, MessageTargetQemu):
-                if not target.raw:
-                    self.socket.send(QemuPacket(data=message).serialise())
-                else:
-                    self.socket.send(QemuRawPacket(protocol=target.protocol, data=message).serialise())
-            else:
-                assert False
+            for frame in _frame_message(message, target, self.BUFFER_SIZE):
+                self.socket.send(frame)
         except socket.error as e:
             self._connected = False
             raise ConnectionError(str(e))
+
+
+def _read_buffered_packet(buffer):
+    """
+    Removes the first complete QEMU message from ``buffer`` and decodes it.
+
+    :param buffer: Data received from QEMU.
+    :type buffer: .ReceiveBuffer
+    :return: ``(target, message)``, as returned by :meth:`.BaseTransport.read_packet`, or ``None`` if the buffer does not
+             yet hold a complete message.
+    """
+    if len(buffer) < _qemu_header.size:
+        return None
+    length = buffer.unpack_from(_qemu_header)[2] + _qemu_overhead
+    if len(buffer) < length:
+        return None
+    packet = QemuInboundPacket.parse(buffer.read(length))[0]
+    if packet.signature != HEADER_SIGNATURE or packet.footer != FOOTER_SIGNATURE:
+        raise PacketDecodeError("QemuTransport: signature mismatch ({:x} = {:x}, {:x} = {:x})".format(
+            packet.signature,
+            HEADER_SIGNATURE,
+            packet.footer,
+            FOOTER_SIGNATURE,
+        ))
+    if isinstance(packet.data, QemuSPP):
+        return MessageTargetWatch(), packet.data.payload
+    else:
+        return MessageTargetQemu(packet.protocol), packet.data
+
+
+def _frame_message(message, target, chunk_size):
+    """
+    Wraps a message in QEMU framing, splitting messages for the watch into chunks of at most ``chunk_size`` bytes.
+
+    :return: An iterable of serialised QEMU messages.
+    """
+    if isinstance(target, MessageTargetWatch):
+        for start_idx in range(0, len(message), chunk_size):
+            yield QemuPacket(data=QemuSPP(payload=message[start_idx:start_idx+chunk_size])).serialise()
+    elif isinstance(target, MessageTargetQemu):
+        if not target.raw:
+            yield QemuPacket(data=message).serialise()
+        else:
+            yield QemuRawPacket(protocol=target.protocol, data=message).serialise()
+    else:
+        assert False
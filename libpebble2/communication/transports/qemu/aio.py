@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import asyncio
+
+from .. import MessageTargetWatch
+from ..aio import BaseAsyncTransport
+from . import QemuTransport, _read_buffered_packet, _frame_message
+from libpebble2.exceptions import ConnectionError
+from libpebble2.util.buffer import ReceiveBuffer
+
+__all__ = ["AsyncQemuTransport"]
+
+
+class AsyncQemuTransport(BaseAsyncTransport):
+    """
+    The :mod:`asyncio` counterpart of :class:`.QemuTransport`.
+
+    :param host: The host on which the QEMU instance is running.
+    :type host: str
+    :param port: The port on which the QEMU instance has exposed its Pebble QEMU Protocol port.
+    :type port: int
+    """
+    #: Number of bytes read from the socket at a time.
+    BUFFER_SIZE = QemuTransport.BUFFER_SIZE
+    must_initialise = True
+
+    def __init__(self, host='127.0.0.1', port=12344):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.assembled_data = ReceiveBuffer()
+        self._connected = False
+
+    async def connect(self):
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            raise ConnectionError(str(e))
+        self._connected = True
+
+    @property
+    def connected(self):
+        return self.writer is not None and self._connected
+
+    async def read_packet(self):
+        while True:
+            result = _read_buffered_packet(self.assembled_data)
+            if result is not None:
+                return result
+            try:
+                received = await self.reader.read(self.BUFFER_SIZE)
+            except OSError:
+                received = b''
+            if len(received) == 0:
+                self._connected = False
+                raise ConnectionError("Disconnected.")
+            self.assembled_data.append(received)
+
+    async def send_packet(self, message, target=MessageTargetWatch()):
+        try:
+            for frame in _frame_message(message, target, self.BUFFER_SIZE):
+                self.writer.write(frame)
+            await self.writer.drain()
+        except OSError as e:
+            self._connected = False
+            raise ConnectionError(str(e))
+
+    async def close(self):
+        """
+        Closes the connection to QEMU.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+        self._connected = False
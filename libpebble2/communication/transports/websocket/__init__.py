@@ -33,10 +33,12 @@ class WebsocketTransport(BaseTransport):
         """:type: str"""
         self.ws = None
         """:type: websocket.WebSocket"""
+        self._fragments = None
 
     def connect(self):
         try:
             self.ws = websocket.create_connection(self.url)
+            self._fragments = None
         except (websocket.WebSocketException, socket.error) as e:
             raise ConnectionError(str(e))
 
@@ -45,30 +47,93 @@ class WebsocketTransport(BaseTransport):
         return self.ws is not None and self.ws.connected
 
     def send_packet(self, message, target=MessageTargetWatch()):
-        handlers = {
-            MessageTargetWatch: self._send_to_watch,
-            MessageTargetPhone: self._send_to_phone,
-        }
-
-        handlers[type(target)](message)
-
-    def _send_to_watch(self, message):
-        self.send_packet(WebSocketRelayToWatch(payload=message), target=MessageTargetPhone())
-
-    def _send_to_phone(self, message):
-        message = struct.pack('B', endpoints[type(message)]) + message.serialise()
-        self.ws.send_binary(message)
+        self.ws.send_binary(_serialise_message(message, target))
+
+    def fileno(self):
+        """
+        :return: The file descriptor of the WebSocket, for use with :class:`.ConnectionPool`.
+        """
+        return self.ws.fileno()
+
+    def read_ready(self):
+        """
+        Reads whatever frames are available from the WebSocket, which should be known to be readable. Fragmented
+        messages are reassembled across calls, so only the remainder of a partially received frame is waited for;
+        control frames such as pings produce no messages. Frames that an SSL connection has already decrypted are
+        read too, as they would not make the socket readable again.
+
+        :return: A list of ``(target, message)`` tuples, as returned by :meth:`read_packet`.
+        """
+        messages = []
+        while True:
+            message = self._read_frame()
+            if message is not None:
+                messages.append(message)
+            if not self._has_pending_data():
+                return messages
+
+    def _read_frame(self):
+        frame = self.ws.recv_frame()
+        if frame.opcode == websocket.ABNF.OPCODE_PING:
+            self.ws.pong(frame.data)
+            return None
+        elif frame.opcode == websocket.ABNF.OPCODE_PONG:
+            return None
+        elif frame.opcode == websocket.ABNF.OPCODE_CLOSE:
+            self.ws.send_close()
+            return self._handle_message(frame.opcode, frame.data)
+        if frame.opcode != websocket.ABNF.OPCODE_CONT:
+            self._fragments = (frame.opcode, [])
+        elif self._fragments is None:
+            raise PebbleError("Got a WebSocket continuation frame with no message to continue")
+        opcode, data = self._fragments
+        data.append(frame.data)
+        if not frame.fin:
+            return None
+        self._fragments = None
+        return self._handle_message(opcode, b''.join(data))
+
+    def _has_pending_data(self):
+        # Only SSL sockets buffer data that select() doesn't know about.
+        sock = self.ws.sock
+        return sock is not None and hasattr(sock, 'pending') and sock.pending() > 0
 
     def read_packet(self):
         opcode, message = self.ws.recv_data()
+        return self._handle_message(opcode, message)
+
+    def _handle_message(self, opcode, message):
         if opcode == websocket.ABNF.OPCODE_BINARY:
-            endpoint, = struct.unpack_from('B', message, 0)
-            if from_watch.get(endpoint, None) == WebSocketRelayFromWatch:
-                return MessageTargetWatch(), message[1:]
-            else:
-                packet, length = from_watch[endpoint].parse(message[1:])
-                return MessageTargetPhone(), packet
+            return _parse_message(message)
         elif opcode == websocket.ABNF.OPCODE_CLOSE:
             raise ConnectionError("Connection gracefully closed by peer.")
         else:
             raise PebbleError("Got unexpected WebSocket opcode {}".format(opcode))
+
+
+def _serialise_message(message, target):
+    """
+    Serialises a message for the WebSocket protocol, wrapping messages for the watch in a relay message.
+
+    :return: The binary WebSocket message.
+    :rtype: bytes
+    """
+    if isinstance(target, MessageTargetWatch):
+        message = WebSocketRelayToWatch(payload=message)
+    elif not isinstance(target, MessageTargetPhone):
+        raise KeyError(type(target))
+    return struct.pack('B', endpoints[type(message)]) + message.serialise()
+
+
+def _parse_message(message):
+    """
+    Decodes a binary message received over the WebSocket protocol.
+
+    :return: ``(target, message)``, as returned by :meth:`.BaseTransport.read_packet`.
+    """
+    endpoint, = struct.unpack_from('B', message, 0)
+    if from_watch.get(endpoint, None) == WebSocketRelayFromWatch:
+        return MessageTargetWatch(), message[1:]
+    else:
+        packet, length = from_watch[endpoint].parse(message[1:])
+        return MessageTargetPhone(), packet
@@ -0,0 +1,66 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+try:
+    import websockets
+except ImportError:
+    pass
+
+from .. import MessageTargetWatch
+from ..aio import BaseAsyncTransport
+from . import _serialise_message, _parse_message
+from libpebble2.exceptions import ConnectionError, PebbleError
+
+__all__ = ["AsyncWebsocketTransport"]
+
+
+class AsyncWebsocketTransport(BaseAsyncTransport):
+    """
+    The :mod:`asyncio` counterpart of :class:`.WebsocketTransport`. This transport requires the
+    `websockets <https://pypi.org/project/websockets/>`_ package.
+
+    :param url: The WebSocket URL to connect to, in standard format (e.g. ``ws://localhost:9000/``)
+    """
+    must_initialise = False
+
+    def __init__(self, url):
+        self.url = url
+        """:type: str"""
+        self.ws = None
+        self._connected = False
+
+    async def connect(self):
+        try:
+            self.ws = await websockets.connect(self.url)
+        except (websockets.exceptions.WebSocketException, OSError) as e:
+            raise ConnectionError(str(e))
+        self._connected = True
+
+    @property
+    def connected(self):
+        return self.ws is not None and self._connected
+
+    async def send_packet(self, message, target=MessageTargetWatch()):
+        try:
+            await self.ws.send(_serialise_message(message, target))
+        except websockets.exceptions.ConnectionClosed as e:
+            self._connected = False
+            raise ConnectionError(str(e))
+
+    async def read_packet(self):
+        try:
+            message = await self.ws.recv()
+        except websockets.exceptions.ConnectionClosed:
+            self._connected = False
+            raise ConnectionError("Connection gracefully closed by peer.")
+        if not isinstance(message, bytes):
+            raise PebbleError("Got unexpected WebSocket text message")
+        return _parse_message(message)
+
+    async def close(self):
+        """
+        Closes the WebSocket connection.
+        """
+        if self.ws is not None:
+            await self.ws.close()
+        self._connected = False
@@ -55,6 +55,17 @@ class BaseEventHandler(with_metaclass(ABCMeta)):
         """
         pass
 
+    def has_handlers(self, event):
+        """
+        Indicates whether anything is currently subscribed to an event. Callers can use this to avoid preparing the
+        arguments for an event that nobody will receive. The default implementation always returns ``True``.
+
+        :param event: The event to check.
+        :return: ``False`` if broadcasting the event would certainly have no effect; otherwise ``True``.
+        :rtype: bool
+        """
+        return True
+
     @abstractmethod
     def broadcast_event(self, event, *args):
         """
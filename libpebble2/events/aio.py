@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import asyncio
+import weakref
+
+from . import BaseEventQueue
+from .threaded import ThreadedEventHandler
+from libpebble2.exceptions import TimeoutError
+
+__all__ = ["AsyncEventHandler"]
+
+_unset = object()
+
+
+class AsyncEventHandler(ThreadedEventHandler):
+    """
+    An :mod:`asyncio` implementation of :class:`.BaseEventHandler`, sharing the handler table of
+    :class:`.ThreadedEventHandler`.
+
+    :meth:`wait_for_event` returns an awaitable, and :meth:`queue_events` returns a queue whose :meth:`~.BaseEventQueue.get`
+    is a coroutine and which supports ``async for``. Both register their handlers as soon as they are called, so a
+    caller can start listening for an event, trigger it, and only then wait for it. An awaitable that is never awaited
+    is unregistered when it is garbage collected, or can be unregistered at once by calling its ``cancel`` method.
+
+    Events must be broadcast from the thread running the event loop.
+    """
+    def wait_for_event(self, event, timeout=10):
+        return _AsyncEventWait(self, event, timeout)
+
+    def queue_events(self, event):
+        return _AsyncEventQueue(self, event)
+
+
+class _AsyncEventWait(object):
+    # The handler only holds a weak reference to the waiter, so a waiter that is dropped without being awaited is
+    # unregistered when it is collected rather than left in the handler table.
+    def __init__(self, events, event, timeout):
+        self.event_handler = events
+        self.timeout = timeout
+        self.future = None
+        self.result = _unset
+        self.handle = events.register_handler(event, _weak_handler(weakref.ref(self)))
+        self._finalizer = weakref.finalize(self, events.unregister_handler, self.handle)
+
+    def handle_result(self, *args):
+        result, = args
+        self.event_handler.unregister_handler(self.handle)
+        if self.future is None:
+            if self.result is _unset:
+                self.result = result
+        elif not self.future.done():
+            self.future.set_result(result)
+
+    def cancel(self):
+        self._finalizer()
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    async def wait(self):
+        # The future is created here, on the running loop, rather than when the waiter is created.
+        try:
+            if self.result is not _unset:
+                return self.result
+            self.future = asyncio.get_running_loop().create_future()
+            try:
+                return await asyncio.wait_for(self.future, self.timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError()
+        finally:
+            self.cancel()
+
+
+def _weak_handler(ref):
+    def handler(*args):
+        waiter = ref()
+        if waiter is not None:
+            waiter.handle_result(*args)
+    return handler
+
+
+class _AsyncEventQueue(BaseEventQueue):
+    def __init__(self, events, event):
+        self.queue = asyncio.Queue()
+        self.event_handler = events
+        self.handle = self.event_handler.register_handler(event, self._handle_event)
+
+    def _handle_event(self, arg):
+        self.queue.put_nowait(arg)
+
+    def close(self):
+        self.event_handler.unregister_handler(self.handle)
+
+    async def get(self, timeout=10):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError()
+
+    def __iter__(self):
+        raise TypeError("Use 'async for' to iterate over an asynchronous event queue.")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
@@ -12,26 +12,47 @@ from libpebble2.exceptions import TimeoutError
 class ThreadedEventHandler(BaseEventHandler):
     """
     A threaded implementation of :class:`.BaseEventHandler`.
+
+    Handlers are dispatched from a table that is replaced wholesale whenever a handler is registered or unregistered,
+    so broadcasting an event takes no locks and makes no copies.
     """
     def __init__(self):
         self._handlers = {}
         self._handle_map = {}
         self._counter = 0
         self._handler_lock = threading.RLock()
+        # Maps each event to a tuple of its handlers. This dict is never mutated once published; registration builds
+        # a new one and swaps it in, which is atomic, so broadcast_event can read it without holding the lock.
+        self._dispatch = {}
+
+    def _rebuild_dispatch(self, event):
+        dispatch = dict(self._dispatch)
+        handlers = self._handlers.get(event)
+        if handlers:
+            dispatch[event] = tuple(handlers.values())
+        else:
+            dispatch.pop(event, None)
+            self._handlers.pop(event, None)
+        self._dispatch = dispatch
 
     def register_handler(self, event, handler):
         with self._handler_lock:
             self._counter += 1
             self._handlers.setdefault(event, {})[self._counter] = handler
             self._handle_map[self._counter] = event
+            self._rebuild_dispatch(event)
             return self._counter
 
     def unregister_handler(self, handle):
         with self._handler_lock:
             if handle not in self._handle_map:
                 return
-            del self._handlers[self._handle_map[handle]][handle]
-            del self._handle_map[handle]
+            event = self._handle_map.pop(handle)
+            del self._handlers[event][handle]
+            self._rebuild_dispatch(event)
+
+    def has_handlers(self, event):
+        return event in self._dispatch
 
     def wait_for_event(self, event, timeout=10):
         return _BlockingEventWait(self, event).wait(timeout=timeout)
@@ -40,7 +61,7 @@ class ThreadedEventHandler(BaseEventHandler):
         return _QueuedEventWait(self, event)
 
     def broadcast_event(self, event, *args):
-        for handler in list(self._handlers.get(event, {}).values()):
+        for handler in self._dispatch.get(event, ()):
             handler(*args)
 
 
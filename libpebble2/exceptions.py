@@ -22,6 +22,13 @@ class PutBytesError(PebbleError):
     pass
 
 
+class BlobDBError(PebbleError):
+    """
+    A BlobDB command could not be sent.
+    """
+    pass
+
+
 class GetBytesError(PebbleError):
     """
     A getbytes session failed.
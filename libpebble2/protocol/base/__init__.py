@@ -4,11 +4,14 @@ __author__ = 'katharine'
 from six import with_metaclass, iteritems
 
 from binascii import hexlify
+import array
 import collections
 import logging
 import struct
 
-from libpebble2.exceptions import IncompleteMessage
+from libpebble2.exceptions import IncompleteMessage, PacketDecodeError
+from libpebble2.util.buffer import ReceiveBuffer
+from .codec import PacketCodec
 from .types import Field, DEFAULT_ENDIANNESS
 
 __all__ = ["PebblePacket"]
@@ -17,6 +20,8 @@ logger = logging.getLogger("libpebble2.protocol")
 
 _PacketRegistry = {}
 
+_frame_header = struct.Struct('!HH')
+
 
 def make_output(thing):
     class C(object):
@@ -25,6 +30,26 @@ def make_output(thing):
     return C()
 
 
+class _FieldValue(object):
+    """
+    Stands in for a field on a packet class. Instances hold their field values directly, so this is only consulted
+    for fields that have not been set: it decodes the field if the packet is being parsed lazily, and otherwise
+    returns the field's default value.
+    """
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def __get__(self, obj, cls=None):
+        if obj is not None:
+            pending = obj.__dict__.get('_pending_decode')
+            if pending is not None:
+                pending.decode_field(obj, self.name)
+                if self.name in obj.__dict__:
+                    return obj.__dict__[self.name]
+        return self.default
+
+
 class PacketType(type):
     """
     Metaclass for :class:`PebblePacket` that transforms properties that are subclasses of :class:`Field` into a
@@ -52,7 +77,7 @@ class PacketType(type):
                 continue
             v._name = k
             mapping.append((k, v))
-            dct[k] = v._default
+            dct[k] = _FieldValue(k, v._default)
         # Put the results into an ordered dict. We sort on field_id to ensure that our dict ends up
         # in the correct order.
         dct['_type_mapping'].update(collections.OrderedDict(sorted(mapping, key=lambda x: x[1].field_id)))
@@ -68,12 +93,153 @@ class PacketType(type):
         # TODO: This isn't used any more; remove it?
         for k, v in iteritems(cls._type_mapping):
             v._parent = cls
+        # Compiled codecs, keyed by default endianness. These are filled in lazily by _get_codec.
+        cls._codecs = {}
         super(PacketType, cls).__init__(name, bases, dct)
 
+    def _get_codec(cls, endianness):
+        """
+        Returns a :class:`.PacketCodec` for this packet at the given default endianness, compiling it the first time
+        it is requested.
+        """
+        try:
+            return cls._codecs[endianness]
+        except KeyError:
+            codec = cls._codecs[endianness] = PacketCodec(cls, endianness)
+            return codec
+
+    def parse_many(cls, buffer, framed=True, default_endianness=DEFAULT_ENDIANNESS):
+        """
+        Decodes a run of messages that are all of this type, reusing the same compiled codec for each.
+
+        If ``framed`` is ``True``, ``buffer`` should contain Pebble Protocol messages, including framing. Messages for
+        endpoints other than this packet's are skipped. If the buffer ends part way through a message,
+        :exc:`.IncompleteMessage` is raised.
+
+        If ``framed`` is ``False``, ``buffer`` should contain unframed packets back to back, each of which is decoded
+        from where the previous one ended.
+
+        :param buffer: The messages to decode.
+        :type buffer: bytes | memoryview
+        :param framed: Whether the messages include Pebble Protocol framing.
+        :type framed: bool
+        :param default_endianness: The default endianness, unless overridden by the fields or class metadata.
+        :return: The decoded messages.
+        :rtype: list[PebblePacket]
+        """
+        codec = cls._get_codec(cls._resolve_endianness(default_endianness))
+        view = memoryview(buffer)
+        results = []
+        if framed:
+            for start, end in cls._iter_frames(view):
+                results.append(codec.parse(view[start:end])[0])
+        else:
+            offset = 0
+            while offset < len(view):
+                packet, length = codec.parse(view[offset:])
+                if length == 0:
+                    raise PacketDecodeError("{} consumed no bytes; can't decode any more.".format(cls.__name__))
+                results.append(packet)
+                offset += length
+        return results
+
+    def parse_stream(cls, chunks, default_endianness=DEFAULT_ENDIANNESS):
+        """
+        Decodes Pebble Protocol messages of this type from an iterable of arbitrarily split chunks of bytes, such as
+        those read from a socket or file. Messages for other endpoints are skipped.
+
+        :param chunks: An iterable of :class:`bytes`.
+        :param default_endianness: The default endianness, unless overridden by the fields or class metadata.
+        :return: A generator of decoded messages.
+        """
+        pending = ReceiveBuffer()
+        for chunk in chunks:
+            pending.append(chunk)
+            complete = 0
+            while len(pending) - complete >= 4:
+                length = pending.unpack_from(_frame_header, complete)[0]
+                if len(pending) - complete < length + 4:
+                    break
+                complete += length + 4
+            if complete:
+                for packet in cls.parse_many(pending.read(complete), default_endianness=default_endianness):
+                    yield packet
+        if pending:
+            raise IncompleteMessage()
+
+    def parse_columns(cls, buffer, framed=True, default_endianness=DEFAULT_ENDIANNESS):
+        """
+        Decodes a run of messages of this type, as with :meth:`parse_many`, but returns the result column by column
+        rather than as one :class:`PebblePacket` per message. This is only possible for packets made up entirely of
+        fixed-width fields. Enum fields are left as their raw values.
+
+        :param buffer: The messages to decode.
+        :type buffer: bytes | memoryview
+        :param framed: Whether the messages include Pebble Protocol framing.
+        :type framed: bool
+        :param default_endianness: The default endianness, unless overridden by the fields or class metadata.
+        :return: A mapping of each field name to an :class:`array.array` (or :class:`list`, for types
+                 :mod:`array` can't represent) of its values, in message order.
+        :rtype: ~collections.OrderedDict
+        """
+        codec = cls._get_codec(cls._resolve_endianness(default_endianness))
+        layout = codec.fixed_struct
+        if layout is None:
+            raise TypeError("{} is not made up only of fixed-width fields.".format(cls.__name__))
+        view = memoryview(buffer)
+        if framed:
+            rows = []
+            for start, end in cls._iter_frames(view):
+                if end - start < layout.size:
+                    raise PacketDecodeError("{}: Expected {} bytes, but only had {}".format(
+                        cls.__name__, layout.size, end - start))
+                rows.append(layout.unpack_from(view, start))
+        else:
+            if len(view) % layout.size != 0:
+                raise IncompleteMessage()
+            if hasattr(layout, 'iter_unpack'):
+                rows = list(layout.iter_unpack(view))
+            else:
+                rows = [layout.unpack_from(view, x) for x in range(0, len(view), layout.size)]
+        columns = collections.OrderedDict()
+        fields = codec.fixed_fields
+        values = list(zip(*rows)) if rows else [()] * len(fields)
+        for field, column in zip(fields, values):
+            columns[field._name] = _make_column(field.struct_format, column)
+        return columns
+
+    def _resolve_endianness(cls, default_endianness):
+        if hasattr(cls, '_Meta'):
+            return cls._Meta.get('endianness', default_endianness)
+        return default_endianness
+
+    def _iter_frames(cls, view):
+        # Yields the (start, end) of the body of each message addressed to this packet's endpoint.
+        endpoint = cls._Meta.get('endpoint') if hasattr(cls, '_Meta') else None
+        offset = 0
+        while offset < len(view):
+            if len(view) - offset < 4:
+                raise IncompleteMessage()
+            length, command = _frame_header.unpack_from(view, offset)
+            end = offset + 4 + length
+            if end > len(view):
+                raise IncompleteMessage()
+            if endpoint is None or command == endpoint:
+                yield offset + 4, end
+            offset = end
+
     def __repr__(self):
         return self.__name__
 
 
+def _make_column(struct_format, values):
+    typecode = 'B' if struct_format == '?' else struct_format
+    try:
+        return array.array(str(typecode), values)
+    except (ValueError, OverflowError):
+        return list(values)
+
+
 class PebblePacket(with_metaclass(PacketType)):
     """
     Represents some sort of Pebble Protocol message.
@@ -109,6 +275,12 @@ class PebblePacket(with_metaclass(PacketType)):
             getattr(self, k)  # Throws an exception if the property doesn't exist.
             setattr(self, k, v)
 
+    def __setattr__(self, name, value):
+        pending = self.__dict__.get('_pending_decode')
+        if pending is not None:
+            pending.decode_before_assign(self, name)
+        object.__setattr__(self, name, value)
+
     def serialise(self, default_endianness=None):
         """
         Serialise a message, without including any framing.
@@ -120,25 +292,33 @@ class PebblePacket(with_metaclass(PacketType)):
         :return: The serialised message.
         :rtype: bytes
         """
+        buffer = bytearray()
+        self.serialise_into(buffer, default_endianness=default_endianness)
+        return bytes(buffer)
+
+    def serialise_into(self, buffer, default_endianness=None):
+        """
+        Serialise a message, without including any framing, by appending it to ``buffer``. This is how nested packets
+        are serialised, so that an entire message is written into a single buffer in one pass.
+
+        :param buffer: The buffer to append the message to.
+        :type buffer: bytearray
+        :param default_endianness: The default endianness, unless overridden by the fields or class metadata.
+                                   Should usually be left at ``None``. Otherwise, use ``'<'`` for little endian and
+                                   ``'>'`` for big endian.
+        :type default_endianness: str
+        """
         # Figure out an endianness.
         endianness = (default_endianness or DEFAULT_ENDIANNESS)
         if hasattr(self, '_Meta'):
             endianness = self._Meta.get('endianness', endianness)
 
-        inferred_fields = set()
-        for k, v in iteritems(self._type_mapping):
-            inferred_fields |= {x._name for x in v.dependent_fields()}
-        for field in inferred_fields:
-            setattr(self, field, None)
+        # Serialisation overwrites inferred fields, so anything still waiting to be decoded must be decoded first.
+        pending = self.__dict__.get('_pending_decode')
+        if pending is not None:
+            pending.decode_all(self)
 
-        # Some fields want to manipulate other fields that appear before them (e.g. Unions)
-        for k, v in iteritems(self._type_mapping):
-            v.prepare(self, getattr(self, k))
-
-        message = b''
-        for k, v in iteritems(self._type_mapping):
-            message += v.value_to_bytes(self, getattr(self, k), default_endianness=endianness)
-        return message
+        type(self)._get_codec(endianness).serialise_into(self, buffer)
 
     def serialise_packet(self):
         """
@@ -149,11 +329,14 @@ class PebblePacket(with_metaclass(PacketType)):
         """
         if not hasattr(self, '_Meta'):
             raise ReferenceError("Can't serialise a packet that doesn't have an endpoint ID.")
-        serialised = self.serialise()
-        return struct.pack('!HH', len(serialised), self._Meta['endpoint']) + serialised
+        # Leave space for the header, then fill it in once we know how long the message was.
+        buffer = bytearray(4)
+        self.serialise_into(buffer)
+        _frame_header.pack_into(buffer, 0, len(buffer) - 4, self._Meta['endpoint'])
+        return bytes(buffer)
 
     @classmethod
-    def parse_message(cls, message):
+    def parse_message(cls, message, lazy=False):
         """
         Parses a message received from the Pebble. Uses Pebble Protocol framing to figure out what sort of packet
         it is. If the packet is registered (has been defined and imported), returns the deserialised packet, which will
@@ -163,6 +346,8 @@ class PebblePacket(with_metaclass(PacketType)):
 
         :param message: A serialised message received from the Pebble.
         :type message: bytes
+        :param lazy: If ``True``, decode the packet lazily, as described in :meth:`parse`.
+        :type lazy: bool
         :return: ``(decoded_message, decoded length)``
         :rtype: (:class:`PebblePacket`, :any:`int`)
         """
@@ -171,38 +356,55 @@ class PebblePacket(with_metaclass(PacketType)):
             raise IncompleteMessage()
         command, = struct.unpack_from('!H', message, 2)
         if command in _PacketRegistry:
-            return _PacketRegistry[command].parse(message[4:length])[0], length
+            return _PacketRegistry[command].parse(memoryview(message)[4:length], lazy=lazy)[0], length
         else:
             return None, length
 
+    @staticmethod
+    def packet_for_endpoint(endpoint):
+        """
+        Returns the packet class registered for a Pebble Protocol endpoint, which is the class that
+        :meth:`parse_message` would use to decode messages sent to it.
+
+        :param endpoint: The endpoint ID.
+        :type endpoint: int
+        :return: The registered packet class, or ``None`` if there isn't one.
+        :rtype: :class:`PacketType`
+        """
+        return _PacketRegistry.get(endpoint)
+
     @classmethod
-    def parse(cls, message, default_endianness=DEFAULT_ENDIANNESS):
+    def parse(cls, message, default_endianness=DEFAULT_ENDIANNESS, lazy=False):
         """
         Parses a message without any framing, returning the decoded result and length of message consumed. The result
         will always be of the same class as :meth:`parse` was called on. If the message is invalid,
         :exc:`.PacketDecodeError` will be raised.
 
+        Parsing works on a single :class:`memoryview` of ``message``; nested packets and lists are decoded from
+        bounded views of it, and bytes are only copied out for the decoded values themselves.
+
+        If ``lazy`` is ``True``, only the leading fixed-width fields (typically a command or other header) are decoded
+        immediately. Each remaining field is decoded the first time it, or any field after it, is accessed, and the
+        result is cached. Decoding errors in those fields are therefore raised on access rather than by :meth:`parse`.
+        Because the length of a lazily decoded packet is not known up front, the entire message is assumed to belong
+        to it, and the returned length is always ``len(message)``.
+
         :param message: The message to decode.
-        :type message: bytes
+        :type message: bytes | memoryview
         :param default_endianness: The default endianness, unless overridden by the fields or class metadata.
                                    Should usually be left at ``None``. Otherwise, use ``'<'`` for little endian and
                                    ``'>'`` for big endian.
+        :param lazy: If ``True``, defer decoding fields until they are accessed.
+        :type lazy: bool
         :return: ``(decoded_message, decoded length)``
         :rtype: (:class:`PebblePacket`, :any:`int`)
         """
-        obj = cls()
-        offset = 0
-        if hasattr(cls, '_Meta'):
-            default_endianness = cls._Meta.get('endianness', default_endianness)
-        for k, v in iteritems(cls._type_mapping):
-            try:
-                value, length = v.buffer_to_value(obj, message, offset, default_endianness=default_endianness)
-            except Exception:
-                logger.warning("Exception decoding {}.{}".format(cls.__name__, k))
-                raise
-            offset += length
-            setattr(obj, k, value)
-        return obj, offset
+        default_endianness = cls._resolve_endianness(default_endianness)
+        if not isinstance(message, memoryview):
+            message = memoryview(message)
+        if lazy:
+            return cls._get_codec(default_endianness).parse_lazy(message), len(message)
+        return cls._get_codec(default_endianness).parse(message)
 
     def __repr__(self):
         return "%s(%s)" % (type(self).__name__,
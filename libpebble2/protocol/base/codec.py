@@ -0,0 +1,340 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+from six import iteritems, itervalues, get_unbound_function
+
+import logging
+import struct
+import threading
+
+from libpebble2.exceptions import PacketDecodeError
+from .types import Field, Padding, Union, Embed, FixedList
+
+__all__ = ["PacketCodec"]
+
+logger = logging.getLogger("libpebble2.protocol")
+
+_field_buffer_to_value = get_unbound_function(Field.buffer_to_value)
+_field_value_to_bytes = get_unbound_function(Field.value_to_bytes)
+_field_prepare = get_unbound_function(Field.prepare)
+
+
+def _overrides(field, name, base_implementation):
+    return get_unbound_function(getattr(type(field), name)) is not base_implementation
+
+
+def _is_fixed_width(field):
+    # Only fields that use the stock struct-based implementation can be merged; anything that overrides
+    # buffer_to_value or value_to_bytes has its own ideas about how it should be encoded.
+    return (field.struct_format is not None
+            and not _overrides(field, 'buffer_to_value', _field_buffer_to_value)
+            and not _overrides(field, 'value_to_bytes', _field_value_to_bytes))
+
+
+def _normalise_endianness(endianness):
+    # '!' and '>' are equivalent, so treat them as such when deciding whether fields can share a struct.
+    return '>' if endianness == '!' else endianness
+
+
+def _deferrable_length(field):
+    # Returns the length field of a field whose contents can be measured as they are written, if it has one.
+    if isinstance(field, (Union, Embed, FixedList)) and isinstance(field.length, Field):
+        return field.length
+    return None
+
+
+class _FieldStep(object):
+    """
+    Encodes or decodes a single field using its own :meth:`~.Field.buffer_to_value` and
+    :meth:`~.Field.value_to_bytes`.
+    """
+    def __init__(self, packet, field, endianness):
+        self.packet = packet
+        self.field = field
+        self.name = field._name
+        self.endianness = endianness
+
+    def decode(self, obj, buffer, offset):
+        try:
+            value, length = self.field.buffer_to_value(obj, buffer, offset, default_endianness=self.endianness)
+        except Exception:
+            logger.warning("Exception decoding {}.{}".format(self.packet.__name__, self.name))
+            raise
+        # Decoded values go straight into the instance, bypassing PebblePacket.__setattr__.
+        obj.__dict__[self.name] = value
+        return length
+
+    def write(self, obj, buffer):
+        self.field.value_to_buffer(obj, getattr(obj, self.name), buffer, default_endianness=self.endianness)
+
+
+class _StructStep(object):
+    """
+    Encodes or decodes a run of adjacent fixed-width fields (and padding) with a single precompiled
+    :class:`struct.Struct`.
+    """
+    def __init__(self, packet, fields, endianness):
+        self.packet = packet
+        self.fields = fields
+        self.endianness = endianness
+        self.struct = struct.Struct(endianness + ''.join(
+            '{}x'.format(x.length) if isinstance(x, Padding) else x.struct_format for x in fields))
+        self.names = [x._name for x in fields if not isinstance(x, Padding)]
+        self.padding_names = [x._name for x in fields if isinstance(x, Padding)]
+        self.enums = [(i, x) for i, x in enumerate(y for y in fields if not isinstance(y, Padding))
+                      if x._enum is not None]
+        #: The byte offset of each field from the start of the run.
+        self.offsets = {}
+        formats = endianness
+        for field in fields:
+            self.offsets[field._name] = struct.calcsize(formats)
+            formats += '{}x'.format(field.length) if isinstance(field, Padding) else field.struct_format
+        #: Indices of values that are back-patched by the codec once the rest of the packet has been written.
+        self.placeholders = []
+
+    def decode(self, obj, buffer, offset):
+        try:
+            values = self.struct.unpack_from(buffer, offset)
+        except struct.error:
+            # Let the fields themselves figure out which one ran off the end, so the error is the same as ever.
+            return self._decode_slowly(obj, buffer, offset)
+        if self.enums:
+            values = list(values)
+            for i, field in self.enums:
+                try:
+                    values[i] = field._enum(values[i])
+                except ValueError as e:
+                    logger.warning("Exception decoding {}.{}".format(self.packet.__name__, field._name))
+                    raise PacketDecodeError("{}: {}".format(field.type, e))
+        fields = obj.__dict__
+        for name, value in zip(self.names, values):
+            fields[name] = value
+        for name in self.padding_names:
+            fields[name] = None
+        return self.struct.size
+
+    def _decode_slowly(self, obj, buffer, offset):
+        start = offset
+        for field in self.fields:
+            offset += _FieldStep(self.packet, field, self.endianness).decode(obj, buffer, offset)
+        return offset - start
+
+    def write(self, obj, buffer):
+        values = [getattr(obj, name) for name in self.names]
+        for i in self.placeholders:
+            values[i] = 0
+        buffer.extend(self.struct.pack(*values))
+
+
+class PacketCodec(object):
+    """
+    A specialised encoder and decoder for a single :class:`.PebblePacket` subclass at a single default endianness.
+    Codecs are compiled lazily by :class:`.PacketType` the first time a packet class is serialised or parsed, and
+    should not ordinarily be used directly.
+
+    :param packet: The packet class to compile.
+    :type packet: .PacketType
+    :param endianness: The endianness to use for fields that do not specify their own.
+    :type endianness: str
+    """
+    def __init__(self, packet, endianness):
+        self.packet = packet
+        self.endianness = endianness
+        fields = list(itervalues(packet._type_mapping))
+
+        #: The names of all fields that are filled in automatically during serialisation.
+        self.inferred_fields = frozenset(x._name for field in fields for x in field.dependent_fields())
+        self.steps = self._compile_steps(fields)
+        #: The index of the step that decodes each field.
+        self.step_index = {}
+        for i, step in enumerate(self.steps):
+            for name in (step.names + step.padding_names if isinstance(step, _StructStep) else [step.name]):
+                self.step_index[name] = i
+        #: Length fields that are filled in after their contents have been written, mapped to the step containing
+        #: them and their offset within it.
+        self.deferred_lengths = self._compile_deferred_lengths(fields)
+        #: The fields that need to be given a chance to manipulate the packet before serialisation, and whether
+        #: they should leave their length field to be back-patched.
+        self.preparers = [(x, self._defers_length(x)) for x in fields if _overrides(x, 'prepare', _field_prepare)]
+        #: For each step, the name of the length field it contributes to, if that length is back-patched.
+        self.step_lengths = [self._defers_length(x.field) and x.field.length._name if isinstance(x, _FieldStep)
+                             else None for x in self.steps]
+
+    def _compile_steps(self, fields):
+        steps = []
+        run = []
+        run_endianness = None
+        for field in fields:
+            if type(field) is Padding:
+                run.append(field)
+                continue
+            if _is_fixed_width(field):
+                field_endianness = _normalise_endianness(str(field.endianness or self.endianness))
+                if run_endianness is not None and field_endianness != run_endianness:
+                    steps.append(self._make_run(run, run_endianness))
+                    run = []
+                run_endianness = field_endianness
+                run.append(field)
+                continue
+            if run:
+                steps.append(self._make_run(run, run_endianness))
+                run = []
+                run_endianness = None
+            steps.append(_FieldStep(self.packet, field, self.endianness))
+        if run:
+            steps.append(self._make_run(run, run_endianness))
+        return steps
+
+    def _make_run(self, fields, endianness):
+        return _StructStep(self.packet, fields, endianness or _normalise_endianness(self.endianness))
+
+    def _compile_deferred_lengths(self, fields):
+        # Unions, Embeds and FixedLists would otherwise have to serialise their contents once during prepare() just
+        # to learn their length. Instead, we write a placeholder and patch it once the contents have been written.
+        # This is only possible if the length is a fixed-width field written earlier in the packet, and is not also
+        # used by some other kind of field that needs its value up front.
+        candidates = {}
+        for field in fields:
+            deferrable = _deferrable_length(field)
+            if deferrable is not None:
+                candidates.setdefault(deferrable._name, True)
+            for dependency in field.dependent_fields():
+                if dependency is not deferrable:
+                    candidates[dependency._name] = False
+        locations = {}
+        for step in self.steps:
+            if isinstance(step, _StructStep):
+                for name in step.names:
+                    locations.setdefault(name, step)
+            else:
+                deferrable = _deferrable_length(step.field)
+                if deferrable is not None and deferrable._name not in locations:
+                    candidates[deferrable._name] = False
+        deferred = {}
+        for name, step in iteritems(locations):
+            if candidates.get(name):
+                deferred[name] = (step, step.offsets[name])
+                step.placeholders.append(step.names.index(name))
+        return deferred
+
+    def _defers_length(self, field):
+        length = _deferrable_length(field)
+        return length is not None and length._name in self.deferred_lengths
+
+    def serialise_into(self, obj, buffer):
+        """
+        Serialises ``obj``, which must be an instance of the packet class this codec was compiled for, appending the
+        result to ``buffer``.
+
+        :param buffer: The buffer to append to.
+        :type buffer: bytearray
+        """
+        for name in self.inferred_fields:
+            setattr(obj, name, None)
+
+        # Some fields want to manipulate other fields that appear before them (e.g. Unions)
+        for field, defer_length in self.preparers:
+            if defer_length:
+                field.prepare(obj, getattr(obj, field._name), defer_length=True)
+            else:
+                field.prepare(obj, getattr(obj, field._name))
+
+        if not self.deferred_lengths:
+            for step in self.steps:
+                step.write(obj, buffer)
+            return
+
+        step_starts = {}
+        lengths = {}
+        for step, length_name in zip(self.steps, self.step_lengths):
+            start = len(buffer)
+            step_starts[step] = start
+            step.write(obj, buffer)
+            if length_name:
+                lengths[length_name] = lengths.get(length_name, 0) + len(buffer) - start
+        for name, (step, offset) in iteritems(self.deferred_lengths):
+            length = lengths.get(name, 0)
+            setattr(obj, name, length)
+            field = obj._type_mapping[name]
+            field._struct(step.endianness).pack_into(buffer, step_starts[step] + offset, length)
+
+    def parse(self, message):
+        """
+        Parses ``message`` into a new instance of the packet class this codec was compiled for.
+
+        :return: ``(decoded_message, decoded length)``
+        :rtype: (:class:`.PebblePacket`, :any:`int`)
+        """
+        obj = self.packet()
+        offset = 0
+        for step in self.steps:
+            offset += step.decode(obj, message, offset)
+        return obj, offset
+
+    @property
+    def fixed_struct(self):
+        """
+        If every field in the packet is fixed-width, the :class:`struct.Struct` that decodes the whole packet;
+        otherwise ``None``.
+        """
+        if len(self.steps) == 1 and isinstance(self.steps[0], _StructStep):
+            return self.steps[0].struct
+        return None
+
+    @property
+    def fixed_fields(self):
+        """
+        The non-padding fields decoded by :attr:`fixed_struct`, in order.
+        """
+        return [x for x in self.steps[0].fields if not isinstance(x, Padding)]
+
+    def parse_lazy(self, message):
+        """
+        Parses the leading fixed-width fields of ``message`` into a new instance of the packet class this codec was
+        compiled for. The remaining fields are decoded, in order, the first time any of them is accessed.
+
+        :return: The partially decoded message.
+        :rtype: .PebblePacket
+        """
+        obj = self.packet()
+        pending = _PendingDecode(self, message)
+        obj.__dict__['_pending_decode'] = pending
+        if self.steps and isinstance(self.steps[0], _StructStep):
+            pending.decode_until(obj, 0)
+        return obj
+
+
+class _PendingDecode(object):
+    """
+    Tracks how far through its message a lazily parsed packet has been decoded.
+    """
+    def __init__(self, codec, message):
+        self.codec = codec
+        self.message = message
+        self.next_step = 0
+        self.offset = 0
+        self.lock = threading.RLock()
+
+    def decode_field(self, obj, name):
+        self.decode_until(obj, self.codec.step_index[name])
+
+    def decode_before_assign(self, obj, name):
+        # A field must be decoded before it is assigned, or decoding it later would overwrite the new value.
+        index = self.codec.step_index.get(name)
+        if index is not None:
+            self.decode_until(obj, index)
+
+    def decode_all(self, obj):
+        self.decode_until(obj, len(self.codec.steps) - 1)
+
+    def decode_until(self, obj, index):
+        # Fields can depend on any field before them, so they are always decoded in order.
+        with self.lock:
+            steps = self.codec.steps
+            while self.next_step <= index:
+                self.offset += steps[self.next_step].decode(obj, self.message, self.offset)
+                self.next_step += 1
+            if self.next_step >= len(steps):
+                # Nothing left to decode, so stop holding on to the message.
+                obj.__dict__.pop('_pending_decode', None)
+                self.message = None
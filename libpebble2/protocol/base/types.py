@@ -15,6 +15,20 @@ __all__ = ["DEFAULT_ENDIANNESS", "Field", "Int8", "Uint8", "Int16", "Uint16", "I
 DEFAULT_ENDIANNESS = '!'
 
 
+def _as_view(buffer):
+    # Nested packets are parsed from bounded sub-views of the original message rather than from copies of it.
+    if isinstance(buffer, memoryview):
+        return buffer
+    return memoryview(buffer)
+
+
+def _materialise(buffer):
+    # The only point at which bytes are actually copied out of a message being parsed.
+    if isinstance(buffer, memoryview):
+        return buffer.tobytes()
+    return buffer
+
+
 class Field(object):
     """
     Base class for Pebble Protocol fields. This class does nothing; only subclasses are useful.
@@ -38,8 +52,17 @@ class Field(object):
         self._enum = enum
         self.field_id = Field.next_id
         self.endianness = endianness
+        self._structs = {}
         Field.next_id += 1
 
+    def _struct(self, default_endianness):
+        endianness = self.endianness or default_endianness
+        try:
+            return self._structs[endianness]
+        except KeyError:
+            compiled = self._structs[endianness] = struct.Struct(str(endianness) + self.struct_format)
+            return compiled
+
     def buffer_to_value(self, obj, buffer, offset, default_endianness=DEFAULT_ENDIANNESS):
         """
         Converts the bytes in ``buffer`` at ``offset`` to a native Python value. Returns that value and the number of
@@ -58,8 +81,8 @@ class Field(object):
         :rtype: (:class:`object`, :any:`int`)
         """
         try:
-            value, length = struct.unpack_from(str(self.endianness or default_endianness)
-                                      + self.struct_format, buffer, offset)[0], struct.calcsize(self.struct_format)
+            compiled = self._struct(default_endianness)
+            value, length = compiled.unpack_from(buffer, offset)[0], compiled.size
             if self._enum is not None:
                 try:
                     return self._enum(value), length
@@ -83,7 +106,23 @@ class Field(object):
         :return: The serialised value
         :rtype: bytes
         """
-        return struct.pack(str(self.endianness or default_endianness) + self.struct_format, value)
+        return self._struct(default_endianness).pack(value)
+
+    def value_to_buffer(self, obj, value, buffer, default_endianness=DEFAULT_ENDIANNESS):
+        """
+        Appends the serialised form of the given value to ``buffer``. The default implementation appends the result
+        of :meth:`value_to_bytes`; fields containing other packets override it to serialise them in place.
+
+        :param obj: The parent :class:`.PebblePacket` of this field
+        :type obj: .PebblePacket
+        :param value: The python value to serialise.
+        :param buffer: The buffer to append to.
+        :type buffer: bytearray
+        :param default_endianness: The default endianness of the value. Used if ``endianness`` was not passed to the
+                                   :class:`Field` constructor.
+        :type default_endianness: str
+        """
+        buffer.extend(self.value_to_bytes(obj, value, default_endianness=default_endianness))
 
     def prepare(self, obj, value):
         pass
@@ -165,7 +204,7 @@ class UUID(Field):
     """
     def buffer_to_value(self, obj, buffer, offset, default_endianness=DEFAULT_ENDIANNESS):
         try:
-            return uuid.UUID(bytes=buffer[offset:offset+16]), 16
+            return uuid.UUID(bytes=_materialise(buffer[offset:offset+16])), 16
         except ValueError as e:
             raise PacketDecodeError("{}: failed to decode UUID: {}".format(self.type, e))
 
@@ -210,20 +249,23 @@ class Union(Field):
         super(Union, self).__init__()
 
     def value_to_bytes(self, obj, value, default_endianness=DEFAULT_ENDIANNESS):
+        buffer = bytearray()
+        self.value_to_buffer(obj, value, buffer, default_endianness=default_endianness)
+        return bytes(buffer)
+
+    def value_to_buffer(self, obj, value, buffer, default_endianness=DEFAULT_ENDIANNESS):
         if value is not None:
-            return value.serialise(default_endianness=default_endianness)
-        elif self.accept_missing:
-            return b''
-        else:
+            value.serialise_into(buffer, default_endianness=default_endianness)
+        elif not self.accept_missing:
             raise Exception("???")
 
-    def prepare(self, obj, value):
+    def prepare(self, obj, value, defer_length=False):
         try:
             setattr(obj, self.determinant._name, self.type_map[type(value)])
         except KeyError:
             if not self.accept_missing:
                 raise
-        if isinstance(self.length, Field):
+        if isinstance(self.length, Field) and not defer_length:
             setattr(obj, self.length._name, len(value.serialise()))
 
     def buffer_to_value(self, obj, buffer, offset, default_endianness=DEFAULT_ENDIANNESS):
@@ -233,7 +275,7 @@ class Union(Field):
             length = len(buffer) - offset
         k = getattr(obj, self.determinant._name)
         try:
-            return self.contents[k].parse(buffer[offset:offset+length], default_endianness=default_endianness)
+            return self.contents[k].parse(_as_view(buffer)[offset:offset+length], default_endianness=default_endianness)
         except KeyError:
             if not self.accept_missing:
                 raise PacketDecodeError("{}: unrecognised value for union: {}".format(self.type, k))
@@ -259,22 +301,28 @@ class Embed(Field):
         self.length = length
         super(Embed, self).__init__()
 
-    def prepare(self, obj, value):
-        if isinstance(self.length, Field):
+    def prepare(self, obj, value, defer_length=False):
+        if isinstance(self.length, Field) and not defer_length:
             setattr(obj, self.length._name, len(value.serialise()))
 
     def value_to_bytes(self, obj, value, default_endianness=DEFAULT_ENDIANNESS):
-        v = value.serialise(default_endianness=default_endianness)
+        buffer = bytearray()
+        self.value_to_buffer(obj, value, buffer, default_endianness=default_endianness)
+        return bytes(buffer)
+
+    def value_to_buffer(self, obj, value, buffer, default_endianness=DEFAULT_ENDIANNESS):
+        start = len(buffer)
+        value.serialise_into(buffer, default_endianness=default_endianness)
         if isinstance(self.length, Field):
             max_len = getattr(obj, self.length._name)
         else:
             max_len = self.length
-        if max_len is not None and len(v) > max_len:
+        if max_len is not None and len(buffer) - start > max_len:
             raise PacketEncodeError("Embedded field with max length {} is actually {} bytes long."
-                                    .format(self.length, len(v)))
-        return v
+                                    .format(self.length, len(buffer) - start))
 
     def buffer_to_value(self, obj, buffer, offset, default_endianness=DEFAULT_ENDIANNESS):
+        buffer = _as_view(buffer)
         if self.length is None:
             return self.packet.parse(buffer[offset:], default_endianness=default_endianness)
         else:
@@ -338,7 +386,8 @@ class PascalString(Field):
         if len(buffer) < offset + length + extra_bytes:
             raise PacketDecodeError("{}: Expected {} bytes, but only had {}".format(
                 self.type, length + extra_bytes, len(buffer) - offset))
-        return buffer[offset+1:offset+1+length].split(b'\x00')[0].decode('utf-8'), length + extra_bytes
+        return (_materialise(buffer[offset+1:offset+1+length]).split(b'\x00')[0].decode('utf-8'),
+                length + extra_bytes)
 
     def value_to_bytes(self, obj, value, default_endianness=DEFAULT_ENDIANNESS):
         value = value[:255].encode('utf-8')
@@ -363,11 +412,10 @@ class NullTerminatedString(Field):
         if end >= len(buffer):
             raise PacketDecodeError("{}: No bytes available.")
         while buffer[end] != b'\x00'[0]:
-            print(buffer[end])
             end += 1
             if end >= len(buffer):
                 raise PacketDecodeError("{}: Reached end of buffer without terminating.".format(self.type))
-        return buffer[offset:end].split(b'\x00')[0].decode('utf-8'), end - offset + 1
+        return _materialise(buffer[offset:end]).decode('utf-8'), end - offset + 1
 
     def value_to_bytes(self, obj, value, default_endianness=DEFAULT_ENDIANNESS):
         return value.encode('utf-8') + b'\x00'
@@ -443,16 +491,23 @@ class PascalList(Field):
             setattr(obj, self.count._name, len(value))
 
     def value_to_bytes(self, obj, values, default_endianness=DEFAULT_ENDIANNESS):
-        result = b''
+        buffer = bytearray()
+        self.value_to_buffer(obj, values, buffer, default_endianness=default_endianness)
+        return bytes(buffer)
+
+    def value_to_buffer(self, obj, values, buffer, default_endianness=DEFAULT_ENDIANNESS):
         for value in values:
-            serialised = value.serialise(default_endianness=default_endianness)
-            result += struct.pack('B', len(serialised)) + serialised
-        return result
+            # Reserve the length byte, serialise the entry after it, then go back and fill it in.
+            start = len(buffer)
+            buffer.append(0)
+            value.serialise_into(buffer, default_endianness=default_endianness)
+            struct.pack_into('B', buffer, start, len(buffer) - start - 1)
 
     def buffer_to_value(self, obj, buffer, offset, default_endianness=DEFAULT_ENDIANNESS):
         results = []
         length = 0
         max_count = None
+        buffer = _as_view(buffer)
 
         if isinstance(self.count, Field):
             max_count = getattr(obj, self.count._name)
@@ -497,11 +552,11 @@ class FixedList(Field):
         self.length = length
         super(FixedList, self).__init__()
 
-    def prepare(self, obj, value):
+    def prepare(self, obj, value, defer_length=False):
         if isinstance(self.count, Field):
             setattr(obj, self.count._name, len(value))
 
-        if isinstance(self.length, Field):
+        if isinstance(self.length, Field) and not defer_length:
             current = getattr(obj, self.length._name) or 0
             if isinstance(self.member_type, Field):
                 total_length = sum(len(self.member_type.value_to_bytes(obj, x)) for x in value)
@@ -510,19 +565,24 @@ class FixedList(Field):
             setattr(obj, self.length._name, current + total_length)
 
     def value_to_bytes(self, obj, values, default_endianness=DEFAULT_ENDIANNESS):
-        result = b''
-        for value in values:
-            if isinstance(self.member_type, Field):
-                result += self.member_type.value_to_bytes(obj, value, default_endianness=default_endianness)
-            else:
-                result += value.serialise(default_endianness=default_endianness)
-        return result
+        buffer = bytearray()
+        self.value_to_buffer(obj, values, buffer, default_endianness=default_endianness)
+        return bytes(buffer)
+
+    def value_to_buffer(self, obj, values, buffer, default_endianness=DEFAULT_ENDIANNESS):
+        if isinstance(self.member_type, Field):
+            for value in values:
+                self.member_type.value_to_buffer(obj, value, buffer, default_endianness=default_endianness)
+        else:
+            for value in values:
+                value.serialise_into(buffer, default_endianness=default_endianness)
 
     def buffer_to_value(self, obj, buffer, offset, default_endianness=DEFAULT_ENDIANNESS):
         results = []
         length = 0
         max_count = None
         max_length = None
+        buffer = _as_view(buffer)
 
         if isinstance(self.count, Field):
             max_count = getattr(obj, self.count._name)
@@ -598,7 +658,7 @@ class BinaryArray(Field):
         if len(buffer) - offset < length:
             raise PacketDecodeError("{}: Expected more bytes (wanted {}; got {}).".format(self.type, length,
                                                                                           len(buffer) - offset))
-        return buffer[offset:offset+length], length
+        return _materialise(buffer[offset:offset+length]), length
 
     def dependent_fields(self):
         if isinstance(self.length, Field):
@@ -625,6 +685,9 @@ class Optional(Field):
     def value_to_bytes(self, *args, **kwargs):
         return self.field.value_to_bytes(*args, **kwargs)
 
+    def value_to_buffer(self, *args, **kwargs):
+        return self.field.value_to_buffer(*args, **kwargs)
+
     def buffer_to_value(self, obj, buffer, offset, default_endianness=DEFAULT_ENDIANNESS):
         if len(buffer) <= offset:
             return None, 0
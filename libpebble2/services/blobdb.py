@@ -1,16 +1,75 @@
 from __future__ import absolute_import
 __author__ = 'katharine'
 
-from collections import namedtuple, OrderedDict
-import random
+from binascii import hexlify, unhexlify
+from collections import deque, namedtuple, OrderedDict
+import hashlib
+import logging
+import os
+import re
+import tempfile
 import threading
 import time
+import uuid
 from six.moves.queue import Queue
 
 from libpebble2.events.mixin import EventSourceMixin
+from libpebble2.exceptions import BlobDBError
 from libpebble2.protocol.blobdb import *
+from libpebble2.util.scheduler import Scheduler
 
-__all__ = ["BlobDBClient", "SyncWrapper"]
+__all__ = ["BlobDBClient", "SyncWrapper", "BlobDBStats", "BlobDBLatency", "BlobDBShadowStore"]
+
+logger = logging.getLogger("libpebble2.services.blobdb")
+
+
+class BlobDBLatency(namedtuple('BlobDBLatency', ('responses', 'mean', 'max'))):
+    """
+    The number of final responses received for one database, and the mean and maximum time in seconds between each
+    command last being sent and its response arriving.
+    """
+    __slots__ = ()
+
+
+class BlobDBStats(namedtuple('BlobDBStats', ('queue_depth', 'in_flight', 'latency'))):
+    """
+    Statistics for a :class:`BlobDBClient`, as returned by :attr:`BlobDBClient.stats`. ``queue_depth`` is the number
+    of commands waiting to be sent (including retries), ``in_flight`` the number awaiting a response, and ``latency``
+    a dict mapping each :class:`.BlobDatabaseID` used to a :class:`BlobDBLatency`.
+    """
+    __slots__ = ()
+
+
+class _TokenAllocator(object):
+    """
+    Hands out BlobDB tokens in sequence, skipping any still in use, so that a token is reused as rarely as possible
+    and never while an earlier command with it is still pending. Not thread safe.
+    """
+    FIRST = 1
+    LAST = 2**16 - 2
+
+    def __init__(self):
+        self._next = self.FIRST
+        self._in_use = set()
+
+    def allocate(self):
+        if len(self._in_use) > self.LAST - self.FIRST:
+            raise BlobDBError("Too many BlobDB commands pending.")
+        while self._next in self._in_use:
+            self._advance()
+        token = self._next
+        self._advance()
+        self._in_use.add(token)
+        return token
+
+    def _advance(self):
+        self._next = self._next + 1 if self._next < self.LAST else self.FIRST
+
+    def release(self, token):
+        self._in_use.discard(token)
+
+    def __len__(self):
+        return len(self._in_use)
 
 
 class BlobDBClient(EventSourceMixin):
@@ -29,32 +88,82 @@ class BlobDBClient(EventSourceMixin):
     :type pebble: .PebbleConnection
     :param timeout: The timeout before resending a BlobDB command.
     :type timeout: int
+    :param window_size: The maximum number of commands awaiting a response from the watch at once. Further commands
+        are sent as responses arrive.
+    :type window_size: int
+    :param scheduler: The scheduler used to time out commands. If omitted, the shared scheduler is used.
+    :type scheduler: .Scheduler
+    :param shadow_store: If given, what the client knows about the watch's databases (see :meth:`known_items`) is
+        saved there, and loaded again by later clients for the same watch, so that :meth:`sync` doesn't need to resend
+        anything that hasn't changed since the last run. This fetches the watch's info, if it hasn't been already.
+        Call :meth:`close` when finished with the client, so that the watch's file is closed.
+    :type shadow_store: .BlobDBShadowStore
+
+    Each pending command has a unique token, which is not reused until long after the command has finished, so
+    late responses can't be mistaken for responses to newer commands. :exc:`.BlobDBError` is raised if all 65,534
+    tokens are pending.
+
+    If the watch responds to a command with :attr:`~.BlobStatus.TryLater`, the command is resent after a short
+    delay, and subsequent commands are delayed too. The delay doubles each time the watch asks us to try later, up to
+    :attr:`MAX_BACKOFF`, and decays again as commands succeed.
+
+    Commands affecting the same item are always sent in the order they were made: a command is held back while an
+    earlier one for the same key, or a clear of the same database, is awaiting a response or waiting to be resent.
     """
+    #: The delay after the watch first responds with :attr:`~.BlobStatus.TryLater`, in seconds.
+    MIN_BACKOFF = 0.05
+    #: The longest delay between commands while the watch keeps responding with :attr:`~.BlobStatus.TryLater`.
+    MAX_BACKOFF = 2.0
+
     _PendingItem = namedtuple('_PendingItem', ('token', 'data', 'callback'))
-    _PendingAck = namedtuple('_PendingAck', ('timestamp', 'data', 'callback'))
+    _PendingAck = namedtuple('_PendingAck', ('timestamp', 'data', 'callback', 'timer'))
 
-    def __init__(self, pebble, timeout=5):
+    def __init__(self, pebble, timeout=5, window_size=4, scheduler=None, shadow_store=None):
         self._pebble = pebble
         self._timeout = timeout
+        self._window_size = max(1, window_size)
+        self._backoff = 0
         self._pending_ack = OrderedDict()
-        self._queue = Queue()
+        self._queue = deque()
         self._lock = threading.Lock()
-        self._running = True
-        self._pebble.register_endpoint(BlobResponse, self._handle_response)
+        self._ready = threading.Condition(self._lock)
+        self._scheduler = scheduler or Scheduler.shared()
+        self._tokens = _TokenAllocator()
+        self._latency = {}
+        self._shadow_log = shadow_store.open(pebble.watch_info) if shadow_store is not None else None
+        self._shadow = self._shadow_log.load() if self._shadow_log is not None else {}
+        self._closed = False
+        self._response_handler = self._pebble.register_endpoint(BlobResponse, self._handle_response)
         self._start_threads()
         EventSourceMixin.__init__(self)
 
     def _start_threads(self):
-        self._pending_ack_thread = threading.Thread(target=self._check_pending_acks)
-        self._pending_ack_thread.daemon = True
-        self._pending_ack_thread.start()
-
         self._queued_data_thread = threading.Thread(target=self._send_queued_data)
         self._queued_data_thread.daemon = True
         self._queued_data_thread.start()
 
+    def close(self):
+        """
+        Stops the client. Commands that have not been sent yet are dropped, and responses to those already sent are
+        ignored. If the client has a shadow store, this waits for every change so far to be written, then closes the
+        watch's file.
+        """
+        with self._lock:
+            self._closed = True
+            self._ready.notify_all()
+        self._pebble.unregister_endpoint(self._response_handler)
+        if self._shadow_log is not None:
+            self._shadow_log.close()
+
     def _enqueue(self, item):
-        self._queue.put(item)
+        with self._lock:
+            self._queue.append(item)
+            self._ready.notify()
+
+    def _requeue(self, item):
+        # Retries go to the front of the queue, ahead of any later commands. Must be called with the lock held.
+        self._queue.appendleft(item)
+        self._ready.notify()
 
     def insert(self, database, key, value, callback=None):
         """
@@ -102,41 +211,401 @@ class BlobDBClient(EventSourceMixin):
                                                            content=ClearCommand()),
                                         callback))
 
-    def _check_pending_acks(self):
-        while self._running:
-            with self._lock:
-                # check pending acks
-                now = time.time()
-                for token, pending in list(self._pending_ack.items()):
-                    if now - pending.timestamp > self._timeout:
-                        del self._pending_ack[token]
-                        self._enqueue(self._PendingItem(token, pending.data, pending.callback))
-            time.sleep(5)
+    def sync(self, database, items, callback=None):
+        """
+        Makes the given database contain exactly the given items, sending only what has changed. Items that the watch
+        already has with the same value are skipped, and items that this client previously put in the database but
+        that aren't in ``items`` are deleted. All the necessary commands are sent at once.
+
+        What the watch has is taken from the client's shadow index (see :meth:`known_items`): the items inserted
+        through this client, plus, if it has a ``shadow_store``, those recorded there by earlier clients for the same
+        watch. Anything else is assumed to be missing from the watch, and is never deleted.
+
+        :param database: The database to sync.
+        :type database: .BlobDatabaseID
+        :param items: The complete contents the database should have.
+        :type items: dict[uuid.UUID, bytes]
+        :param callback: A callback to be called when every command has completed, with a dict mapping the key of each
+                         item that was inserted or deleted to its :class:`.BlobStatus`. If nothing needed changing,
+                         the dict is empty.
+        """
+        with self._lock:
+            shadow = dict(self._shadow.get(database, {}))
+        inserts = [(key, value) for key, value in items.items() if shadow.get(key) != _content_hash(value)]
+        deletes = [key for key in shadow if key not in items]
+        results = {}
+        expected = len(inserts) + len(deletes)
+
+        def handle_result(key):
+            def handler(status):
+                results[key] = status
+                if len(results) == expected and callable(callback):
+                    callback(results)
+            return handler
+
+        if expected == 0:
+            if callable(callback):
+                callback(results)
+            return
+        for key, value in inserts:
+            self.insert(database, key, value, callback=handle_result(key))
+        for key in deletes:
+            self.delete(database, key, callback=handle_result(key))
+
+    def known_items(self, database):
+        """
+        Returns what this client knows the watch to have in a database: the key of every item it, or an earlier client
+        using the same ``shadow_store``, has successfully inserted and not since deleted, along with a hash of the
+        item's value.
+
+        :param database: The database.
+        :type database: .BlobDatabaseID
+        :rtype: dict[uuid.UUID, bytes]
+        """
+        with self._lock:
+            return dict(self._shadow.get(database, {}))
+
+    def _update_shadow(self, command, status):
+        content = command.content
+        shadow = self._shadow.setdefault(command.database, {})
+        log = self._shadow_log
+        if isinstance(content, ClearCommand):
+            if status == BlobStatus.Success:
+                shadow.clear()
+                if log is not None:
+                    log.clear(command.database)
+            return
+        key = uuid.UUID(bytes=content.key)
+        if isinstance(content, InsertCommand) and status == BlobStatus.Success:
+            shadow[key] = _content_hash(content.value)
+            if log is not None:
+                log.insert(command.database, key, shadow[key])
+        elif shadow.pop(key, None) is not None and log is not None:
+            # Either it was deleted, or we don't know what the watch has any more.
+            log.delete(command.database, key)
+
+    def _handle_timeout(self, token, sent_at):
+        with self._lock:
+            pending = self._pending_ack.get(token)
+            # Timers are cancelled after the lock is released, so this may be the timer for an earlier attempt.
+            if pending is None or pending.timestamp != sent_at:
+                return
+            del self._pending_ack[token]
+            self._requeue(self._PendingItem(token, pending.data, pending.callback))
+
+    def _next_sendable(self):
+        # Finds the first queued command that doesn't affect the same item as one in flight, or as an earlier
+        # command that is itself being held back. Must be called with the lock held.
+        busy = [_command_scope(pending.data) for pending in self._pending_ack.values()]
+        for i, item in enumerate(self._queue):
+            scope = _command_scope(item.data)
+            if any(_scopes_overlap(scope, other) for other in busy):
+                busy.append(scope)
+                continue
+            del self._queue[i]
+            return item
+        return None
 
     def _send_queued_data(self):
         while True:
-            token, data, callback = self._queue.get()
             with self._lock:
-                self._pending_ack[token] = self._PendingAck(time.time(), data, callback)
-                self._pebble.send_packet(data)
-            time.sleep(0.05)
+                while True:
+                    if self._closed:
+                        return
+                    if len(self._pending_ack) < self._window_size:
+                        item = self._next_sendable()
+                        if item is not None:
+                            break
+                    self._ready.wait()
+                token, data, callback = item
+                backoff = self._backoff
+            if backoff:
+                time.sleep(backoff)
+            # Timers are armed and cancelled without the lock held, so that the scheduler never waits for it.
+            sent_at = time.time()
+            timer = self._scheduler.call_later(self._timeout, self._handle_timeout, token, sent_at)
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    self._pending_ack[token] = self._PendingAck(sent_at, data, callback, timer)
+                    self._pebble.send_packet(data)
+            if closed:
+                timer.cancel()
+                return
 
-    @staticmethod
-    def _get_token():
-        return random.randrange(1, 2**16 - 1, 1)
+    def _get_token(self):
+        with self._lock:
+            return self._tokens.allocate()
+
+    @property
+    def stats(self):
+        """
+        Statistics on the commands sent by this client.
+
+        :rtype: BlobDBStats
+        """
+        with self._lock:
+            latency = {database: BlobDBLatency(count, total / count, maximum)
+                       for database, (count, total, maximum) in self._latency.items()}
+            return BlobDBStats(queue_depth=len(self._queue), in_flight=len(self._pending_ack), latency=latency)
+
+    def reset_stats(self):
+        """
+        Resets the latencies reported by :attr:`stats`.
+        """
+        with self._lock:
+            self._latency = {}
+
+    def _record_latency(self, database, latency):
+        count, total, maximum = self._latency.get(database, (0, 0.0, 0.0))
+        self._latency[database] = (count + 1, total + latency, max(maximum, latency))
 
     def _handle_response(self, packet):
-        if packet.response == BlobStatus.TryLater:
-            # Do nothing, wait for the packet to timeout and re-send
+        with self._lock:
+            if self._closed:
+                return
+            pending = self._pending_ack.pop(packet.token, None)
+            if pending is None:
+                return
+            self._ready.notify()
+
+            retry = packet.response == BlobStatus.TryLater
+            if retry:
+                # The watch is busy, so slow down and send it again.
+                self._backoff = min(self.MAX_BACKOFF, max(self.MIN_BACKOFF, self._backoff * 2))
+                self._requeue(self._PendingItem(packet.token, pending.data, pending.callback))
+            else:
+                if self._backoff:
+                    self._backoff = self._backoff / 2 if self._backoff / 2 >= self.MIN_BACKOFF else 0
+
+                self._tokens.release(packet.token)
+                self._record_latency(pending.data.database, time.time() - pending.timestamp)
+                self._update_shadow(pending.data, packet.response)
+
+        # The timer is cancelled, and callbacks are called, without the lock held, so that callbacks can send more
+        # commands.
+        pending.timer.cancel()
+        if retry:
             return
+        if callable(pending.callback):
+            pending.callback(packet.response)
 
-        with self._lock:
-            if packet.token in self._pending_ack:
-                pending = self._pending_ack[packet.token]
-                del self._pending_ack[packet.token]
 
-                if callable(pending.callback):
-                    pending.callback(packet.response)
+def _command_scope(command):
+    # A clear affects every key in its database, which is represented by a key of None.
+    content = command.content
+    return command.database, None if isinstance(content, ClearCommand) else content.key
+
+
+def _scopes_overlap(a, b):
+    return a[0] == b[0] and (a[1] is None or b[1] is None or a[1] == b[1])
+
+
+def _content_hash(value):
+    return hashlib.sha1(value).digest()
+
+
+class BlobDBShadowStore(object):
+    """
+    Saves what each :class:`BlobDBClient` using it knows about its watch's databases, so that it survives restarts.
+    Each watch has its own file in ``directory``, named after its serial number, to which every change is appended as
+    it happens. Once the file has built up enough superseded entries, it is rewritten to contain only what is current.
+
+    A watch's file is discarded if the watch's firmware has changed, or the watch reports that it has been paired with
+    another phone, since the watch's databases may no longer match.
+
+    Changes are written on a background thread, so that clients never wait for the disk. The thread stops and the file
+    is closed when the client is closed (see :meth:`BlobDBClient.close`). Only one client at a time
+    should use the store for any given watch: opening a watch's file rewrites it and renames the new file over the
+    old one, so a client that already had it open would carry on writing to the replaced file, and its changes would
+    be lost.
+
+    :param directory: The directory in which to keep the files. It is created if necessary.
+    :type directory: str
+    :param compact_threshold: The number of superseded entries a file may have before it is rewritten.
+    :type compact_threshold: int
+    """
+    def __init__(self, directory, compact_threshold=1000):
+        self.directory = directory
+        self.compact_threshold = compact_threshold
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open(self, watch_info):
+        """
+        Opens the file for a watch. This compacts the file by replacing it, so nothing else should have the same
+        watch's file open.
+
+        :param watch_info: The watch's info, from :attr:`.PebbleConnection.watch_info`.
+        :type watch_info: .WatchVersionResponse
+        :return: The watch's log.
+        :rtype: _ShadowLog
+        """
+        serial = re.sub(r'[^A-Za-z0-9_-]', '_', watch_info.serial) or 'unknown'
+        running = watch_info.running
+        firmware = "{}-{}-{}".format(running.version_tag, running.git_hash, running.timestamp)
+        return _ShadowLog(os.path.join(self.directory, serial + '.log'), firmware, self.compact_threshold,
+                          discard=bool(watch_info.is_unfaithful))
+
+
+# Commands for a _ShadowLog's writer thread, queued alongside changes.
+_COMPACT = object()
+_CLOSE = object()
+
+
+class _ShadowLog(object):
+    """
+    One watch's file in a :class:`BlobDBShadowStore`. The first line identifies the firmware the entries are for, and
+    each subsequent line records an insert (``I database key hash``), delete (``D database key``) or clear
+    (``C database``), with keys and hashes in hex.
+
+    Once the file has been loaded, changes are queued and written, in order, by a background thread, which also does
+    all compaction from then on, and runs until the log is closed.
+    """
+    def __init__(self, path, firmware, compact_threshold, discard=False):
+        self.path = path
+        self.firmware = firmware
+        self.compact_threshold = compact_threshold
+        self._discard = discard
+        self._state = {}
+        self._superseded = 0
+        self._file = None
+        self._queue = Queue()
+        self._writer = None
+        self._closed = False
+
+    def load(self):
+        """
+        Reads the file, starting a new one if it is missing, unreadable, or for different firmware.
+
+        :return: The contents of each database, in the form used by :meth:`BlobDBClient.known_items`.
+        :rtype: dict[.BlobDatabaseID, dict[uuid.UUID, bytes]]
+        """
+        lines = []
+        if not self._discard:
+            try:
+                with open(self.path) as f:
+                    lines = f.read().splitlines()
+            except (IOError, OSError):
+                pass
+        if lines[:1] != ['F ' + self.firmware]:
+            if lines:
+                logger.info("Discarding BlobDB shadow %s, because the watch may have changed.", self.path)
+            lines = []
+        for line in lines[1:]:
+            try:
+                self._apply(line.split(' '))
+            except (ValueError, TypeError, IndexError):
+                # Probably a partially written line from when we last stopped.
+                logger.warning("Ignoring bad entry in %s: %r", self.path, line)
+        self._compact()
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_changes)
+            self._writer.daemon = True
+            self._writer.name = "BlobDBShadowStore"
+            self._writer.start()
+        return {database: dict(items) for database, items in self._state.items()}
+
+    def _apply(self, fields):
+        database = BlobDatabaseID(int(fields[1]))
+        items = self._state.setdefault(database, {})
+        if fields[0] == 'I':
+            key = uuid.UUID(hex=fields[2])
+            value = unhexlify(fields[3].encode('ascii'))
+            if key in items:
+                self._superseded += 1
+            items[key] = value
+        elif fields[0] == 'D':
+            if items.pop(uuid.UUID(hex=fields[2]), None) is not None:
+                self._superseded += 2
+            else:
+                self._superseded += 1
+        elif fields[0] == 'C':
+            self._superseded += len(items) + 1
+            items.clear()
+        else:
+            raise ValueError(fields[0])
+
+    def insert(self, database, key, content_hash):
+        self._enqueue(['I', str(int(database)), key.hex, hexlify(content_hash).decode('ascii')])
+
+    def delete(self, database, key):
+        self._enqueue(['D', str(int(database)), key.hex])
+
+    def clear(self, database):
+        self._enqueue(['C', str(int(database))])
+
+    def _enqueue(self, command):
+        if not self._closed:
+            self._queue.put(command)
+
+    def flush(self):
+        """
+        Waits until every change so far has been written.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Writes any outstanding changes, then stops the background thread and closes the file. Further changes are
+        ignored.
+        """
+        self._closed = True
+        if self._writer is not None:
+            self._queue.put(_CLOSE)
+            self._writer.join()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_changes(self):
+        while True:
+            fields = self._queue.get()
+            try:
+                if fields is _CLOSE:
+                    return
+                elif fields is _COMPACT:
+                    self._compact()
+                else:
+                    self._append(fields)
+            except Exception:
+                logger.exception("Couldn't write to BlobDB shadow %s.", self.path)
+            finally:
+                self._queue.task_done()
+
+    def _append(self, fields):
+        self._apply(fields)
+        if self._superseded > self.compact_threshold:
+            self._compact()
+        else:
+            self._file.write(' '.join(fields) + '\n')
+            self._file.flush()
+
+    def compact(self):
+        """
+        Rewrites the file to contain only the current contents of each database, once every change so far has been
+        written.
+        """
+        self._enqueue(_COMPACT)
+
+    def _compact(self):
+        # Only called by the writer thread, or before it starts.
+        if self._file is not None:
+            self._file.close()
+        directory = os.path.dirname(self.path) or '.'
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write('F ' + self.firmware + '\n')
+            for database, items in self._state.items():
+                for key, content_hash in items.items():
+                    f.write('I {} {} {}\n'.format(int(database), key.hex, hexlify(content_hash).decode('ascii')))
+        if os.path.exists(self.path) and os.name == 'nt':
+            # Windows won't rename over an existing file.
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+        self._superseded = 0
+        self._file = open(self.path, 'a')
 
 
 class SyncWrapper(object):
@@ -1,9 +1,6 @@
 from __future__ import absolute_import
 __author__ = 'katharine'
 
-from array import array
-from six.moves import range
-
 from libpebble2.events.mixin import EventSourceMixin
 from libpebble2.exceptions import GetBytesError
 from libpebble2.protocol.transfers import *
@@ -68,7 +65,7 @@ class GetBytesService(EventSourceMixin):
                 raise GetBytesError(info.error_code)
 
             # Allocate a mutable array large enough to contain the data
-            data = array('B', (0 for _ in range(info.num_bytes)))
+            data = bytearray(info.num_bytes)
 
             bytes_received = 0
             while bytes_received < info.num_bytes:
@@ -77,9 +74,9 @@ class GetBytesService(EventSourceMixin):
                 bytes_received += len(part.data)
 
                 # Insert the received chunk into our array.
-                data[part.offset:part.offset+len(part.data)] = array('B', part.data)
+                data[part.offset:part.offset+len(part.data)] = part.data
 
-            # Return the data as a more standard bytearray.
-            return data.tostring()
+            # Return the data as a more standard bytes object.
+            return bytes(data)
         finally:
             queue.close()
@@ -1,6 +1,11 @@
 from __future__ import absolute_import
 __author__ = 'katharine'
 
+import logging
+import threading
+
+from six.moves import queue
+
 from .blobdb import BlobDBClient, BlobDatabaseID, SyncWrapper, BlobStatus
 from .putbytes import PutBytes, PutBytesType
 from libpebble2.events.mixin import EventSourceMixin
@@ -8,9 +13,72 @@ from libpebble2.exceptions import AppInstallError
 from libpebble2.protocol.apps import AppMetadata, AppRunState, AppRunStateStart, AppFetchRequest, AppFetchResponse, AppFetchStatus
 from libpebble2.protocol.legacy2 import *
 from libpebble2.services.appmessage import AppMessageService, Uint8 as AMUint8
-from libpebble2.util.bundle import PebbleBundle
+from libpebble2.util.bundle import PebbleBundle, BundleCache
+from libpebble2.util.hardware import PebbleHardware
+
+__all__ = ["AppInstaller", "MultiAppInstaller"]
+
+logger = logging.getLogger("libpebble2.services.install")
+
+
+class _PartPipeline(object):
+    """
+    Fetches the parts of an app and their CRCs from a bundle (see :meth:`.PebbleBundle.get_part`) on a
+    background thread, in the order they will be sent, so that each part is usually ready before the watch has
+    finished receiving the one before it. At most one part is fetched ahead of the one being sent.
 
-__all__ = ["AppInstaller"]
+    :param bundle: The bundle to read the parts from.
+    :type bundle: .PebbleBundle
+    :param parts: The ``(type, path)`` of each part, in the order they will be sent.
+    :type parts: list[(.PutBytesType, str)]
+    """
+    def __init__(self, bundle, parts):
+        self._bundle = bundle
+        self._parts = [(object_type, path, threading.Event(), {}) for object_type, path in parts]
+        # One slot for the part being sent, and one for the part after it.
+        self._slots = threading.Semaphore(2)
+        self._closed = False
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.name = "AppInstaller"
+        thread.start()
+
+    def _run(self):
+        for object_type, path, ready, result in self._parts:
+            self._slots.acquire()
+            if self._closed:
+                return
+            try:
+                data, crc = self._bundle.get_part(path)
+                result['part'] = (object_type, data, len(data), crc)
+            except Exception as e:
+                result['error'] = e
+                return
+            finally:
+                ready.set()
+
+    def __iter__(self):
+        """
+        Yields ``(type, data, size, crc)`` for each part, waiting for it to be ready if necessary.
+        """
+        try:
+            for object_type, path, ready, result in self._parts:
+                ready.wait()
+                if 'error' in result:
+                    raise result['error']
+                part = result.pop('part')
+                yield part
+                # We're done with this part, so the next but one can be fetched.
+                self._slots.release()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops fetching parts.
+        """
+        self._closed = True
+        self._slots.release()
 
 
 class AppInstaller(EventSourceMixin):
@@ -23,14 +91,26 @@ class AppInstaller(EventSourceMixin):
 
     :param pebble: The :class:`PebbleConnection` over which to install the app.
     :type pebble: .PebbleConnection
-    :param pbw_path: The path to the PBW file to be installed on the filesystem.
+    :param pbw_path: The path to the PBW file to be installed on the filesystem, or a :class:`.PebbleBundle` already
+                     opened for the watch's hardware.
     :type pbw_path: str
     :param blobdb_client: An optional :class:`BlobDBClient` to use, if one already exists. If omitted, one will be
                           created.
     :type blobdb_client: .BlobDBClient
+    :param window_size: The number of PutBytes chunks to keep in flight at once. See :class:`.PutBytes`.
+    :type window_size: int
+    :param bundle_cache: A cache of bundle contents to use, if any. This is useful when installing the same app many
+                         times.
+    :type bundle_cache: .BundleCache
+
+    Each part of the app is decompressed and its CRC worked out on a background thread while the part before it is
+    sent, starting before the watch asks for the app. At most two parts are in memory at once: the one being sent, and
+    the one after it.
     """
-    def __init__(self, pebble, pbw_path, blobdb_client=None):
+    def __init__(self, pebble, pbw_path, blobdb_client=None, window_size=1, bundle_cache=None):
         self._pebble = pebble
+        self._bundle_cache = bundle_cache
+        self._window_size = window_size
         self._blobdb = blobdb_client or BlobDBClient(pebble)
         EventSourceMixin.__init__(self)
         #: Total number of bytes sent so far.
@@ -40,16 +120,23 @@ class AppInstaller(EventSourceMixin):
         self._prepare(pbw_path)
 
     def _prepare(self, pbw_path):
-        self._bundle = PebbleBundle(pbw_path, hardware=self._pebble.watch_info.running.hardware_platform)
+        if isinstance(pbw_path, PebbleBundle):
+            self._bundle = pbw_path
+        else:
+            self._bundle = PebbleBundle(pbw_path, hardware=self._pebble.watch_info.running.hardware_platform,
+                                        cache=self._bundle_cache)
         if not self._bundle.is_app_bundle:
             raise AppInstallError("This is not an app bundle.")
 
-        self.total_size = self._bundle.zip.getinfo(self._bundle.get_app_path()).file_size
-        if self._bundle.has_resources:
-            self.total_size += self._bundle.zip.getinfo(self._bundle.get_resource_path()).file_size
+        self.total_size = sum(self._bundle.zip.getinfo(path).file_size for object_type, path in self._parts())
 
+    def _parts(self):
+        parts = [(PutBytesType.Binary, self._bundle.get_app_path())]
+        if self._bundle.has_resources:
+            parts.append((PutBytesType.Resources, self._bundle.get_resource_path()))
         if self._bundle.has_worker:
-            self.total_size += self._bundle.zip.getinfo(self._bundle.get_worker_path()).file_size
+            parts.append((PutBytesType.Worker, self._bundle.get_worker_path()))
+        return parts
 
     def install(self, force_install=False):
         """
@@ -64,12 +151,21 @@ class AppInstaller(EventSourceMixin):
         """
         if not (force_install or self._bundle.should_permit_install()):
             raise AppInstallError("This pbw is not supported on this platform.")
-        if self._pebble.firmware_version.major < 3:
-            self._install_legacy2()
-        else:
-            self._install_modern()
+        parts = self._prepare_parts()
+        try:
+            if self._pebble.firmware_version.major < 3:
+                self._install_legacy2(parts)
+            else:
+                self._install_modern(parts)
+        finally:
+            parts.close()
 
-    def _install_modern(self):
+    def _prepare_parts(self):
+        # Returns an iterator of (type, data, size, crc) for each part, which must be closed when done with. Parts are
+        # fetched in the background, starting immediately, so that it overlaps with talking to the watch.
+        return _PartPipeline(self._bundle, self._parts())
+
+    def _install_modern(self, parts):
         metadata = self._bundle.get_app_metadata()
         app_uuid = metadata['uuid']
         blob_packet = AppMetadata(uuid=app_uuid, flags=metadata['flags'], icon=metadata['icon_resource_id'],
@@ -92,23 +188,16 @@ class AppInstaller(EventSourceMixin):
         self._broadcast_event('progress', 0, self.total_sent, self.total_size)
 
         # Send the app over
-        binary = self._bundle.zip.read(self._bundle.get_app_path())
-        self._send_part(PutBytesType.Binary, binary, app_fetch.app_id)
-
-        if self._bundle.has_resources:
-            resources = self._bundle.zip.read(self._bundle.get_resource_path())
-            self._send_part(PutBytesType.Resources, resources, app_fetch.app_id)
+        for object_type, object, size, crc in parts:
+            self._send_part(object_type, object, size, crc, app_fetch.app_id)
 
-        if self._bundle.has_worker:
-            worker = self._bundle.zip.read(self._bundle.get_worker_path())
-            self._send_part(PutBytesType.Worker, worker, app_fetch.app_id)
-
-    def _send_part(self, type, object, install_id):
-        pb = PutBytes(self._pebble, type, object, app_install_id=install_id)
+    def _send_part(self, type, object, size, crc, install_id):
+        pb = PutBytes(self._pebble, type, object, app_install_id=install_id, window_size=self._window_size,
+                      object_size=size, object_crc=crc)
         pb.register_handler("progress", self._handle_progress)
         pb.send()
 
-    def _install_legacy2(self):
+    def _install_legacy2(self, parts):
         metadata = self._bundle.get_app_metadata()
         app_uuid = metadata['uuid']
 
@@ -129,16 +218,8 @@ class AppInstaller(EventSourceMixin):
             raise AppInstallError("No app banks free.")
 
         # Send the app over
-        binary = self._bundle.zip.read(self._bundle.get_app_path())
-        self._send_part_legacy2(PutBytesType.Binary, binary, first_free)
-
-        if self._bundle.has_resources:
-            resources = self._bundle.zip.read(self._bundle.get_resource_path())
-            self._send_part_legacy2(PutBytesType.Resources, resources, first_free)
-
-        if self._bundle.has_worker:
-            worker = self._bundle.zip.read(self._bundle.get_worker_path())
-            self._send_part_legacy2(PutBytesType.Worker, worker, first_free)
+        for object_type, object, size, crc in parts:
+            self._send_part_legacy2(object_type, object, size, crc, first_free)
 
         # Mark it as available
         self._pebble.send_and_read(LegacyAppInstallRequest(data=LegacyAppAvailable(bank=first_free, vibrate=True)),
@@ -151,11 +232,133 @@ class AppInstaller(EventSourceMixin):
         })
         appmessage.shutdown()
 
-    def _send_part_legacy2(self, type, object, bank):
-        pb = PutBytes(self._pebble, type, object, bank=bank)
+    def _send_part_legacy2(self, type, object, size, crc, bank):
+        pb = PutBytes(self._pebble, type, object, bank=bank, window_size=self._window_size, object_size=size,
+                      object_crc=crc)
         pb.register_handler("progress", self._handle_progress)
         pb.send()
 
     def _handle_progress(self, sent, total_sent, total_length):
         self.total_sent += sent
         self._broadcast_event('progress', sent, self.total_sent, self.total_size)
+
+
+class MultiAppInstaller(EventSourceMixin):
+    """
+    Installs the same app on many Pebbles at once. The bundle is only read and decompressed once per hardware platform,
+    and up to ``max_parallel`` installs run simultaneously, each on its own thread.
+
+    While :meth:`install` runs, "progress" events are emitted with the following signature: ::
+
+       (pebble, sent_this_interval, sent_total, total_size)
+
+    where ``sent_total`` and ``total_size`` cover every Pebble. ``total_size`` grows as the size of the app for each
+    Pebble becomes known. When an install finishes, successfully or otherwise, a "complete" event is emitted: ::
+
+       (pebble, error)
+
+    where ``error`` is ``None`` if the install succeeded, or the exception that caused it to fail.
+
+    :param pebbles: The connections to the Pebbles to install the app on.
+    :type pebbles: list[.PebbleConnection]
+    :param pbw_path: The path to the PBW file to be installed on the filesystem.
+    :type pbw_path: str
+    :param max_parallel: The maximum number of installs to run at once.
+    :type max_parallel: int
+    :param window_size: The number of PutBytes chunks to keep in flight at once. See :class:`.PutBytes`.
+    :type window_size: int
+    :param bundle_cache: A cache of bundle contents to use. If omitted, one is created for the duration of the
+                         install.
+    :type bundle_cache: .BundleCache
+    :param blobdb_clients: The :class:`.BlobDBClient` to use for each Pebble, if any already exist.
+    :type blobdb_clients: dict[.PebbleConnection, .BlobDBClient]
+    """
+    def __init__(self, pebbles, pbw_path, max_parallel=8, window_size=1, bundle_cache=None, blobdb_clients=None):
+        self._pebbles = list(pebbles)
+        self._pbw_path = pbw_path
+        self._max_parallel = max(1, max_parallel)
+        self._window_size = window_size
+        self._bundle_cache = bundle_cache or BundleCache()
+        self._blobdb_clients = blobdb_clients or {}
+        self._bundles = {}
+        self._bundle_lock = threading.Lock()
+        self._lock = threading.Lock()
+        EventSourceMixin.__init__(self)
+        #: Total number of bytes sent so far, to every Pebble.
+        self.total_sent = 0
+        #: Total number of bytes to send, to every Pebble whose install has started.
+        self.total_size = 0
+
+    def install(self, force_install=False):
+        """
+        Installs the app on every Pebble. Blocks until every install has finished. Failures do not affect any other
+        install, and are reported rather than raised.
+
+        :param force_install: Install even if installing this pbw on a platform is usually forbidden.
+        :type force_install: bool
+        :return: The result of each install: ``None`` if it succeeded, or the exception that caused it to fail.
+        :rtype: dict[.PebbleConnection, Exception]
+        """
+        pending = queue.Queue()
+        for pebble in self._pebbles:
+            pending.put(pebble)
+        results = {}
+        threads = []
+        for i in range(min(self._max_parallel, len(self._pebbles))):
+            thread = threading.Thread(target=self._run, args=(pending, results, force_install))
+            thread.daemon = True
+            thread.name = "MultiAppInstaller-{}".format(i)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _run(self, pending, results, force_install):
+        while True:
+            try:
+                pebble = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._install_one(pebble, force_install)
+            except Exception as e:
+                logger.warning("Installing on %s failed: %s", pebble, e)
+                results[pebble] = e
+            else:
+                results[pebble] = None
+            self._broadcast_event('complete', pebble, results[pebble])
+
+    def _install_one(self, pebble, force_install):
+        bundle = self._bundle_for(pebble.watch_info.running.hardware_platform)
+        installer = AppInstaller(pebble, bundle, blobdb_client=self._blobdb_clients.get(pebble),
+                                 window_size=self._window_size)
+        with self._lock:
+            self.total_size += installer.total_size
+        installer.register_handler('progress', lambda sent, total_sent, total_size: self._handle_progress(pebble,
+                                                                                                         sent))
+        installer.install(force_install=force_install)
+
+    def _bundle_for(self, hardware):
+        # Watches on the same platform get the same bundle, which is read in full before anyone uses it, so that it's
+        # usually served from the cache. The cache may evict parts again, but the bundle locks its own zip reads, so
+        # it's still safe to share between threads.
+        platform = PebbleHardware.hardware_platform(hardware)
+        with self._bundle_lock:
+            if platform not in self._bundles:
+                bundle = PebbleBundle(self._pbw_path, hardware=hardware, cache=self._bundle_cache)
+                if bundle.is_app_bundle:
+                    bundle.get_app_metadata()
+                    bundle.get_part(bundle.get_app_path())
+                    if bundle.has_resources:
+                        bundle.get_part(bundle.get_resource_path())
+                    if bundle.has_worker:
+                        bundle.get_part(bundle.get_worker_path())
+                self._bundles[platform] = bundle
+            return self._bundles[platform]
+
+    def _handle_progress(self, pebble, sent):
+        with self._lock:
+            self.total_sent += sent
+            total_sent, total_size = self.total_sent, self.total_size
+        self._broadcast_event('progress', pebble, sent, total_sent, total_size)
@@ -1,14 +1,21 @@
 from __future__ import absolute_import
 __author__ = 'katharine'
 
+from collections import deque, namedtuple
 from enum import IntEnum
+import logging
+import mmap
+import os
+import time
 
 from libpebble2.events.mixin import EventSourceMixin
-from libpebble2.exceptions import PutBytesError
+from libpebble2.exceptions import PutBytesError, TimeoutError
 from libpebble2.protocol import transfers
 from libpebble2.util import stm32_crc
 
-__all__ = ["PutBytes", "PutBytesType"]
+__all__ = ["PutBytes", "PutBytesType", "PutBytesCheckpoint"]
+
+logger = logging.getLogger("libpebble2.services.putbytes")
 
 
 class PutBytesType(IntEnum):
@@ -21,6 +28,67 @@ class PutBytesType(IntEnum):
     Worker = 7
 
 
+PutBytesCheckpoint = namedtuple('PutBytesCheckpoint', ('cookie', 'offset', 'crc_state', 'object_type',
+                                                       'object_size'))
+"""
+Records how far a :class:`PutBytes` transfer got, so that it can be resumed with the same session later. ``offset`` is
+the number of bytes the watch has acknowledged, and ``crc_state`` is the :attr:`~.Crc32.state` of the CRC of those
+bytes, or ``None`` if the CRC of the whole object was given up front.
+"""
+
+
+class _ChunkSizer(object):
+    """
+    Chooses the size of PutBytes chunks. Chunks start at the largest size permitted, shrink rapidly if the watch
+    starts taking much longer than usual to acknowledge each chunk, and grow back slowly while it keeps up.
+
+    Decisions are based on how long each chunk takes to be acknowledged, not on how long each byte takes: much of that
+    time is spent on the round trip rather than on the chunk's contents, so smaller chunks always take longer per
+    byte, and would otherwise look slower than the larger chunks they replaced.
+
+    :param maximum: The largest permissible chunk size.
+    :type maximum: int
+    :param minimum: The smallest chunk size to shrink to.
+    :type minimum: int
+    """
+    #: A chunk taking this many times longer than usual to be acknowledged causes the chunk size to halve.
+    SLOWDOWN_FACTOR = 2.0
+    #: The number of consecutive chunks acknowledged at least as quickly as usual before the chunk size grows.
+    GROWTH_INTERVAL = 4
+
+    def __init__(self, maximum, minimum):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        #: The size to use for the next chunk.
+        self.size = maximum
+        self._step = max(1, maximum // 8)
+        self._round_trip = None
+        self._fast_chunks = 0
+
+    def record(self, elapsed):
+        """
+        Records how long the watch took to acknowledge a chunk, and updates :attr:`size` accordingly.
+
+        :param elapsed: The time it took to acknowledge, in seconds.
+        :type elapsed: float
+        """
+        if elapsed <= 0:
+            return
+        if self._round_trip is None:
+            self._round_trip = elapsed
+            return
+        if elapsed > self._round_trip * self.SLOWDOWN_FACTOR:
+            self.size = max(self.minimum, self.size // 2)
+            self._fast_chunks = 0
+        elif elapsed <= self._round_trip:
+            self._fast_chunks += 1
+            if self._fast_chunks >= self.GROWTH_INTERVAL:
+                self.size = min(self.maximum, self.size + self._step)
+                self._fast_chunks = 0
+        # A smoothed average, so that one slow acknowledgement doesn't become the new normal.
+        self._round_trip += (elapsed - self._round_trip) / 8
+
+
 class PutBytes(EventSourceMixin):
     """
     Synchronously sends data to the watch over PutBytes.
@@ -29,7 +97,8 @@ class PutBytes(EventSourceMixin):
     :type pebble: .PebbleConnection
     :param object_type: The type of data being sent.
     :type object_type: .PutBytesType
-    :param object: The data to send.
+    :param object: The data to send. This can be a bytes-like object, an :class:`mmap.mmap`, or a file-like object,
+        which is read a chunk at a time as the data is sent.
     :type object: bytes
     :param bank: The bank to install the data to, if applicable.
     :type bank: int
@@ -38,14 +107,63 @@ class PutBytes(EventSourceMixin):
     :param app_install_id: This is used during app installations on 3.x. It is mutually exclusive with ``bank`` and
         ``filename``.
     :type app_install_id: int
+    :param window_size: The number of chunks to send before waiting for the watch to acknowledge the first of them.
+        The default of 1 waits for each chunk to be acknowledged before sending the next. Larger windows are much
+        faster over high-latency connections. If the watch rejects a chunk or stops responding during a windowed
+        transfer, the transfer is aborted and retried without a window. This requires a file-like ``object`` to be
+        seekable.
+    :type window_size: int
+    :param object_size: The number of bytes to send from a file-like ``object``, starting from its current position.
+        If omitted, everything up to the end of the file is sent, which requires the file to be seekable.
+    :type object_size: int
+    :param resume_from: The :attr:`checkpoint` of an earlier attempt to send the same object, which failed part way
+        through (e.g. because the connection dropped). If the watch still recognises that session, the transfer
+        continues from the last acknowledged chunk; otherwise the old session is aborted and the transfer starts from
+        the beginning. A file-like ``object`` should be positioned at the start of the object, as usual.
+    :type resume_from: .PutBytesCheckpoint
+    :param object_crc: The STM32 CRC of the object (see :func:`.stm32_crc.crc32`), if it is already known. If omitted,
+        it is computed as the object is sent.
+    :type object_crc: int
+
+    Chunks are sized so that the transport never has to split them up (see
+    :attr:`~.BaseTransport.preferred_payload_size`), and shrink if the watch is slow to acknowledge them.
     """
-    def __init__(self, pebble, object_type, object, bank=None, filename="", app_install_id=None):
+    #: The maximum time to wait for the watch to acknowledge a chunk, in seconds.
+    ACK_TIMEOUT = 15
+    #: The largest chunk to send.
+    MAX_CHUNK_SIZE = 2000
+    #: The smallest size that chunks will shrink to.
+    MIN_CHUNK_SIZE = 256
+    # Framing (4), command (1), cookie (4) and payload size (4).
+    _PUT_OVERHEAD = 13
+
+    def __init__(self, pebble, object_type, object, bank=None, filename="", app_install_id=None, window_size=1,
+                 object_size=None, resume_from=None, object_crc=None):
         self._pebble = pebble
         self._object_type = object_type
-        self._object = object
+        if hasattr(object, 'read') and not isinstance(object, mmap.mmap):
+            self._object = None
+            self._stream = object
+            self._stream_start = object.tell() if _seekable(object) else None
+            self._stream_offset = 0
+            self._object_size = object_size if object_size is not None else _remaining_size(object)
+        else:
+            self._object = object
+            self._stream = None
+            self._object_size = len(object)
         self._bank = bank
         self._filename = filename
         self._app_install_id = app_install_id
+        self._crc = None
+        self._object_crc = object_crc
+        self._window_size = max(1, window_size)
+        self._reported = 0
+        self._resume_from = resume_from
+        #: The size of the chunks currently being sent.
+        self.chunk_size = None
+        #: A :class:`PutBytesCheckpoint` recording the progress of the transfer so far, or ``None`` if the transfer
+        #: has not started.
+        self.checkpoint = None
         if app_install_id is not None:
             self._object_type |= (1 << 7)
         EventSourceMixin.__init__(self)
@@ -57,49 +175,219 @@ class PutBytes(EventSourceMixin):
         During transmission, a "progress" event will be periodically emitted with the following signature: ::
 
            (sent_this_interval, sent_so_far, total_object_size)
+
+        A "chunk_size" event is emitted with the size of the chunks being sent when the transfer starts, and again
+        whenever it changes: ::
+
+           (chunk_size,)
         """
-        # Prepare the watch to receive something.
-        cookie = self._prepare()
+        cookie = None
+        if self._resume_from is not None:
+            cookie = self._resume(self._resume_from)
+
+        if cookie is None:
+            # Prepare the watch to receive something.
+            cookie = self._prepare()
 
-        # Send it.
-        self._send_object(cookie)
+            # Send it.
+            try:
+                self._send_object(cookie, self._window_size)
+            except (PutBytesError, TimeoutError) as e:
+                if self._window_size == 1 or not self._can_rewind():
+                    raise
+                # We don't know how much the watch accepted, so start again, one chunk at a time.
+                logger.warning("Windowed PutBytes transfer failed (%s); retrying without a window.", e)
+                self._abort(cookie)
+                self._seek(0)
+                cookie = self._prepare(stale_cookie=cookie)
+                self._send_object(cookie, 1)
 
-        # Commit it.
-        self._commit(cookie)
+            # Commit it.
+            self._commit(cookie)
 
         # Install it.
         self._install(cookie)
 
+    def _resume(self, checkpoint):
+        # Returns the cookie of the resumed session once it's been committed, or None if we have to start again.
+        if (checkpoint.object_type, checkpoint.object_size) != (self._object_type, self._object_size):
+            raise PutBytesError("The checkpoint is for a different object.")
+        if checkpoint.crc_state is None and self._object_crc is None:
+            raise PutBytesError("The checkpoint has no CRC state, so object_crc must be given.")
+        self._reported = checkpoint.offset
+        try:
+            self._seek(checkpoint.offset)
+            self._send_object(checkpoint.cookie, self._window_size, checkpoint)
+            self._commit(checkpoint.cookie)
+        except PutBytesError as e:
+            if not self._can_rewind():
+                raise
+            logger.info("Couldn't resume PutBytes session %s (%s); starting again.", checkpoint.cookie, e)
+            self._abort(checkpoint.cookie)
+            self._seek(0)
+            return None
+        return checkpoint.cookie
+
+    def _can_rewind(self):
+        return self._stream is None or self._stream_start is not None
+
+    def _seek(self, offset):
+        if self._stream is None:
+            return
+        if self._stream_start is not None:
+            self._stream.seek(self._stream_start + offset)
+            self._stream_offset = offset
+        elif offset >= self._stream_offset:
+            self._read_chunk(self._stream_offset, offset - self._stream_offset)
+        else:
+            raise PutBytesError("Can't rewind a stream that isn't seekable.")
+
     def _assert_success(self, result):
         if result.result == transfers.PutBytesResponse.Result.NACK:
             raise PutBytesError("Watch NACKed PutBytes request.")
 
-    def _prepare(self):
+    def _prepare(self, stale_cookie=None):
+        # Acknowledgements for chunks of an abandoned session can still arrive after it's been aborted. They carry
+        # that session's cookie, so skip them rather than mistaking one for the response to this request.
         if self._app_install_id is not None:
             packet = transfers.PutBytesApp(data=transfers.PutBytesAppInit(
-                object_size=len(self._object), object_type=self._object_type, app_id=self._app_install_id))
+                object_size=self._object_size, object_type=self._object_type, app_id=self._app_install_id))
         else:
             packet = transfers.PutBytes(data=transfers.PutBytesInit(
-                object_size=len(self._object), object_type=self._object_type, bank=self._bank, filename=self._filename))
-        result = self._pebble.send_and_read(packet, transfers.PutBytesResponse)
+                object_size=self._object_size, object_type=self._object_type, bank=self._bank, filename=self._filename))
+        responses = self._pebble.get_endpoint_queue(transfers.PutBytesResponse)
+        try:
+            self._pebble.send_packet(packet)
+            result = responses.get(timeout=self.ACK_TIMEOUT)
+            while stale_cookie is not None and result.cookie == stale_cookie:
+                result = responses.get(timeout=self.ACK_TIMEOUT)
+        finally:
+            responses.close()
         self._assert_success(result)
         return result.cookie
 
-    def _send_object(self, cookie):
-        sent = 0
-        length = 2000
-        while sent < len(self._object):
-            chunk = self._object[sent:sent+length]
-            packet = transfers.PutBytes(data=transfers.PutBytesPut(cookie=cookie, payload=chunk))
-            self._assert_success(self._pebble.send_and_read(packet, transfers.PutBytesResponse))
-            sent += len(chunk)
-            self._broadcast_event("progress", len(chunk), sent, len(self._object))
+    def _max_chunk_size(self):
+        preferred = self._pebble.transport.preferred_payload_size
+        if preferred is None:
+            return self.MAX_CHUNK_SIZE
+        return max(1, min(self.MAX_CHUNK_SIZE, preferred - self._PUT_OVERHEAD))
+
+    def _set_chunk_size(self, size):
+        if size != self.chunk_size:
+            self.chunk_size = size
+            self._broadcast_event("chunk_size", size)
+
+    def _send_object(self, cookie, window_size, checkpoint=None):
+        if checkpoint is None:
+            crc_state = stm32_crc.Crc32().state if self._object_crc is None else None
+            checkpoint = PutBytesCheckpoint(cookie, 0, crc_state, self._object_type, self._object_size)
+        self.checkpoint = checkpoint
+        sent = checkpoint.offset
+        acked = checkpoint.offset
+        sizer = _ChunkSizer(self._max_chunk_size(), self.MIN_CHUNK_SIZE)
+        self._set_chunk_size(sizer.size)
+        in_flight = deque()
+        last_ack = 0
+        # Unless we already know it, work out the CRC while waiting for the watch to acknowledge each chunk, so it's
+        # ready as soon as the last one has been sent.
+        if self._object_crc is None:
+            self._crc = stm32_crc.Crc32.from_state(checkpoint.crc_state)
+        responses = self._pebble.get_endpoint_queue(transfers.PutBytesResponse)
+        try:
+            while acked < self._object_size:
+                # Fill the window, then wait for the oldest chunk to be acknowledged. The watch acknowledges chunks
+                # in order, so each response is for the oldest chunk still in flight.
+                while sent < self._object_size and len(in_flight) < window_size:
+                    chunk = self._read_chunk(sent, min(self.chunk_size, self._object_size - sent))
+                    packet = transfers.PutBytes(data=transfers.PutBytesPut(cookie=cookie, payload=chunk))
+                    self._pebble.send_packet(packet)
+                    if self._crc is not None:
+                        self._crc.update(chunk)
+                    in_flight.append((len(chunk), time.time(), self._crc.state if self._crc is not None else None))
+                    sent += len(chunk)
+                response = responses.get(timeout=self.ACK_TIMEOUT)
+                chunk_length, sent_at, crc_state = in_flight.popleft()
+                # The watch can't have started on this chunk before it finished with the last one, so time it from
+                # whichever happened later.
+                now = time.time()
+                sizer.record(now - max(sent_at, last_ack))
+                last_ack = now
+                self._set_chunk_size(sizer.size)
+                if response.result == transfers.PutBytesResponse.Result.NACK:
+                    # Collect the responses to anything else we sent, so they aren't mistaken for responses to
+                    # whatever we send next.
+                    self._discard_responses(responses, len(in_flight))
+                self._assert_success(response)
+                acked += chunk_length
+                self.checkpoint = PutBytesCheckpoint(cookie, acked, crc_state, self._object_type, self._object_size)
+                self._report_progress(acked)
+        finally:
+            responses.close()
+
+    def _read_chunk(self, offset, length):
+        if self._stream is None:
+            chunk = self._object[offset:offset+length]
+            # Slices of bytearrays and memoryviews aren't bytes, but packets need them to be.
+            if isinstance(chunk, memoryview):
+                return chunk.tobytes()
+            return chunk if isinstance(chunk, bytes) else bytes(chunk)
+        chunk = self._stream.read(length)
+        # Streams are permitted to return less than we asked for.
+        while len(chunk) < length:
+            more = self._stream.read(length - len(chunk))
+            if not more:
+                raise PutBytesError("Object ended after {} of {} bytes.".format(offset + len(chunk),
+                                                                               self._object_size))
+            chunk += more
+        self._stream_offset = offset + length
+        return chunk
+
+    def _discard_responses(self, responses, count):
+        try:
+            for i in range(count):
+                responses.get(timeout=self.ACK_TIMEOUT)
+        except TimeoutError:
+            pass
+
+    def _report_progress(self, acked):
+        # If a transfer is retried, don't report the same bytes twice.
+        if acked > self._reported:
+            self._broadcast_event("progress", acked - self._reported, acked, self._object_size)
+            self._reported = acked
+
+    def _abort(self, cookie):
+        packet = transfers.PutBytes(data=transfers.PutBytesAbort(cookie=cookie))
+        try:
+            self._pebble.send_and_read(packet, transfers.PutBytesResponse, timeout=self.ACK_TIMEOUT)
+        except TimeoutError:
+            pass
 
     def _commit(self, cookie):
-        crc = stm32_crc.crc32(self._object)
+        crc = self._object_crc if self._object_crc is not None else self._crc.value
         packet = transfers.PutBytes(data=transfers.PutBytesCommit(cookie=cookie, object_crc=crc))
         self._assert_success(self._pebble.send_and_read(packet, transfers.PutBytesResponse))
 
     def _install(self, cookie):
         packet = transfers.PutBytes(data=transfers.PutBytesInstall(cookie=cookie))
         self._assert_success(self._pebble.send_and_read(packet, transfers.PutBytesResponse))
+
+
+def _seekable(stream):
+    try:
+        return stream.seekable()
+    except AttributeError:
+        # Python 2 files don't say, so try it and see.
+        try:
+            stream.tell()
+        except (IOError, OSError):
+            return False
+        return True
+
+
+def _remaining_size(stream):
+    start = stream.tell()
+    end = stream.seek(0, os.SEEK_END)
+    if end is None:
+        end = stream.tell()
+    stream.seek(start)
+    return end - start
@@ -41,13 +41,13 @@ class Screenshot(EventSourceMixin):
         if header.response_code != ScreenshotHeader.ResponseCode.OK:
             queue.close()
             raise ScreenshotError("Screenshot failed: {!s}".format(header.response_code))
-        data = header.data
+        data = bytearray(header.data)
         expected_size = self._get_expected_bytes(header)
         while len(data) < expected_size:
-            data += queue.get().data
+            data.extend(queue.get().data)
             self._broadcast_event("progress", len(data), expected_size)
         queue.close()
-        return self._decode_image(header, data)
+        return self._decode_image(header, bytes(data))
 
     @classmethod
     def _get_expected_bytes(cls, header):
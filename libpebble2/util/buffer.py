@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import struct
+
+__all__ = ["ReceiveBuffer"]
+
+
+class ReceiveBuffer(object):
+    """
+    Accumulates bytes received from a stream and hands them back out as complete messages, without shifting the
+    remainder of the buffer each time a message is removed from the front.
+
+    Incoming data is appended to a single :class:`bytearray`, and a read cursor tracks how much of it has been
+    consumed. Consumed space is reclaimed in bulk once it makes up at least half of the buffer, so the total cost of
+    reassembling a stream is linear in its length however it is split.
+
+    :param compact_threshold: The minimum number of consumed bytes before space is reclaimed.
+    :type compact_threshold: int
+    """
+    def __init__(self, compact_threshold=4096):
+        self._buffer = bytearray()
+        self._start = 0
+        self._compact_threshold = compact_threshold
+
+    def __len__(self):
+        return len(self._buffer) - self._start
+
+    def append(self, data):
+        """
+        Adds received data to the end of the buffer.
+
+        :param data: The data to add.
+        :type data: bytes
+        """
+        self._buffer.extend(data)
+
+    def unpack_from(self, fmt, offset=0):
+        """
+        Unpacks a value from the unread data without consuming it, like :func:`struct.unpack_from`.
+
+        :param fmt: Either a format string or a :class:`struct.Struct`.
+        :param offset: The offset from the read cursor.
+        :type offset: int
+        :return: The unpacked values.
+        :rtype: tuple
+        """
+        if isinstance(fmt, struct.Struct):
+            return fmt.unpack_from(self._buffer, self._start + offset)
+        return struct.unpack_from(fmt, self._buffer, self._start + offset)
+
+    def peek(self, length=None):
+        """
+        Returns up to ``length`` bytes of unread data without consuming them.
+
+        :param length: The number of bytes to return. If omitted, everything unread is returned.
+        :type length: int
+        :rtype: bytes
+        """
+        end = len(self._buffer) if length is None else self._start + length
+        return bytes(self._buffer[self._start:end])
+
+    def read(self, length):
+        """
+        Consumes and returns ``length`` bytes of unread data, or fewer if that much is not available.
+
+        :param length: The number of bytes to read.
+        :type length: int
+        :rtype: bytes
+        """
+        result = self.peek(length)
+        self.skip(len(result))
+        return result
+
+    def skip(self, length):
+        """
+        Consumes ``length`` bytes of unread data without returning them.
+
+        :param length: The number of bytes to skip.
+        :type length: int
+        """
+        self._start = min(self._start + length, len(self._buffer))
+        if self._start == len(self._buffer):
+            del self._buffer[:]
+            self._start = 0
+        elif self._start >= self._compact_threshold and self._start * 2 >= len(self._buffer):
+            del self._buffer[:self._start]
+            self._start = 0
+
+    def clear(self):
+        """
+        Discards all unread data.
+        """
+        del self._buffer[:]
+        self._start = 0
@@ -1,15 +1,156 @@
 from __future__ import absolute_import
 __author__ = 'katharine'
 
+from collections import OrderedDict, namedtuple
+import copy
+import hashlib
 import json
+import multiprocessing
 import os
 import struct
+import tempfile
+import threading
 import uuid
 import zipfile
 
+from six import string_types
+
 from .hardware import PebbleHardware
+from . import stm32_crc
+
+__all__ = ["PebbleBundle", "BundleCache", "BundleRecord", "scan_bundles", "write_bundle_index"]
+
+
+class BundleCache(object):
+    """
+    Remembers the expensive-to-compute parts of bundles: their parsed manifests and app metadata, and their decompressed
+    contents and CRCs. Entries are keyed by a hash of the bundle's contents and the hardware platform it was opened
+    for, so a bundle that changes on disk is never confused with the old version. Pass the same cache to every
+    :class:`PebbleBundle` (or :class:`.AppInstaller`) that should share it. ::
+
+        cache = BundleCache(path=os.path.expanduser("~/.cache/libpebble2/bundles"))
+        for pebble in pebbles:
+            AppInstaller(pebble, "app.pbw", bundle_cache=cache).install()
+
+    Entries are kept in memory until they exceed ``max_bytes`` in total, at which point the least recently used are
+    evicted. If ``path`` is given, entries are also written to that directory, and read back from it when they are not
+    in memory, so they survive between processes. Nothing is ever removed from the directory; it is safe to delete it
+    at any time.
+
+    :param max_bytes: The number of bytes of entries to keep in memory.
+    :type max_bytes: int
+    :param path: A directory in which to persist entries, if any. It is created if necessary.
+    :type path: str
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def key_for(bundle_path, hardware=PebbleHardware.UNKNOWN):
+        """
+        Returns the key under which entries for a bundle are stored.
+
+        :param bundle_path: The path to the bundle.
+        :type bundle_path: str
+        :param hardware: The hardware the bundle is being opened for.
+        :type hardware: int
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        with open(bundle_path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                digest.update(block)
+        return "{}-{}".format(digest.hexdigest(), PebbleHardware.hardware_platform(hardware))
 
-__all__ = ["PebbleBundle"]
+    @property
+    def size(self):
+        """
+        The number of bytes of entries currently held in memory.
+
+        :rtype: int
+        """
+        return self._size
+
+    def get(self, key, name):
+        """
+        Returns a cached value, or ``None`` if it isn't cached.
+
+        :param key: The key of the bundle, from :meth:`key_for`.
+        :type key: str
+        :param name: The name of the value.
+        :type name: str
+        :rtype: bytes
+        """
+        with self._lock:
+            value = self._entries.pop((key, name), None)
+            if value is not None:
+                self._entries[(key, name)] = value
+                return value
+        if self.path is None:
+            return None
+        try:
+            with open(self._file_for(key, name), 'rb') as f:
+                value = f.read()
+        except (IOError, OSError):
+            return None
+        self._remember(key, name, value)
+        return value
+
+    def put(self, key, name, value):
+        """
+        Caches a value.
+
+        :param key: The key of the bundle, from :meth:`key_for`.
+        :type key: str
+        :param name: The name of the value.
+        :type name: str
+        :param value: The value to cache.
+        :type value: bytes
+        """
+        self._remember(key, name, value)
+        if self.path is not None:
+            self._persist(key, name, value)
+
+    def _remember(self, key, name, value):
+        with self._lock:
+            old = self._entries.pop((key, name), None)
+            if old is not None:
+                self._size -= len(old)
+            if len(value) > self.max_bytes:
+                return
+            self._entries[(key, name)] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _file_for(self, key, name):
+        return os.path.join(self.path, key, hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+    def _persist(self, key, name, value):
+        directory = os.path.join(self.path, key)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Someone else probably got there first.
+                if not os.path.isdir(directory):
+                    raise
+        # Write somewhere else first, so that nobody ever reads a partially written file.
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.rename(temp_path, self._file_for(key, name))
+        except OSError:
+            # Most likely someone else wrote the same thing first (os.rename won't replace files on Windows).
+            os.remove(temp_path)
 
 
 class PebbleBundle(object):
@@ -49,7 +190,7 @@ class PebbleBundle(object):
         'emery': {'basalt/': 0x54, '': 0x16},
     }
 
-    def __init__(self, bundle_path, hardware=PebbleHardware.UNKNOWN):
+    def __init__(self, bundle_path, hardware=PebbleHardware.UNKNOWN, cache=None):
         self.hardware = hardware
         bundle_abs_path = os.path.abspath(bundle_path)
         if not os.path.exists(bundle_abs_path):
@@ -60,12 +201,49 @@ class PebbleBundle(object):
         self.manifest = None
         self.header = None
         self._zip_contents = set(self.zip.namelist())
+        # ZipFile isn't safe to read from several threads at once, and bundles may be shared between installers.
+        self._zip_lock = threading.Lock()
 
         self.app_metadata_struct = struct.Struct(''.join(self.STRUCT_DEFINITION))
         self.app_metadata_length_bytes = self.app_metadata_struct.size
 
         self.print_pbl_logs = False
 
+        self._cache = cache
+        self._cache_key = cache.key_for(bundle_abs_path, hardware) if cache is not None else None
+
+    @property
+    def cache(self):
+        """
+        The :class:`BundleCache` in use, if any.
+        """
+        return self._cache
+
+    def for_hardware(self, hardware):
+        """
+        Returns a view of the same bundle for different hardware, which shares this bundle's open zip (and so should
+        not be closed separately) but otherwise reads its manifest and metadata afresh.
+
+        :param hardware: The hardware to read the bundle for.
+        :type hardware: int
+        :rtype: PebbleBundle
+        """
+        bundle = copy.copy(self)
+        bundle.hardware = hardware
+        bundle.manifest = None
+        bundle.header = None
+        bundle._cache_key = self._cache.key_for(self.path, hardware) if self._cache is not None else None
+        return bundle
+
+    def _cached(self, name, compute):
+        if self._cache is None:
+            return compute()
+        value = self._cache.get(self._cache_key, name)
+        if value is None:
+            value = compute()
+            self._cache.put(self._cache_key, name, value)
+        return value
+
     @classmethod
     def prefixes_for_hardware(cls, hardware):
         platform = PebbleHardware.hardware_platform(hardware)
@@ -107,10 +285,11 @@ class PebbleBundle(object):
         if self.manifest:
             return self.manifest
 
-        if self.get_real_path(self.MANIFEST_FILENAME) not in self.zip.namelist():
+        if self.get_real_path(self.MANIFEST_FILENAME) not in self._zip_contents:
             raise Exception("Could not find {}; are you sure this is a PebbleBundle?".format(self.MANIFEST_FILENAME))
 
-        self.manifest = json.loads(self.zip.read(self.get_real_path(self.MANIFEST_FILENAME)).decode('utf-8'))
+        manifest = self._cached('manifest', lambda: self._read(self.get_real_path(self.MANIFEST_FILENAME)))
+        self.manifest = json.loads(manifest.decode('utf-8'))
         return self.manifest
 
     def get_app_metadata(self):
@@ -119,9 +298,12 @@ class PebbleBundle(object):
 
         app_manifest = self.get_manifest()['application']
 
-        app_bin = self.zip.open(self.get_real_path(app_manifest['name'])).read()
+        def read_header():
+            # Only decompress as much as we need.
+            with self._zip_lock, self.zip.open(self.get_real_path(app_manifest['name'])) as app_bin:
+                return app_bin.read(self.app_metadata_length_bytes)
 
-        header = app_bin[0:self.app_metadata_length_bytes]
+        header = self._cached('header', read_header)
         values = self.app_metadata_struct.unpack(header)
         self.header = {
             'sentinel': values[0],
@@ -144,6 +326,23 @@ class PebbleBundle(object):
         }
         return self.header
 
+    def get_part(self, path):
+        """
+        Returns the decompressed contents of a file in the bundle, along with its STM32 CRC.
+
+        :param path: The path of the file within the bundle, e.g. from :meth:`get_app_path`.
+        :type path: str
+        :return: ``(data, crc)``
+        :rtype: (bytes, int)
+        """
+        data = self._cached('data:' + path, lambda: self._read(path))
+        crc, = struct.unpack('<I', self._cached('crc:' + path, lambda: struct.pack('<I', stm32_crc.crc32(data))))
+        return data, crc
+
+    def _read(self, path):
+        with self._zip_lock:
+            return self.zip.read(path)
+
     def close(self):
         self.zip.close()
 
@@ -199,3 +398,143 @@ class PebbleBundle(object):
 
     def get_worker_path(self):
         return self.get_real_path(self.get_worker_info()['name'])
+
+
+class BundleRecord(namedtuple('BundleRecord', ('path', 'platform', 'prefix', 'uuid', 'app_name', 'company_name',
+                                               'sdk_version_major', 'sdk_version_minor', 'app_version_major',
+                                               'app_version_minor', 'app_size', 'crc', 'permitted', 'error'))):
+    """
+    Describes the build of an app bundle that one platform would install, as produced by :func:`scan_bundles`.
+
+    ``prefix`` is the directory within the bundle that the platform's build was found in (``''`` for bundles predating
+    multiple platforms). Platforms that fall back on another platform's build, such as diorite running an aplite
+    build, report that build's prefix. ``permitted`` is the result of :meth:`PebbleBundle.should_permit_install` for
+    the platform. ``uuid``, ``crc`` and the other metadata come from the app's header.
+
+    If the bundle has no build that the platform can use, ``prefix`` and the metadata are ``None``, and ``permitted``
+    is ``False``.
+
+    If the bundle couldn't be read at all, there is a single record for it, with ``platform`` set to ``None`` and
+    ``error`` describing the problem. Otherwise ``error`` is ``None``.
+    """
+    __slots__ = ()
+
+
+def _platform_hardware():
+    # One hardware revision per platform is enough, since bundles only care about the platform.
+    platforms = OrderedDict()
+    for hardware in sorted(PebbleHardware.PLATFORMS):
+        if hardware != PebbleHardware.UNKNOWN:
+            platforms.setdefault(PebbleHardware.PLATFORMS[hardware], hardware)
+    return platforms
+
+
+_PLATFORM_HARDWARE = _platform_hardware()
+
+
+def _index_bundle(path):
+    try:
+        bundle = PebbleBundle(path)
+    except Exception as e:
+        return [BundleRecord(path, None, None, None, None, None, None, None, None, None, None, None, None, str(e))]
+    records = []
+    builds = {}
+    try:
+        for platform, hardware in _PLATFORM_HARDWARE.items():
+            # The same zip will do for every platform.
+            platform_bundle = bundle.for_hardware(hardware)
+            prefix = platform_bundle._get_real_prefix()
+            if prefix is None:
+                records.append(BundleRecord(path, platform, None, None, None, None, None, None, None, None, None,
+                                            None, False, None))
+                continue
+            if prefix in builds:
+                # Platforms sharing a build share its manifest and header too, so each is only read once.
+                platform_bundle.manifest, platform_bundle.header = builds[prefix]
+            elif not platform_bundle.is_app_bundle:
+                return []
+            else:
+                platform_bundle.get_app_metadata()
+                builds[prefix] = (platform_bundle.manifest, platform_bundle.header)
+            metadata = platform_bundle.header
+            records.append(BundleRecord(path, platform, prefix, str(metadata['uuid']), metadata['app_name'],
+                                        metadata['company_name'], metadata['sdk_version_major'],
+                                        metadata['sdk_version_minor'], metadata['app_version_major'],
+                                        metadata['app_version_minor'], metadata['app_size'], metadata['crc'],
+                                        platform_bundle.should_permit_install(), None))
+    except Exception as e:
+        return [BundleRecord(path, None, None, None, None, None, None, None, None, None, None, None, None, str(e))]
+    finally:
+        bundle.close()
+    # A zip without a manifest for any platform isn't a bundle at all.
+    return records if builds else []
+
+
+def scan_bundles(paths, processes=None, chunksize=16):
+    """
+    Reads the metadata of the build each platform would install from many app bundles, using several processes. Only
+    the manifests and app headers are decompressed, once per build. Records are yielded as soon as they are ready, so bundles are not necessarily
+    reported in the order given, but every record for a given bundle is yielded together. ::
+
+        for record in scan_bundles("/srv/appstore/pbws"):
+            print(record.path, record.platform, record.uuid, record.permitted)
+
+    Firmware bundles and anything else that isn't an app bundle produce no records.
+
+    :param paths: Either the path to a directory, which is searched recursively for ``.pbw`` files, or an iterable of
+                  paths to bundles.
+    :type paths: str | list[str]
+    :param processes: The number of processes to use. Defaults to the number of CPUs. If 1, everything happens in
+                      this process.
+    :type processes: int
+    :param chunksize: The number of bundles to hand to a process at a time.
+    :type chunksize: int
+    :return: An iterator of records.
+    :rtype: collections.Iterator[BundleRecord]
+    """
+    if isinstance(paths, string_types):
+        paths = _find_bundles(paths)
+    if processes == 1:
+        for path in paths:
+            for record in _index_bundle(path):
+                yield record
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for records in pool.imap_unordered(_index_bundle, paths, chunksize):
+            for record in records:
+                yield record
+    finally:
+        pool.terminate()
+
+
+def _find_bundles(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.endswith('.pbw'):
+                yield os.path.join(root, filename)
+
+
+def write_bundle_index(records, f):
+    """
+    Writes records to a file as JSON, one array per field rather than one object per record, which is much more
+    compact and can be loaded straight into most data analysis tools. ::
+
+        with open("index.json", "w") as f:
+            write_bundle_index(scan_bundles("/srv/appstore/pbws"), f)
+
+    :param records: The records to write, e.g. from :func:`scan_bundles`.
+    :type records: collections.Iterable[BundleRecord]
+    :param f: A file open for writing text.
+    :return: The number of records written.
+    :rtype: int
+    """
+    columns = OrderedDict((field, []) for field in BundleRecord._fields)
+    count = 0
+    for record in records:
+        for field, value in zip(BundleRecord._fields, record):
+            columns[field].append(value)
+        count += 1
+    json.dump(columns, f, separators=(',', ':'))
+    return count
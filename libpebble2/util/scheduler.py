@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+__all__ = ["Scheduler", "Timer"]
+
+logger = logging.getLogger("libpebble2.util.scheduler")
+
+# Wall clock changes shouldn't make timers fire early or late.
+_now = getattr(time, 'monotonic', time.time)
+
+
+class Timer(object):
+    """
+    A callback scheduled by :meth:`Scheduler.call_later`.
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Prevents the callback from being called, if it hasn't been already. This is cheap, and safe to call from
+        anywhere, including while holding locks that the callback takes.
+        """
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Calls functions after a delay, on a single background thread. Pending calls are kept in a heap ordered by
+    deadline, so scheduling and firing each cost O(log n), and the thread sleeps until exactly when the next call is
+    due. Cancelled calls are discarded when they reach the front of the heap.
+
+    Callbacks are called without holding any of the scheduler's locks, so they may schedule or cancel other calls.
+    They should return quickly, because no other callback can run until they do.
+
+    Most code should use the scheduler shared by the whole process, from :meth:`shared`.
+
+    :param name: The name of the scheduler's thread.
+    :type name: str
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, name="Scheduler"):
+        self.name = name
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the scheduler shared by the whole process, creating it if necessary.
+
+        :rtype: Scheduler
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def call_later(self, delay, callback, *args):
+        """
+        Calls ``callback(*args)`` after ``delay`` seconds.
+
+        :param delay: The delay, in seconds.
+        :type delay: float
+        :param callback: The function to call.
+        :return: A timer that can be used to cancel the call.
+        :rtype: Timer
+        """
+        timer = Timer(_now() + delay, callback, args)
+        with self._condition:
+            heapq.heappush(self._heap, (timer.deadline, next(self._counter), timer))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.name = self.name
+                self._thread.start()
+            elif self._heap[0][2] is timer:
+                # The thread is waiting for something later than this, so wake it up to wait for this instead.
+                self._condition.notify()
+        return timer
+
+    def __len__(self):
+        """
+        The number of calls that are waiting to be made, including cancelled calls that have not yet been discarded.
+        """
+        return len(self._heap)
+
+    def _next_timer(self):
+        with self._condition:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                wait = self._heap[0][0] - _now()
+                if wait <= 0:
+                    return heapq.heappop(self._heap)[2]
+                self._condition.wait(wait)
+
+    def _run(self):
+        while True:
+            timer = self._next_timer()
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Scheduled call to %s failed.", timer.callback)
@@ -1,43 +1,230 @@
 from __future__ import division
 
-from six.moves import range
+from six.moves import range, zip
 
-import array
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ["crc32", "process_buffer", "process_word", "Crc32"]
 
 CRC_POLY = 0x04C11DB7
 
+#: Buffers of at least this many bytes have their CRC computed by NumPy, if it is available.
+NUMPY_THRESHOLD = 65536
 
-def process_word(data, crc=0xffffffff):
-    if len(data) < 4:
-        d_array = array.array('B', data)
-        for x in range(0, 4 - len(data)):
-            d_array.insert(0, 0)
-        d_array.reverse()
-        data = d_array.tostring()
+# The STM32 CRC unit consumes one little-endian word at a time: it XORs the word into the CRC, then shifts the CRC left
+# 32 times, XORing in the polynomial whenever a set bit falls off the top. Those 32 shifts are linear, so instead of
+# performing them one by one we can look up what they do to each byte of the CRC and XOR the results together.
+# _word_tables[k][i] is the result of the 32 shifts applied to i << (8 * k).
+# _double_word_tables[k][i] is the same for 64 shifts, which lets us consume two words at once (i.e. slice-by-8).
 
-    d = array.array('I', data)[0]
-    crc = crc ^ d
 
-    for i in range(0, 32):
+def _shift(crc, count):
+    for i in range(count):
         if (crc & 0x80000000) != 0:
             crc = (crc << 1) ^ CRC_POLY
         else:
             crc = (crc << 1)
+        crc &= 0xffffffff
+    return crc
+
+
+def _make_tables(shifts):
+    byte_table = [_shift(i << 24, 8) for i in range(256)]
+    tables = [byte_table]
+    for k in range(1, shifts // 8):
+        previous = tables[-1]
+        tables.append([((x << 8) & 0xffffffff) ^ byte_table[x >> 24] for x in previous])
+    # tables[n] now covers 8 * (n + 1) shifts of a value in the top byte; we want the tables for each byte position
+    # after exactly ``shifts`` shifts.
+    return [tables[shifts // 8 - 4 + k] for k in range(4)]
+
+
+_word_tables = _make_tables(32)
+_double_word_tables = _make_tables(64)
+
+
+def _process_words(words, crc):
+    t0, t1, t2, t3 = _word_tables
+    d0, d1, d2, d3 = _double_word_tables
+    iterator = iter(words)
+    for first, second in zip(iterator, iterator):
+        crc ^= first
+        crc = (d3[crc >> 24] ^ d2[(crc >> 16) & 0xff] ^ d1[(crc >> 8) & 0xff] ^ d0[crc & 0xff] ^
+               t3[second >> 24] ^ t2[(second >> 16) & 0xff] ^ t1[(second >> 8) & 0xff] ^ t0[second & 0xff])
+    if len(words) % 2:
+        crc ^= words[-1]
+        crc = t3[crc >> 24] ^ t2[(crc >> 16) & 0xff] ^ t1[(crc >> 8) & 0xff] ^ t0[crc & 0xff]
+    return crc
+
+
+def _unpack_words(buf, count):
+    return struct.unpack_from('<{}I'.format(count), buf, 0)
+
+
+# When NumPy is available, large buffers are split into blocks of _BLOCK_WORDS words. The CRC of every block
+# (starting from zero) is computed simultaneously, and since the CRC is linear, the results can then be combined:
+# the CRC after a block is the CRC before it advanced by the block's length, XORed with the block's own CRC.
+_BLOCK_WORDS = 256
+_numpy_tables = None
+
 
-    result = crc & 0xffffffff
-    return result
+def _get_numpy_tables():
+    global _numpy_tables
+    if _numpy_tables is None:
+        word_tables = numpy.array(_word_tables, dtype=numpy.uint32)
+        # Work out what advancing by a whole block does to each byte of the CRC.
+        advance = numpy.array([[i << (8 * k) for i in range(256)] for k in range(4)], dtype=numpy.uint32).ravel()
+        for i in range(_BLOCK_WORDS):
+            advance = _numpy_word_step(word_tables, advance)
+        _numpy_tables = (word_tables, [[int(x) for x in row] for row in advance.reshape(4, 256)])
+    return _numpy_tables
+
+
+def _numpy_word_step(tables, crc):
+    return (tables[3][crc >> 24] ^ tables[2][(crc >> 16) & 0xff] ^
+            tables[1][(crc >> 8) & 0xff] ^ tables[0][crc & 0xff])
+
+
+def _process_words_numpy(buf, word_count, crc):
+    word_tables, advance = _get_numpy_tables()
+    block_count = word_count // _BLOCK_WORDS
+    words = numpy.frombuffer(buf, dtype='<u4', count=block_count * _BLOCK_WORDS).astype(numpy.uint32)
+    blocks = words.reshape(block_count, _BLOCK_WORDS)
+    block_crcs = numpy.zeros(block_count, dtype=numpy.uint32)
+    for i in range(_BLOCK_WORDS):
+        block_crcs = _numpy_word_step(word_tables, block_crcs ^ blocks[:, i])
+    a0, a1, a2, a3 = advance
+    for block_crc in block_crcs.tolist():
+        crc = a3[crc >> 24] ^ a2[(crc >> 16) & 0xff] ^ a1[(crc >> 8) & 0xff] ^ a0[crc & 0xff] ^ block_crc
+    remaining = word_count - block_count * _BLOCK_WORDS
+    if remaining:
+        rest = struct.unpack_from('<{}I'.format(remaining), buf, block_count * _BLOCK_WORDS * 4)
+        crc = _process_words(rest, crc)
+    return crc
+
+
+def process_word(data, crc=0xffffffff):
+    """
+    Adds a single word to a CRC. If ``data`` is shorter than a word, it is padded in the same way as the STM32 firmware
+    pads the final partial word of a buffer.
+
+    :param data: Up to four bytes.
+    :type data: bytes
+    :param crc: The CRC so far.
+    :type crc: int
+    :return: The updated CRC.
+    :rtype: int
+    """
+    data = bytearray(data)
+    if len(data) < 4:
+        data = bytearray(reversed(data)) + bytearray(4 - len(data))
+    return _process_words(_unpack_words(data, 1), crc)
 
 
 def process_buffer(buf, c=0xffffffff):
-    word_count = len(buf) // 4
-    if len(buf) % 4 != 0:
-        word_count += 1
+    """
+    Adds a buffer to a CRC.
 
+    :param buf: The data to add.
+    :type buf: bytes
+    :param c: The CRC so far.
+    :type c: int
+    :return: The updated CRC.
+    :rtype: int
+    """
+    word_count = len(buf) // 4
     crc = c
-    for i in range(0, word_count):
-        crc = process_word(buf[i * 4:(i + 1) * 4], crc)
+    if numpy is not None and len(buf) >= NUMPY_THRESHOLD:
+        crc = _process_words_numpy(buf, word_count, crc)
+    elif word_count:
+        crc = _process_words(_unpack_words(buf, word_count), crc)
+    if len(buf) % 4 != 0:
+        crc = process_word(buf[word_count * 4:], crc)
     return crc
 
 
 def crc32(data):
+    """
+    Computes the CRC of ``data`` the same way the STM32 CRC unit does.
+
+    :param data: The data to checksum.
+    :type data: bytes
+    :return: The CRC.
+    :rtype: int
+    """
     return process_buffer(data)
+
+
+class Crc32(object):
+    """
+    Computes a CRC incrementally, for when the data is not all available at once. The result is the same as calling
+    :func:`crc32` on all the data passed to :meth:`update`, in order.
+
+    :param data: Initial data to add, if any.
+    :type data: bytes
+    """
+    def __init__(self, data=b''):
+        self._crc = 0xffffffff
+        self._pending = bytearray()
+        self.update(data)
+
+    def update(self, data):
+        """
+        Adds more data to the CRC.
+
+        :param data: The data to add.
+        :type data: bytes
+        """
+        if self._pending:
+            # Top up any partial word left over from last time before carrying on.
+            needed = 4 - len(self._pending)
+            self._pending += data[:needed]
+            data = data[needed:]
+            if len(self._pending) < 4:
+                return
+            self._crc = process_buffer(self._pending, self._crc)
+            self._pending = bytearray()
+        whole = len(data) - len(data) % 4
+        if whole:
+            self._crc = process_buffer(memoryview(data)[:whole], self._crc)
+        self._pending = bytearray(data[whole:])
+
+    @property
+    def state(self):
+        """
+        A snapshot of the CRC computation so far, which can later be passed to :meth:`from_state` to carry on from the
+        same point.
+
+        :rtype: (int, bytes)
+        """
+        return self._crc, bytes(self._pending)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Resumes a CRC computation from a snapshot previously taken from :attr:`state`.
+
+        :param state: The snapshot.
+        :return: A new :class:`Crc32` in the same state as the one the snapshot was taken from.
+        :rtype: Crc32
+        """
+        crc = cls()
+        crc._crc, pending = state
+        crc._pending = bytearray(pending)
+        return crc
+
+    @property
+    def value(self):
+        """
+        The CRC of all the data added so far.
+
+        :rtype: int
+        """
+        if self._pending:
+            return process_word(self._pending, self._crc)
+        return self._crc
@@ -34,6 +34,7 @@ requires = [
 
 if sys.version_info < (3, 4, 0):
     requires.append('enum34>=1.0.4')
+    requires.append('selectors34>=1.1')
 
 setup(name='libpebble2',
       version=__version__,
@@ -47,6 +48,7 @@ setup(name='libpebble2',
       install_requires=requires,
       extras_require={
         'pulse': ['pebble.pulse2>=0.0.5'],
+        'asyncio': ['websockets>=4.0'],
       },
       tests_require=[
         'pytest',
@@ -0,0 +1,35 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import json
+import struct
+import uuid
+import zipfile
+
+from libpebble2.util.bundle import PebbleBundle
+
+APP_UUID = uuid.UUID('0f71aa5d-7a08-4dae-a4bd-2c2b1d7e2b43')
+
+
+def make_app_binary(name=b'Test App', sdk_version=(5, 0x48), size=4096):
+    header = struct.pack(''.join(PebbleBundle.STRUCT_DEFINITION), b'PBLAPP\0\0', 16, 0, sdk_version[0],
+                         sdk_version[1], 1, 2, size, 0, 0, name, b'Pebble', 1, 0, 0, 0, APP_UUID.bytes)
+    return header + bytes(bytearray(i % 251 for i in range(size - len(header))))
+
+
+def make_pbw(path, platforms=('basalt',), worker=False):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('appinfo.json', json.dumps({'uuid': str(APP_UUID)}))
+        for platform in platforms:
+            prefix = platform + '/' if platform else ''
+            manifest = {
+                'application': {'name': 'pebble-app.bin'},
+                'resources': {'name': 'app_resources.pbpack'},
+            }
+            z.writestr(prefix + 'pebble-app.bin', make_app_binary())
+            z.writestr(prefix + 'app_resources.pbpack', b'resources' * 1000)
+            if worker:
+                manifest['worker'] = {'name': 'pebble-worker.bin'}
+                z.writestr(prefix + 'pebble-worker.bin', b'worker' * 100)
+            z.writestr(prefix + 'manifest.json', json.dumps(manifest))
+    return path
@@ -0,0 +1,7 @@
+import sys
+
+collect_ignore = []
+
+# The asyncio tests use syntax and APIs that only exist on Python 3.7 and later.
+if sys.version_info < (3, 7):
+    collect_ignore.append("test_aio.py")
@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import pytest
+import asyncio
+
+from libpebble2.communication.aio import AsyncPebbleConnection
+from libpebble2.communication.transports.qemu import _read_buffered_packet
+from libpebble2.communication.transports.qemu.aio import AsyncQemuTransport
+from libpebble2.communication.transports.qemu.protocol import QemuPacket, QemuSPP
+from libpebble2.events.aio import AsyncEventHandler
+from libpebble2.exceptions import TimeoutError
+from libpebble2.protocol.system import PingPong, Ping, Pong
+from libpebble2.util.buffer import ReceiveBuffer
+
+
+def test_async_event_handler():
+    async def run():
+        events = AsyncEventHandler()
+        waiter = events.wait_for_event("event", timeout=1)
+        queue = events.queue_events("event")
+        events.broadcast_event("event", 1)
+        events.broadcast_event("event", 2)
+        assert await waiter == 1
+        assert [await queue.get(), await queue.get()] == [1, 2]
+        with pytest.raises(TimeoutError):
+            await queue.get(timeout=0.01)
+        queue.close()
+        assert not events.has_handlers("event")
+        with pytest.raises(TimeoutError):
+            await events.wait_for_event("event", timeout=0.01)
+        assert not events.has_handlers("event")
+
+    asyncio.run(run())
+
+
+def test_async_event_wait_not_awaited():
+    async def run():
+        events = AsyncEventHandler()
+        waiter = events.wait_for_event("event", timeout=1)
+        assert events.has_handlers("event")
+        del waiter
+        assert not events.has_handlers("event")
+
+        waiter = events.wait_for_event("event", timeout=1)
+        waiter.cancel()
+        assert not events.has_handlers("event")
+
+    asyncio.run(run())
+
+
+def test_async_qemu_connection():
+    async def handle_client(reader, writer):
+        # Pretend to be a watch that answers pings.
+        buffer = ReceiveBuffer()
+        while True:
+            data = await reader.read(2048)
+            if not data:
+                break
+            buffer.append(data)
+            result = _read_buffered_packet(buffer)
+            while result is not None:
+                target, message = result
+                ping, length = PingPong.parse_message(message)
+                pong = PingPong(cookie=ping.cookie, message=Pong())
+                writer.write(QemuPacket(data=QemuSPP(payload=pong.serialise_packet())).serialise())
+                result = _read_buffered_packet(buffer)
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        transport = AsyncQemuTransport(port=port)
+        pebble = AsyncPebbleConnection(transport)
+        await pebble.connect()
+        assert pebble.connected
+        reader = pebble._spawn(pebble.run_sync())
+
+        for i in range(5):
+            response = await pebble.send_and_read(PingPong(cookie=i, message=Ping(idle=False)), PingPong, timeout=5)
+            assert response.cookie == i
+
+        await transport.close()
+        server.close()
+        await server.wait_closed()
+        await asyncio.wait_for(reader, 5)
+        assert not pebble.connected
+
+    asyncio.run(run())
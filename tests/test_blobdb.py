@@ -0,0 +1,363 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import threading
+import time
+import uuid
+
+from six.moves import queue
+
+import pytest
+
+from libpebble2.exceptions import BlobDBError
+from libpebble2.protocol.blobdb import BlobCommand, BlobResponse, BlobStatus, BlobDatabaseID, DeleteCommand
+from libpebble2.protocol.system import WatchVersionResponse, WatchFirmwareVersion
+from libpebble2.services.blobdb import BlobDBClient, SyncWrapper, BlobDBShadowStore, _TokenAllocator
+from libpebble2.util.scheduler import Scheduler
+
+
+class FakeBlobDBWatch(object):
+    """
+    Pretends to be a watch's BlobDB endpoint, answering each command a short time after it was sent.
+    """
+    def __init__(self, latency=0.01, try_later=0, drop=0):
+        self.latency = latency
+        self.try_later = try_later
+        self.drop = drop
+        self.handler = None
+        self.commands = []
+        self.accepted = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.outbox = queue.Queue()
+        thread = threading.Thread(target=self._respond)
+        thread.daemon = True
+        thread.start()
+
+    def register_endpoint(self, endpoint, handler):
+        self.handler = handler
+        return handler
+
+    def unregister_endpoint(self, handle):
+        if self.handler is handle:
+            self.handler = None
+
+    def send_packet(self, packet):
+        assert isinstance(packet, BlobCommand)
+        self.commands.append(packet)
+        if self.drop:
+            self.drop -= 1
+            return
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.try_later:
+            self.try_later -= 1
+            status = BlobStatus.TryLater
+        else:
+            status = BlobStatus.Success
+            self.accepted.append(packet)
+        self.outbox.put((time.time() + self.latency, BlobResponse(token=packet.token, response=status)))
+
+    def _respond(self):
+        while True:
+            deadline, response = self.outbox.get()
+            time.sleep(max(0, deadline - time.time()))
+            self.in_flight -= 1
+            if self.handler is not None:
+                self.handler(response)
+
+
+def insert_many(client, count):
+    results = []
+    done = threading.Event()
+
+    def callback(status):
+        results.append(status)
+        if len(results) == count:
+            done.set()
+
+    for i in range(count):
+        client.insert(BlobDatabaseID.Notification, uuid.uuid4(), b'value', callback=callback)
+    assert done.wait(5)
+    return results
+
+
+def test_window():
+    watch = FakeBlobDBWatch()
+    client = BlobDBClient(watch, window_size=4)
+    start = time.time()
+    assert insert_many(client, 40) == [BlobStatus.Success] * 40
+    # Without a window, this would take at least 40 * latency.
+    assert time.time() - start < 40 * watch.latency
+    assert 1 < watch.max_in_flight <= 4
+
+
+def test_try_later():
+    watch = FakeBlobDBWatch(try_later=3)
+    client = BlobDBClient(watch, window_size=1)
+    assert SyncWrapper(client.insert, BlobDatabaseID.App, uuid.uuid4(), b'value').wait(5) == BlobStatus.Success
+    assert len(watch.commands) == 4
+    assert len(set(x.token for x in watch.commands)) == 1
+    assert client._backoff < BlobDBClient.MIN_BACKOFF * 4
+
+
+def test_try_later_keeps_order():
+    watch = FakeBlobDBWatch(try_later=1)
+    client = BlobDBClient(watch, window_size=4)
+    key, other = uuid.uuid4(), uuid.uuid4()
+    done = threading.Event()
+    client.insert(BlobDatabaseID.App, key, b'value')
+    client.insert(BlobDatabaseID.App, other, b'other')
+    client.delete(BlobDatabaseID.App, key)
+    client.clear(BlobDatabaseID.App, callback=lambda status: done.set())
+    assert done.wait(5)
+    # The insert had to be resent, but was still accepted before the delete and clear that followed it.
+    accepted = [(type(x.content).__name__, getattr(x.content, 'key', None)) for x in watch.accepted]
+    assert accepted.index(('InsertCommand', key.bytes)) < accepted.index(('DeleteCommand', key.bytes))
+    assert accepted[-1] == ('ClearCommand', None)
+    assert client.known_items(BlobDatabaseID.App) == {}
+
+
+def test_timeout_resends():
+    watch = FakeBlobDBWatch(drop=1)
+    client = BlobDBClient(watch, timeout=0.1)
+    start = time.time()
+    assert SyncWrapper(client.insert, BlobDatabaseID.App, uuid.uuid4(), b'value').wait(5) == BlobStatus.Success
+    assert 0.1 <= time.time() - start < 1
+    assert len(watch.commands) == 2
+
+
+class LockCheckingScheduler(object):
+    """
+    Records whether the client's lock was held by the calling thread whenever a timer was armed or cancelled.
+    """
+    def __init__(self):
+        self.scheduler = Scheduler()
+        self.client = None
+        self.held = []
+
+    def _check(self):
+        # The lock isn't reentrant, so if this thread holds it, it never becomes available.
+        deadline = time.time() + 0.5
+        while not self.client._lock.acquire(False):
+            if time.time() > deadline:
+                self.held.append(True)
+                return
+            time.sleep(0.001)
+        self.client._lock.release()
+        self.held.append(False)
+
+    def call_later(self, delay, callback, *args):
+        self._check()
+        timer = self.scheduler.call_later(delay, callback, *args)
+        cancel = timer.cancel
+        checker = self
+
+        class CheckedTimer(object):
+            def cancel(self):
+                checker._check()
+                cancel()
+        return CheckedTimer()
+
+
+def test_timers_maintained_without_lock():
+    watch = FakeBlobDBWatch(try_later=1, drop=1)
+    scheduler = LockCheckingScheduler()
+    client = BlobDBClient(watch, timeout=0.1, scheduler=scheduler)
+    scheduler.client = client
+    assert SyncWrapper(client.insert, BlobDatabaseID.App, uuid.uuid4(), b'value').wait(5) == BlobStatus.Success
+    # Armed three times (dropped, try later, success), and cancelled by the two responses.
+    assert scheduler.held == [False] * 5
+
+
+def test_token_allocator():
+    tokens = _TokenAllocator()
+    first = [tokens.allocate() for i in range(3)]
+    assert first == [1, 2, 3]
+    tokens.release(2)
+    # Released tokens aren't reused until the counter wraps around.
+    assert tokens.allocate() == 4
+    tokens._next = _TokenAllocator.LAST
+    assert tokens.allocate() == _TokenAllocator.LAST
+    # ...and then tokens still in use are skipped.
+    assert tokens.allocate() == 2
+    assert tokens.allocate() == 5
+    assert len(tokens) == 6
+
+
+def test_token_exhaustion():
+    tokens = _TokenAllocator()
+    for i in range(_TokenAllocator.LAST):
+        tokens.allocate()
+    with pytest.raises(BlobDBError):
+        tokens.allocate()
+    tokens.release(1234)
+    assert tokens.allocate() == 1234
+
+
+def test_stats():
+    watch = FakeBlobDBWatch()
+    client = BlobDBClient(watch)
+    insert_many(client, 10)
+    stats = client.stats
+    assert (stats.queue_depth, stats.in_flight) == (0, 0)
+    assert list(stats.latency) == [BlobDatabaseID.Notification]
+    latency = stats.latency[BlobDatabaseID.Notification]
+    assert latency.responses == 10
+    assert watch.latency <= latency.mean <= latency.max
+    assert len(client._tokens) == 0
+
+
+def test_sync():
+    watch = FakeBlobDBWatch()
+    client = BlobDBClient(watch)
+    keys = [uuid.uuid4() for i in range(5)]
+    items = {key: str(key).encode('utf-8') for key in keys}
+    result = SyncWrapper(client.sync, BlobDatabaseID.Pin, items).wait(5)
+    assert result == {key: BlobStatus.Success for key in keys}
+    assert len(watch.commands) == 5
+    assert set(client.known_items(BlobDatabaseID.Pin)) == set(keys)
+
+    # Nothing changed, so there's nothing to do.
+    assert SyncWrapper(client.sync, BlobDatabaseID.Pin, items).wait(5) == {}
+    assert len(watch.commands) == 5
+
+    # Change one, remove one and add one.
+    del items[keys[0]]
+    items[keys[1]] = b'changed'
+    new_key = uuid.uuid4()
+    items[new_key] = b'new'
+    result = SyncWrapper(client.sync, BlobDatabaseID.Pin, items).wait(5)
+    assert result == {keys[0]: BlobStatus.Success, keys[1]: BlobStatus.Success, new_key: BlobStatus.Success}
+    assert len(watch.commands) == 8
+    assert sum(isinstance(x.content, DeleteCommand) for x in watch.commands) == 1
+    assert set(client.known_items(BlobDatabaseID.Pin)) == set(items)
+
+    # Clearing the database means everything has to be sent again.
+    SyncWrapper(client.clear, BlobDatabaseID.Pin).wait(5)
+    assert client.known_items(BlobDatabaseID.Pin) == {}
+    assert len(SyncWrapper(client.sync, BlobDatabaseID.Pin, items).wait(5)) == len(items)
+
+
+def make_watch_info(serial='Q123456789AB', version_tag='v4.3', is_unfaithful=None):
+    running = WatchFirmwareVersion(timestamp=0, version_tag=version_tag, git_hash='abcdef0', is_recovery=False,
+                                   hardware_platform=0, metadata_version=0)
+    return WatchVersionResponse(running=running, recovery=running, bootloader_timestamp=0, board='', serial=serial,
+                                bt_address=b'\0' * 6, resource_crc=0, resource_timestamp=0, language='en_US',
+                                language_version=1, capabilities=0, is_unfaithful=is_unfaithful)
+
+
+def test_shadow_store(tmpdir):
+    store = BlobDBShadowStore(str(tmpdir), compact_threshold=5)
+    watch = FakeBlobDBWatch()
+    watch.watch_info = make_watch_info()
+    client = BlobDBClient(watch, shadow_store=store)
+    keys = [uuid.uuid4() for i in range(3)]
+    items = {key: key.bytes for key in keys}
+    SyncWrapper(client.sync, BlobDatabaseID.Pin, items).wait(5)
+    del items[keys[0]]
+    SyncWrapper(client.sync, BlobDatabaseID.Pin, items).wait(5)
+    SyncWrapper(client.sync, BlobDatabaseID.Notification, {keys[0]: b'notification'}).wait(5)
+    expected = client.known_items(BlobDatabaseID.Pin)
+    client.close()
+
+    # A new client for the same watch picks up where the last one left off.
+    watch = FakeBlobDBWatch()
+    watch.watch_info = make_watch_info()
+    client = BlobDBClient(watch, shadow_store=store)
+    assert client.known_items(BlobDatabaseID.Pin) == expected
+    assert SyncWrapper(client.sync, BlobDatabaseID.Pin, items).wait(5) == {}
+    assert watch.commands == []
+
+    # Lots of changes get compacted away.
+    for i in range(10):
+        SyncWrapper(client.sync, BlobDatabaseID.Pin, {keys[1]: str(i).encode('utf-8')}).wait(5)
+    client._shadow_log.flush()
+    with open(str(tmpdir.join('Q123456789AB.log'))) as f:
+        assert len(f.readlines()) < 8
+    SyncWrapper(client.clear, BlobDatabaseID.Notification).wait(5)
+    expected = {BlobDatabaseID.Pin: client.known_items(BlobDatabaseID.Pin), BlobDatabaseID.Notification: {}}
+    client.close()
+    assert load_shadow(store, make_watch_info()) == expected
+
+    # New firmware or a different phone means starting again.
+    assert load_shadow(store, make_watch_info(version_tag='v4.4')) == {}
+    assert load_shadow(store, make_watch_info(is_unfaithful=True)) == {}
+
+
+def load_shadow(store, watch_info):
+    log = store.open(watch_info)
+    try:
+        return log.load()
+    finally:
+        log.close()
+
+
+def test_shadow_store_close(tmpdir):
+    watch = FakeBlobDBWatch()
+    watch.watch_info = make_watch_info()
+    client = BlobDBClient(watch, shadow_store=BlobDBShadowStore(str(tmpdir)))
+    log = client._shadow_log
+    writer = log._writer
+    assert len(insert_many(client, 5)) == 5
+    client.close()
+    # Outstanding changes are written before the writer stops and the file is closed.
+    assert not writer.is_alive() and log._file is None
+    client._queued_data_thread.join(1)
+    assert not client._queued_data_thread.is_alive()
+    assert len(load_shadow(BlobDBShadowStore(str(tmpdir)), make_watch_info())[BlobDatabaseID.Notification]) == 5
+
+
+def test_shadow_store_compacts_on_writer(tmpdir):
+    store = BlobDBShadowStore(str(tmpdir))
+    log = store.open(make_watch_info())
+    log.load()
+    key = uuid.uuid4()
+    for i in range(10):
+        log.insert(BlobDatabaseID.Pin, key, str(i).encode('utf-8'))
+    # Compaction is queued behind the changes made before it, rather than racing the writer.
+    log.compact()
+    log.flush()
+    with open(log.path) as f:
+        assert len(f.readlines()) == 2
+    log.close()
+    assert load_shadow(store, make_watch_info()) == {BlobDatabaseID.Pin: {key: b'9'}}
+
+
+def test_chained_commands():
+    watch = FakeBlobDBWatch()
+    client = BlobDBClient(watch)
+    done = threading.Event()
+    results = []
+
+    def second(status):
+        results.append(status)
+        results.append(client.stats.in_flight)
+        done.set()
+
+    def first(status):
+        results.append(status)
+        client.insert(BlobDatabaseID.Pin, uuid.uuid4(), b'second', callback=second)
+
+    client.insert(BlobDatabaseID.Pin, uuid.uuid4(), b'first', callback=first)
+    assert done.wait(5)
+    assert results == [BlobStatus.Success, BlobStatus.Success, 0]
+
+
+def test_shadow_store_writes_in_background(tmpdir):
+    watch = FakeBlobDBWatch()
+    watch.watch_info = make_watch_info()
+    client = BlobDBClient(watch, shadow_store=BlobDBShadowStore(str(tmpdir)))
+    log = client._shadow_log
+    append = log._append
+    log._append = lambda fields: (time.sleep(0.2), append(fields))
+
+    # A slow disk doesn't hold up responses.
+    start = time.time()
+    assert len(insert_many(client, 5)) == 5
+    assert time.time() - start < 0.5
+    log.flush()
+    assert time.time() - start >= 1
+    assert len(client.known_items(BlobDatabaseID.Notification)) == 5
+    client.close()
+    assert len(load_shadow(BlobDBShadowStore(str(tmpdir)), make_watch_info())[BlobDatabaseID.Notification]) == 5
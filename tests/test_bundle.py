@@ -0,0 +1,191 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+
+import pytest
+
+from libpebble2.util import stm32_crc
+from libpebble2.util.bundle import PebbleBundle, BundleCache, scan_bundles, write_bundle_index
+from libpebble2.util.hardware import PebbleHardware
+
+from tests.bundles import APP_UUID, make_app_binary, make_pbw
+
+
+def test_app_metadata(tmpdir):
+    bundle = PebbleBundle(make_pbw(str(tmpdir.join('app.pbw'))), hardware=PebbleHardware.SNOWY_DVT)
+    assert bundle.is_app_bundle
+    assert bundle.has_resources and not bundle.has_worker
+    assert bundle.get_app_path() == 'basalt/pebble-app.bin'
+    metadata = bundle.get_app_metadata()
+    assert metadata['uuid'] == APP_UUID
+    assert metadata['app_name'] == 'Test App'
+    assert (metadata['sdk_version_major'], metadata['sdk_version_minor']) == (5, 0x48)
+    assert bundle.get_part('basalt/app_resources.pbpack') == (b'resources' * 1000,
+                                                              stm32_crc.crc32(b'resources' * 1000))
+
+
+def test_bundle_for_hardware(tmpdir):
+    bundle = PebbleBundle(make_pbw(str(tmpdir.join('app.pbw')), platforms=('',)), hardware=PebbleHardware.TINTIN_EV1)
+    assert bundle.should_permit_install()
+    basalt = bundle.for_hardware(PebbleHardware.SNOWY_DVT)
+    # Legacy SDK 2 apps can't be installed on basalt.
+    assert not basalt.should_permit_install()
+    assert basalt.zip is bundle.zip
+    # The original bundle is unaffected.
+    assert bundle.hardware == PebbleHardware.TINTIN_EV1
+    assert bundle.should_permit_install()
+    bundle.close()
+
+
+def test_bundle_cache(tmpdir):
+    pbw = make_pbw(str(tmpdir.join('app.pbw')))
+    cache = BundleCache(path=str(tmpdir.join('cache')))
+    bundle = PebbleBundle(pbw, hardware=PebbleHardware.SNOWY_DVT, cache=cache)
+    expected = (bundle.get_app_metadata(), bundle.get_part('basalt/pebble-app.bin'))
+
+    # A second bundle finds everything in memory, without looking at the zip.
+    bundle = PebbleBundle(pbw, hardware=PebbleHardware.SNOWY_DVT, cache=cache)
+    bundle.zip.close()
+    assert (bundle.get_app_metadata(), bundle.get_part('basalt/pebble-app.bin')) == expected
+
+    # ...and a new cache finds it all on disk.
+    bundle = PebbleBundle(pbw, hardware=PebbleHardware.SNOWY_DVT, cache=BundleCache(path=cache.path))
+    bundle.zip.close()
+    assert (bundle.get_app_metadata(), bundle.get_part('basalt/pebble-app.bin')) == expected
+
+    # Other platforms are cached separately.
+    assert BundleCache.key_for(pbw, PebbleHardware.SNOWY_DVT) != BundleCache.key_for(pbw, PebbleHardware.SPALDING)
+
+
+def test_bundle_cache_eviction():
+    cache = BundleCache(max_bytes=10)
+    cache.put('bundle', 'a', b'12345')
+    cache.put('bundle', 'b', b'12345')
+    assert cache.get('bundle', 'a') == b'12345'
+    cache.put('bundle', 'c', b'12345')
+    # 'b' was used least recently.
+    assert cache.get('bundle', 'b') is None
+    assert cache.get('bundle', 'a') == cache.get('bundle', 'c') == b'12345'
+    assert cache.size == 10
+    # Anything too big to fit isn't kept at all.
+    cache.put('bundle', 'd', b'x' * 11)
+    assert cache.get('bundle', 'd') is None
+    assert cache.size == 10
+
+
+def test_shared_bundle_reads_zip_one_thread_at_a_time(tmpdir):
+    class TrackingZip(object):
+        def __init__(self, zip):
+            self.zip = zip
+            self.reading = 0
+            self.max_reading = 0
+
+        def read(self, path):
+            self.reading += 1
+            self.max_reading = max(self.max_reading, self.reading)
+            time.sleep(0.01)
+            try:
+                return self.zip.read(path)
+            finally:
+                self.reading -= 1
+
+    # The cache is too small to keep anything, so every thread has to go back to the zip.
+    bundle = PebbleBundle(make_pbw(str(tmpdir.join('app.pbw'))), hardware=PebbleHardware.SNOWY_DVT,
+                          cache=BundleCache(max_bytes=10))
+    tracker = bundle.zip = TrackingZip(bundle.zip)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(bundle.get_part('basalt/app_resources.pbpack')))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    bundle.zip = tracker.zip
+    bundle.close()
+    assert results == [(b'resources' * 1000, stm32_crc.crc32(b'resources' * 1000))] * 4
+    assert tracker.max_reading == 1
+
+
+def test_scan_bundles_fallback_platforms(tmpdir, monkeypatch):
+    path = make_pbw(str(tmpdir.join('app.pbw')), platforms=('aplite', 'basalt'))
+    headers_read = []
+    get_app_metadata = PebbleBundle.get_app_metadata
+
+    def counting_get_app_metadata(self):
+        if self.header is None:
+            headers_read.append(self.get_real_path('pebble-app.bin'))
+        return get_app_metadata(self)
+
+    monkeypatch.setattr(PebbleBundle, 'get_app_metadata', counting_get_app_metadata)
+    records = list(scan_bundles([path], processes=1))
+    assert [(x.platform, x.prefix, x.permitted) for x in records] == [
+        ('aplite', 'aplite/', True),
+        ('basalt', 'basalt/', True),
+        ('chalk', None, False),
+        ('diorite', 'aplite/', True),
+        ('emery', 'basalt/', True),
+    ]
+    assert records[3].uuid == str(APP_UUID)
+    # Each build's header is only read once, however many platforms use it.
+    assert sorted(headers_read) == ['aplite/pebble-app.bin', 'basalt/pebble-app.bin']
+
+
+def test_app_metadata_reads_only_header(tmpdir):
+    path = str(tmpdir.join('app.pbw'))
+    binary = make_app_binary(size=60000)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr('manifest.json', json.dumps({'application': {'name': 'pebble-app.bin'}}))
+        z.writestr('pebble-app.bin', binary)
+    # Corrupt the end of the binary, which zipfile only notices once it reads that far.
+    with open(path, 'rb') as f:
+        contents = f.read()
+    end = contents.index(binary) + len(binary) - 1
+    with open(path, 'wb') as f:
+        f.write(contents[:end] + b'\xff' + contents[end + 1:])
+
+    bundle = PebbleBundle(path)
+    assert bundle.get_app_metadata()['uuid'] == APP_UUID
+    with pytest.raises(zipfile.BadZipfile):
+        bundle.get_part('pebble-app.bin')
+
+
+def test_scan_bundles(tmpdir):
+    make_pbw(str(tmpdir.join('modern.pbw')), platforms=('basalt', 'chalk'))
+    tmpdir.mkdir('legacy')
+    make_pbw(str(tmpdir.join('legacy', 'legacy.pbw')), platforms=('',))
+    tmpdir.join('broken.pbw').write('not a zip')
+
+    records = sorted(scan_bundles(str(tmpdir), processes=2), key=lambda x: (x.path, x.platform or ''))
+    assert [(os.path.basename(x.path), x.platform, x.prefix, x.permitted) for x in records] == [
+        ('broken.pbw', None, None, None),
+        # Legacy SDK 2 apps can only be installed on aplite, and there's nothing at all for chalk.
+        ('legacy.pbw', 'aplite', '', True),
+        ('legacy.pbw', 'basalt', '', False),
+        ('legacy.pbw', 'chalk', None, False),
+        ('legacy.pbw', 'diorite', '', False),
+        ('legacy.pbw', 'emery', '', False),
+        ('modern.pbw', 'aplite', None, False),
+        ('modern.pbw', 'basalt', 'basalt/', True),
+        ('modern.pbw', 'chalk', 'chalk/', True),
+        ('modern.pbw', 'diorite', None, False),
+        # Emery can run basalt apps.
+        ('modern.pbw', 'emery', 'basalt/', True),
+    ]
+    assert records[0].error is not None
+    modern = records[-3]
+    assert modern.uuid == str(APP_UUID)
+    assert (modern.sdk_version_major, modern.sdk_version_minor) == (5, 0x48)
+    assert modern.error is None
+    assert records[3].uuid is None
+
+    assert sorted(scan_bundles(str(tmpdir), processes=1)) == sorted(records)
+    out = io.StringIO()
+    assert write_bundle_index(records, out) == len(records)
+    columns = json.loads(out.getvalue())
+    assert columns['platform'] == [x.platform for x in records]
@@ -0,0 +1,119 @@
+# encoding: utf-8
+from __future__ import absolute_import, unicode_literals
+__author__ = 'katharine'
+
+import pytest
+
+from libpebble2.communication import PebbleConnection
+from libpebble2.communication.transports import BaseTransport, MessageTargetWatch
+from libpebble2.events.threaded import ThreadedEventHandler
+from libpebble2.exceptions import PacketDecodeError
+from libpebble2.protocol.system import PingPong, Ping
+from libpebble2.util.buffer import ReceiveBuffer
+
+
+class FakeTransport(BaseTransport):
+    must_initialise = False
+    connected = True
+
+    def __init__(self):
+        self.sent = []
+
+    def connect(self):
+        pass
+
+    def read_packet(self):
+        raise NotImplementedError
+
+    def send_packet(self, message, target=MessageTargetWatch()):
+        self.sent.append(message)
+
+
+def test_receive_buffer():
+    buffer = ReceiveBuffer(compact_threshold=2)
+    buffer.append(b'\x00\x03abc')
+    buffer.append(b'\x00\x01')
+    assert len(buffer) == 7
+    assert buffer.unpack_from('!H') == (3,)
+    assert buffer.read(5) == b'\x00\x03abc'
+    assert buffer.unpack_from('!H') == (1,)
+    assert buffer.peek() == b'\x00\x01'
+    buffer.append(b'd')
+    assert buffer.read(3) == b'\x00\x01d'
+    assert len(buffer) == 0
+    assert buffer.read(3) == b''
+
+
+def test_reassemble_split_messages():
+    pebble = PebbleConnection(FakeTransport())
+    received = []
+    pebble.register_endpoint(PingPong, received.append)
+    raw = []
+    pebble.register_raw_inbound_handler(raw.append)
+
+    messages = b''.join(PingPong(cookie=i, message=Ping(idle=False)).serialise_packet() for i in range(10))
+    for i in range(0, len(messages), 7):
+        pebble._handle_watch_message(messages[i:i+7])
+
+    assert [x.cookie for x in received] == list(range(10))
+    assert b''.join(raw) == messages
+    assert pebble.pending_bytes == b''
+
+
+def test_skip_undecodable_message():
+    pebble = PebbleConnection(FakeTransport())
+    received = []
+    pebble.register_endpoint(PingPong, received.append)
+
+    good = PingPong(cookie=1, message=Ping(idle=False)).serialise_packet()
+    bad = b'\x00\x02\x07\xd1\xff\xff'
+    with pytest.raises(PacketDecodeError):
+        pebble._handle_watch_message(bad + good)
+    pebble._handle_watch_message(b'')
+    assert [x.cookie for x in received] == [1]
+
+
+def test_event_dispatch_table():
+    events = ThreadedEventHandler()
+    calls = []
+    assert not events.has_handlers("event")
+
+    def unregister_self(*args):
+        calls.append(('first',) + args)
+        events.unregister_handler(first)
+
+    first = events.register_handler("event", unregister_self)
+    events.register_handler("event", lambda *args: calls.append(('second',) + args))
+    assert events.has_handlers("event")
+
+    # Changes made during a broadcast take effect from the next one.
+    events.broadcast_event("event", 1)
+    events.broadcast_event("event", 2)
+    assert calls == [('first', 1), ('second', 1), ('second', 2)]
+
+    events.unregister_handler(first + 1)
+    assert not events.has_handlers("event")
+    events.broadcast_event("event", 3)
+    assert len(calls) == 3
+
+
+def test_skip_unsubscribed_endpoints():
+    pebble = PebbleConnection(FakeTransport())
+    raw = []
+    pebble.register_raw_inbound_handler(raw.append)
+    message = PingPong(cookie=1, message=Ping(idle=False)).serialise_packet()
+    # Undecodable, but nobody would ever find out.
+    bad = b'\x00\x02\x07\xd1\xff\xff'
+
+    pebble._handle_watch_message(message + bad + message)
+    assert pebble.skipped_frames == {PingPong._Meta['endpoint']: 3}
+    assert raw == [message, bad, message]
+
+    received = []
+    handle = pebble.register_endpoint(PingPong, received.append)
+    pebble._handle_watch_message(message)
+    assert len(received) == 1
+    pebble.unregister_endpoint(handle)
+    pebble._handle_watch_message(message)
+    assert len(received) == 1
+    assert pebble.skipped_frames == {PingPong._Meta['endpoint']: 4}
@@ -0,0 +1,160 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import functools
+import io
+import threading
+import time
+import zipfile
+
+import pytest
+
+from libpebble2.events.mixin import EventSourceMixin
+from libpebble2.exceptions import AppInstallError
+from libpebble2.services import install
+from libpebble2.services.install import _PartPipeline
+from libpebble2.services.putbytes import PutBytesType
+from libpebble2.util import stm32_crc
+from libpebble2.util.bundle import PebbleBundle, BundleCache
+from libpebble2.util.hardware import PebbleHardware
+
+from tests.bundles import make_pbw
+
+
+class FakeBundle(object):
+    def __init__(self, files):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, data in files.items():
+                z.writestr(name, data)
+        self.zip = zipfile.ZipFile(buf)
+        self.fetched = []
+
+    def get_part(self, path):
+        self.fetched.append(path)
+        data = self.zip.read(path)
+        return data, stm32_crc.crc32(data)
+
+
+def test_part_pipeline():
+    files = {'pebble-app.bin': b'app' * 1000, 'app_resources.pbpack': b'resources' * 1000}
+    bundle = FakeBundle(files)
+    parts = _PartPipeline(bundle, [(PutBytesType.Binary, 'pebble-app.bin'),
+                                   (PutBytesType.Resources, 'app_resources.pbpack')])
+    assert list(parts) == [
+        (PutBytesType.Binary, files['pebble-app.bin'], 3000, stm32_crc.crc32(files['pebble-app.bin'])),
+        (PutBytesType.Resources, files['app_resources.pbpack'], 9000,
+         stm32_crc.crc32(files['app_resources.pbpack'])),
+    ]
+
+
+def test_part_pipeline_fetches_one_ahead():
+    files = {'a': b'a', 'b': b'b', 'c': b'c'}
+    bundle = FakeBundle(files)
+    parts = iter(_PartPipeline(bundle, [(PutBytesType.Binary, 'a'), (PutBytesType.Resources, 'b'),
+                                        (PutBytesType.Worker, 'c')]))
+    assert next(parts)[1] == b'a'
+    time.sleep(0.05)
+    # Only the part after the one being sent has been fetched.
+    assert bundle.fetched == ['a', 'b']
+    assert next(parts)[1] == b'b'
+    assert next(parts)[1] == b'c'
+
+
+def test_part_pipeline_error():
+    bundle = FakeBundle({'pebble-app.bin': b'app'})
+    parts = iter(_PartPipeline(bundle, [(PutBytesType.Binary, 'pebble-app.bin'), (PutBytesType.Worker, 'missing')]))
+    assert next(parts)[1] == b'app'
+    with pytest.raises(KeyError):
+        next(parts)
+
+
+class FakeWatch(object):
+    def __init__(self, name, hardware):
+        self.name = name
+        self.watch_info = type('WatchVersionResponse', (), {})()
+        self.watch_info.running = type('WatchFirmwareVersion', (), {'hardware_platform': hardware})()
+
+
+class InstallTracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.bundles = []
+
+
+class FakeAppInstaller(EventSourceMixin):
+    def __init__(self, tracker, pebble, bundle, blobdb_client=None, window_size=1):
+        EventSourceMixin.__init__(self)
+        self.tracker = tracker
+        self.pebble = pebble
+        tracker.bundles.append((pebble.name, bundle))
+        self.total_size = len(bundle.get_part(bundle.get_app_path())[0])
+
+    def install(self, force_install=False):
+        with self.tracker.lock:
+            self.tracker.running += 1
+            self.tracker.max_running = max(self.tracker.running, self.tracker.max_running)
+        time.sleep(0.05)
+        with self.tracker.lock:
+            self.tracker.running -= 1
+        if self.pebble.name == 'broken':
+            raise AppInstallError("Broken.")
+        self._broadcast_event('progress', self.total_size, self.total_size, self.total_size)
+
+
+@pytest.fixture
+def install_tracker(monkeypatch):
+    tracker = InstallTracker()
+    monkeypatch.setattr(install, 'AppInstaller', functools.partial(FakeAppInstaller, tracker))
+    return tracker
+
+
+def test_multi_app_installer(tmpdir, install_tracker):
+    pbw = make_pbw(str(tmpdir.join('app.pbw')), platforms=('basalt', 'chalk'))
+    watches = [FakeWatch(str(i), PebbleHardware.SNOWY_DVT) for i in range(5)]
+    watches += [FakeWatch('round', PebbleHardware.SPALDING), FakeWatch('broken', PebbleHardware.SNOWY_DVT)]
+
+    installer = install.MultiAppInstaller(watches, pbw, max_parallel=3)
+    progress = []
+    installer.register_handler('progress', lambda *args: progress.append(args))
+    results = installer.install()
+
+    assert set(results) == set(watches)
+    assert isinstance(results[watches[-1]], AppInstallError)
+    assert all(results[x] is None for x in watches[:-1])
+    assert 1 < install_tracker.max_running <= 3
+    # Each platform shares one bundle.
+    bundles = dict(install_tracker.bundles)
+    assert len(set(id(x) for x in bundles.values())) == 2
+    assert bundles['round'].get_app_path() == 'chalk/pebble-app.bin'
+    assert len(progress) == 6
+    assert installer.total_sent == sum(x[1] for x in progress) == installer.total_size * 6 // 7
+
+
+def test_parts_prepared_in_background_without_cache(tmpdir):
+    installer = install.AppInstaller.__new__(install.AppInstaller)
+    installer._bundle = PebbleBundle(make_pbw(str(tmpdir.join('app.pbw'))), hardware=PebbleHardware.SNOWY_DVT)
+    assert installer._bundle.cache is None
+    get_part = installer._bundle.get_part
+    fetched = []
+    installer._bundle.get_part = lambda path: (fetched.append(path), get_part(path))[1]
+
+    parts = installer._prepare_parts()
+    parts_iter = iter(parts)
+    object_type, data, size, crc = next(parts_iter)
+    assert object_type == PutBytesType.Binary
+    assert (len(data), crc) == (size, stm32_crc.crc32(data))
+    # While the first part is being sent, the next one is read and its CRC worked out.
+    time.sleep(0.05)
+    assert fetched == ['basalt/pebble-app.bin', 'basalt/app_resources.pbpack']
+    object_type, data, size, crc = next(parts_iter)
+    assert (object_type, crc) == (PutBytesType.Resources, stm32_crc.crc32(data))
+    parts.close()
+
+    installer._bundle = PebbleBundle(installer._bundle.path, hardware=PebbleHardware.SNOWY_DVT, cache=BundleCache())
+    parts = installer._prepare_parts()
+    object_type, data, size, crc = next(iter(parts))
+    assert (len(data), crc) == (size, stm32_crc.crc32(data))
+    parts.close()
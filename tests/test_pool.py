@@ -0,0 +1,157 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import socket
+
+import pytest
+import websocket
+
+from libpebble2.communication import PebbleConnection
+from libpebble2.communication.pool import ConnectionPool
+from libpebble2.communication.transports import MessageTargetWatch
+from libpebble2.communication.transports.qemu import QemuTransport
+from libpebble2.communication.transports.qemu.protocol import QemuPacket, QemuSPP
+from libpebble2.communication.transports.websocket import WebsocketTransport
+from libpebble2.exceptions import ConnectionError
+from libpebble2.protocol.system import PingPong, Ping, Pong
+
+
+def make_connection():
+    transport = QemuTransport()
+    transport.socket, emulator = socket.socketpair()
+    transport._connected = True
+    return PebbleConnection(transport), emulator
+
+
+def test_connection_pool():
+    pool = ConnectionPool()
+    connections = [make_connection() for i in range(3)]
+    received = []
+    for i, (pebble, emulator) in enumerate(connections):
+        pebble.register_endpoint(PingPong, lambda packet, i=i: received.append((i, packet.cookie)))
+        pool.add(pebble)
+    assert pool.stats.connections == 3
+
+    for i, (pebble, emulator) in enumerate(connections):
+        pebble.send_packet(PingPong(cookie=i, message=Ping(idle=False)))
+        pong = PingPong(cookie=i * 10, message=Pong()).serialise_packet()
+        frame = QemuPacket(data=QemuSPP(payload=pong)).serialise()
+        emulator.sendall(frame * 2)
+
+    handled = 0
+    while handled < 6:
+        handled += pool.poll(timeout=1)
+    assert sorted(received) == sorted([(0, 0), (1, 10), (2, 20)] * 2)
+
+    stats = pool.stats
+    assert stats.messages_received == 6
+    assert stats.bytes_received == 6 * len(pong)
+    assert stats.messages_sent == 3
+    assert stats.max_latency >= stats.mean_latency >= 0
+
+    pebble, emulator = connections[0]
+    emulator.close()
+    pool.poll(timeout=1)
+    assert pebble not in pool.connections
+    assert not pebble.connected
+    assert pool.stats.connections == 2
+
+
+def test_connection_pool_errors():
+    pool = ConnectionPool()
+    (bad_handler, bad_handler_emulator), (bad_transport, bad_transport_emulator), (good, good_emulator) = \
+        [make_connection() for i in range(3)]
+    received = []
+
+    def fail(packet):
+        raise ValueError("Handler failed.")
+
+    def fail_read():
+        raise RuntimeError("Transport failed.")
+
+    bad_handler.register_endpoint(PingPong, fail)
+    bad_transport.transport.read_ready = fail_read
+    good.register_endpoint(PingPong, lambda packet: received.append(packet.cookie))
+    for pebble in (bad_handler, bad_transport, good):
+        pool.add(pebble)
+
+    pong = QemuPacket(data=QemuSPP(payload=PingPong(cookie=1, message=Pong()).serialise_packet())).serialise()
+    for emulator in (bad_handler_emulator, bad_transport_emulator, good_emulator):
+        emulator.sendall(pong)
+    for i in range(3):
+        pool.poll(timeout=0.1)
+
+    # A failing handler doesn't affect anything else; a failing transport only loses its own connection.
+    assert received == [1]
+    assert set(pool.connections) == {bad_handler, good}
+    bad_handler_emulator.sendall(pong)
+    good_emulator.sendall(pong)
+    for i in range(3):
+        pool.poll(timeout=0.1)
+    assert received == [1, 1]
+
+
+class FakeSSLSocket(object):
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+    def pending(self):
+        # Pretend that everything after the next frame has already been decrypted.
+        return len(self.websocket.frames) - self.websocket.buffered_from
+
+
+class FakeWebSocket(object):
+    def __init__(self, frames, ssl=False):
+        self.frames = list(frames)
+        self.sock = FakeSSLSocket(self) if ssl else object()
+        self.buffered_from = 0
+        self.pongs = []
+        self.closed = False
+
+    def recv_frame(self):
+        opcode, data, fin = self.frames.pop(0)
+        return websocket.ABNF(opcode=opcode, data=data, fin=fin)
+
+    def pong(self, data):
+        self.pongs.append(data)
+
+    def send_close(self):
+        self.closed = True
+
+
+def test_websocket_read_ready():
+    pong = PingPong(cookie=1, message=Pong()).serialise_packet()
+    transport = WebsocketTransport('ws://localhost:9000/')
+    transport.ws = FakeWebSocket([(websocket.ABNF.OPCODE_PING, b'hi', 1),
+                                  (websocket.ABNF.OPCODE_BINARY, b'\x00' + pong, 1),
+                                  (websocket.ABNF.OPCODE_CLOSE, b'', 1)])
+    # Control frames don't block waiting for a message.
+    assert transport.read_ready() == []
+    assert transport.ws.pongs == [b'hi']
+    (target, message), = transport.read_ready()
+    assert isinstance(target, MessageTargetWatch)
+    assert message == pong
+    with pytest.raises(ConnectionError):
+        transport.read_ready()
+    assert transport.ws.closed
+
+
+def test_websocket_read_ready_fragmented():
+    pong = PingPong(cookie=1, message=Pong()).serialise_packet()
+    transport = WebsocketTransport('ws://localhost:9000/')
+    transport.ws = FakeWebSocket([(websocket.ABNF.OPCODE_BINARY, b'\x00' + pong[:3], 0),
+                                  (websocket.ABNF.OPCODE_PING, b'', 1),
+                                  (websocket.ABNF.OPCODE_CONT, pong[3:], 1)])
+    # Each fragment is read only once it is available, rather than waiting for the rest of the message.
+    assert transport.read_ready() == []
+    assert transport.read_ready() == []
+    (target, message), = transport.read_ready()
+    assert message == pong
+
+
+def test_websocket_read_ready_ssl_pending():
+    pong = PingPong(cookie=1, message=Pong()).serialise_packet()
+    transport = WebsocketTransport('wss://localhost:9000/')
+    transport.ws = FakeWebSocket([(websocket.ABNF.OPCODE_BINARY, b'\x00' + pong, 1)] * 3, ssl=True)
+    # Frames already decrypted by SSL won't wake the selector, so they're read straight away.
+    assert len(transport.read_ready()) == 3
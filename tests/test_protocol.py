@@ -8,7 +8,7 @@ import pytest
 from enum import IntEnum, Enum
 import uuid
 
-from libpebble2.exceptions import PacketDecodeError, PacketEncodeError
+from libpebble2.exceptions import PacketDecodeError, PacketEncodeError, IncompleteMessage
 from libpebble2.protocol.base import PebblePacket
 from libpebble2.protocol.base.types import *
 
@@ -757,3 +757,217 @@ def test_unbounded_length_array():
 
     result = Foo(array=b'hello world').serialise()
     assert result == b'hello world'
+
+
+def test_compiled_codec_merges_fixed_width_fields():
+    class Foo(PebblePacket):
+        a = Uint8()
+        b = Uint16()
+        c = Padding(2)
+        d = Uint32(endianness='<')
+        e = Uint16(endianness='<')
+        f = FixedString(2)
+
+    packet = Foo(a=1, b=0x0203, d=0x04050607, e=0x0809, f="hi")
+    serialised = packet.serialise()
+    assert serialised == b'\x01\x02\x03\x00\x00\x07\x06\x05\x04\x09\x08hi'
+    assert len(Foo._get_codec('!').steps) == 3
+    assert Foo.parse(serialised) == (packet, 13)
+
+
+def test_compiled_codec_enum_deserialise_error():
+    class TestEnum(IntEnum):
+        Foo = 0x01
+
+    class Foo(PebblePacket):
+        a = Uint8()
+        b = Uint8(enum=TestEnum)
+
+    assert Foo.parse(b'\x00\x01') == (Foo(a=0, b=TestEnum.Foo), 2)
+    with pytest.raises(PacketDecodeError):
+        Foo.parse(b'\x00\x02')
+    with pytest.raises(PacketDecodeError):
+        Foo.parse(b'\x00')
+
+
+def test_parse_memoryview():
+    class Foo(PebblePacket):
+        foo = Uint8()
+        bar = BinaryArray()
+
+    class Bar(PebblePacket):
+        length = Uint8()
+        foo = Embed(Foo, length=length)
+        uuid = UUID()
+        name = PascalString()
+
+    some_uuid = uuid.UUID("012345678-1234-1234-1234-123456789ab")
+    message = b'\x04\x01abc' + some_uuid.bytes + b'\x02hi'
+    for buffer in (message, bytearray(message), memoryview(message)):
+        result, length = Bar.parse(buffer)
+        assert result == Bar(length=4, foo=Foo(foo=1, bar=b'abc'), uuid=some_uuid, name="hi")
+        assert isinstance(result.foo.bar, bytes)
+        assert length == len(message)
+
+
+def test_binary_array_deserialise_memoryview(packet):
+    field = BinaryArray(length=3)
+
+    value, length = field.buffer_to_value(packet, memoryview(b'foobar'), 2)
+    assert value == b'oba'
+    assert isinstance(value, bytes)
+    assert length == 3
+
+
+def test_union_length_back_patched():
+    class Foo(PebblePacket):
+        foo = Uint16()
+
+    class Bar(PebblePacket):
+        bar = FixedString()
+
+    class Thing(PebblePacket):
+        class Meta:
+            endpoint = 0x1234
+
+        kind = Uint8()
+        length = Uint16()
+        flag = Uint8()
+        data = Union(kind, {1: Foo, 2: Bar}, length=length)
+
+    thing = Thing(flag=7, data=Bar(bar="hello"))
+    assert thing.serialise() == b'\x02\x00\x05\x07hello'
+    assert thing.length == 5
+    assert thing.serialise_packet() == b'\x00\x09\x12\x34\x02\x00\x05\x07hello'
+    assert Thing.parse(thing.serialise()) == (thing, 9)
+
+
+def test_serialise_into():
+    class Foo(PebblePacket):
+        foo = Uint16()
+
+    buffer = bytearray(b'xx')
+    Foo(foo=0x0102).serialise_into(buffer)
+    Foo(foo=0x0102).serialise_into(buffer, default_endianness='<')
+    assert buffer == bytearray(b'xx\x01\x02\x02\x01')
+
+
+def test_lazy_parse():
+    class Foo(PebblePacket):
+        foo = Uint8()
+
+    class Bar(PebblePacket):
+        command = Uint8()
+        session = Uint16()
+        data = Union(command, {1: Foo})
+        name = PascalString()
+
+    message = b'\x01\x00\x05\x07\x02hi'
+    result, length = Bar.parse(message, lazy=True)
+    assert length == len(message)
+    assert result.__dict__['command'] == 1
+    assert result.__dict__['session'] == 5
+    assert 'data' not in result.__dict__
+    assert result.data == Foo(foo=7)
+    assert 'name' not in result.__dict__
+    assert result == Bar.parse(message)[0]
+    assert '_pending_decode' not in result.__dict__
+
+
+def test_lazy_parse_assign_then_serialise():
+    class Bar(PebblePacket):
+        command = Uint8()
+        name = PascalString()
+        other = PascalString()
+
+    message = b'\x01\x03foo\x03bar'
+    result, length = Bar.parse(message, lazy=True)
+    result.name = 'baz'
+    # Decoding the rest of the packet mustn't overwrite the new value.
+    assert result.serialise() == b'\x01\x03baz\x03bar'
+
+
+def test_lazy_parse_assign_then_read_later_field():
+    class Bar(PebblePacket):
+        command = Uint8()
+        name = PascalString()
+        other = PascalString()
+
+    result, length = Bar.parse(b'\x01\x03foo\x03bar', lazy=True)
+    result.name = 'baz'
+    assert result.other == 'bar'
+    assert result.name == 'baz'
+
+
+def test_lazy_parse_error_on_access():
+    class Foo(PebblePacket):
+        foo = Uint8()
+
+    class Bar(PebblePacket):
+        command = Uint8()
+        data = Union(command, {1: Foo})
+
+    result, length = Bar.parse(b'\x02\x00', lazy=True)
+    assert result.command == 2
+    with pytest.raises(PacketDecodeError):
+        result.data
+
+
+class BatchPacket(PebblePacket):
+    class Meta:
+        endpoint = 0x4242
+        endianness = '<'
+        register = False
+
+    command = Uint8()
+    value = Uint16()
+    flag = Boolean()
+
+
+def batch_messages(count):
+    return b''.join(BatchPacket(command=i, value=i * 100, flag=bool(i % 2)).serialise_packet() for i in range(count))
+
+
+def test_parse_many_framed():
+    other = b'\x00\x01\x00\x10\xff'
+    result = BatchPacket.parse_many(batch_messages(3) + other + batch_messages(1))
+    assert result == [BatchPacket(command=0, value=0, flag=False), BatchPacket(command=1, value=100, flag=True),
+                      BatchPacket(command=2, value=200, flag=False), BatchPacket(command=0, value=0, flag=False)]
+
+    with pytest.raises(IncompleteMessage):
+        BatchPacket.parse_many(batch_messages(2)[:-1])
+
+
+def test_parse_many_unframed():
+    class Foo(PebblePacket):
+        length = Uint8()
+        data = BinaryArray(length=length)
+
+    assert Foo.parse_many(b'\x01a\x02bc\x00', framed=False) == [Foo(length=1, data=b'a'), Foo(length=2, data=b'bc'),
+                                                                Foo(length=0, data=b'')]
+
+
+def test_parse_stream():
+    messages = batch_messages(5)
+    chunks = [messages[i:i+3] for i in range(0, len(messages), 3)]
+    assert list(BatchPacket.parse_stream(chunks)) == BatchPacket.parse_many(messages)
+
+    with pytest.raises(IncompleteMessage):
+        list(BatchPacket.parse_stream([messages[:-1]]))
+
+
+def test_parse_columns():
+    columns = BatchPacket.parse_columns(batch_messages(4))
+    assert list(columns.keys()) == ['command', 'value', 'flag']
+    assert list(columns['command']) == [0, 1, 2, 3]
+    assert list(columns['value']) == [0, 100, 200, 300]
+    assert list(columns['flag']) == [0, 1, 0, 1]
+
+    columns = BatchPacket.parse_columns(b'\x01\x02\x00\x01\x03\x04\x00\x00', framed=False)
+    assert list(columns['value']) == [2, 4]
+
+    class Foo(PebblePacket):
+        data = BinaryArray()
+
+    with pytest.raises(TypeError):
+        Foo.parse_columns(b'')
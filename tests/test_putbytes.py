@@ -0,0 +1,306 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import io
+import mmap
+import threading
+import time
+
+from six.moves import queue
+
+import pytest
+
+from libpebble2.communication import PebbleConnection
+from libpebble2.communication.transports import BaseTransport, MessageTargetWatch
+from libpebble2.exceptions import PutBytesError, ConnectionError
+from libpebble2.protocol import transfers
+from libpebble2.services.putbytes import PutBytes, PutBytesType, _ChunkSizer
+from libpebble2.util import stm32_crc
+
+
+class FakePutBytesWatch(BaseTransport):
+    """
+    Pretends to be a watch receiving PutBytes transfers, answering each message after a short delay.
+    """
+    must_initialise = False
+    connected = True
+
+    def __init__(self, latency=0.005, nack_put=None, preferred_payload_size=None, sessions=None, first_cookie=1,
+                 disconnect_after_puts=None, stall_put=None, stall=0):
+        self.latency = latency
+        self.stall_put = stall_put
+        self.stall = stall
+        self.nack_put = nack_put
+        self.payload_size = preferred_payload_size
+        self.disconnect_after_puts = disconnect_after_puts
+        self.message_sizes = []
+        self.pebble = PebbleConnection(self)
+        self.sessions = sessions if sessions is not None else {}
+        self.next_cookie = first_cookie
+        self.committed = {}
+        self.puts = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.outbox = queue.Queue()
+        thread = threading.Thread(target=self._respond)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def preferred_payload_size(self):
+        return self.payload_size
+
+    def connect(self):
+        pass
+
+    def read_packet(self):
+        raise NotImplementedError
+
+    def send_packet(self, message, target=MessageTargetWatch()):
+        if self.disconnect_after_puts is not None and self.puts >= self.disconnect_after_puts:
+            raise ConnectionError("Disconnected.")
+        self.message_sizes.append(len(message))
+        packet = transfers.PutBytes.parse(message[4:])[0].data
+        result = transfers.PutBytesResponse.Result.ACK
+        cookie = getattr(packet, 'cookie', None)
+        if isinstance(packet, transfers.PutBytesInit):
+            cookie = self.next_cookie
+            self.next_cookie += 1
+            self.sessions[cookie] = b''
+        elif cookie not in self.sessions:
+            result = transfers.PutBytesResponse.Result.NACK
+        elif isinstance(packet, transfers.PutBytesAbort):
+            del self.sessions[cookie]
+        elif isinstance(packet, transfers.PutBytesPut):
+            self.puts += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if self.puts == self.nack_put:
+                result = transfers.PutBytesResponse.Result.NACK
+            else:
+                self.sessions[cookie] += packet.payload
+        elif isinstance(packet, transfers.PutBytesCommit):
+            if packet.object_crc == stm32_crc.crc32(self.sessions[cookie]):
+                self.committed[cookie] = packet.object_crc
+            else:
+                result = transfers.PutBytesResponse.Result.NACK
+        is_put = isinstance(packet, transfers.PutBytesPut)
+        delay = self.stall if is_put and self.puts == self.stall_put else 0
+        self.outbox.put((is_put, delay, transfers.PutBytesResponse(result=result, cookie=cookie)))
+
+    def _respond(self):
+        while True:
+            was_put, delay, response = self.outbox.get()
+            time.sleep(self.latency + delay)
+            if was_put:
+                self.in_flight -= 1
+            self.pebble._handle_watch_message(response.serialise_packet())
+
+
+def send(data, nack_put=None, preferred_payload_size=None, **kwargs):
+    watch = FakePutBytesWatch(nack_put=nack_put, preferred_payload_size=preferred_payload_size)
+    progress = []
+    putbytes = PutBytes(watch.pebble, PutBytesType.Resources, data, bank=0, **kwargs)
+    putbytes.register_handler("progress", lambda *args: progress.append(args))
+    putbytes.send()
+    return watch, progress
+
+
+def test_stop_and_wait():
+    data = bytes(bytearray(range(256))) * 20
+    watch, progress = send(data)
+    assert watch.sessions == {1: data}
+    assert watch.committed == {1: stm32_crc.crc32(data)}
+    assert watch.max_in_flight == 1
+    assert sum(x[0] for x in progress) == len(data)
+    assert progress[-1][1:] == (len(data), len(data))
+
+
+def test_windowed():
+    data = bytes(bytearray(range(256))) * 40
+    watch, progress = send(data, window_size=4)
+    assert watch.sessions == {1: data}
+    assert watch.committed == {1: stm32_crc.crc32(data)}
+    assert 1 < watch.max_in_flight <= 4
+    assert sum(x[0] for x in progress) == len(data)
+
+
+def test_windowed_falls_back_on_nack():
+    data = bytes(bytearray(range(256))) * 40
+    watch, progress = send(data, window_size=4, nack_put=3)
+    # The first session is abandoned, and the second sent one chunk at a time.
+    assert watch.sessions[2] == data
+    assert watch.committed == {2: stm32_crc.crc32(data)}
+    assert sum(x[0] for x in progress) == len(data)
+    assert [x[1] for x in progress] == sorted(set(x[1] for x in progress))
+
+
+def test_windowed_falls_back_on_timeout():
+    data = bytes(bytearray(range(256))) * 40
+    # The third chunk is acknowledged too late, so the acknowledgements for it and everything behind it arrive after
+    # the session has been abandoned.
+    watch = FakePutBytesWatch(stall_put=3, stall=0.15)
+    putbytes = PutBytes(watch.pebble, PutBytesType.Resources, data, bank=0, window_size=4)
+    putbytes.ACK_TIMEOUT = 0.1
+    putbytes.send()
+    assert watch.sessions == {2: data}
+    assert watch.committed == {2: stm32_crc.crc32(data)}
+
+
+def test_known_crc():
+    data = bytes(bytearray(range(256))) * 20
+    watch, progress = send(data, window_size=2, object_crc=stm32_crc.crc32(data))
+    assert watch.committed == {1: stm32_crc.crc32(data)}
+    # A wrong CRC is passed on to the watch, which rejects it.
+    with pytest.raises(PutBytesError):
+        send(data, object_crc=stm32_crc.crc32(data) ^ 1)
+
+
+def test_chunks_fit_transport():
+    data = bytes(bytearray(range(256))) * 20
+    watch, progress = send(data, preferred_payload_size=1013)
+    assert watch.sessions == {1: data}
+    assert max(watch.message_sizes) == 1013
+
+
+def test_chunk_sizer():
+    sizer = _ChunkSizer(2000, 256)
+    assert sizer.size == 2000
+    sizer.record(0.1)
+    # Much slower than usual
+    sizer.record(0.5)
+    assert sizer.size == 1000
+    sizer.record(0.5)
+    assert sizer.size == 500
+    # Keeping up
+    for i in range(8):
+        sizer.record(0.001)
+    assert sizer.size == 1000
+    for i in range(100):
+        sizer.record(0.001)
+    assert sizer.size == 2000
+
+
+def test_chunk_sizer_fixed_round_trip():
+    sizer = _ChunkSizer(2000, 256)
+    sizer.record(0.1)
+    sizer.record(0.5)
+    assert sizer.size == 1000
+    # Once the watch recovers, every chunk takes the same time regardless of its size, which is enough to grow back.
+    for i in range(100):
+        sizer.record(0.1)
+    assert sizer.size == 2000
+
+
+class TrickleStream(io.RawIOBase):
+    """
+    A non-seekable stream that never returns more than 100 bytes at once.
+    """
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.data.read(min(size, 100))
+
+
+def test_send_from_buffers():
+    data = bytes(bytearray(range(256))) * 20
+    for buffer in (bytearray(data), memoryview(data)):
+        watch, progress = send(buffer, window_size=2)
+        assert watch.sessions == {1: data}
+        assert watch.committed == {1: stm32_crc.crc32(data)}
+
+
+def test_send_from_streams(tmpdir):
+    data = bytes(bytearray(range(256))) * 20
+    path = tmpdir.join('object')
+    path.write_binary(b'header' + data)
+
+    with path.open('rb') as f:
+        f.seek(6)
+        watch, progress = send(f)
+    assert watch.sessions == {1: data}
+    assert watch.committed == {1: stm32_crc.crc32(data)}
+
+    path = tmpdir.join('mapped')
+    path.write_binary(data)
+    with path.open('rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        watch, progress = send(mapped)
+        mapped.close()
+    assert watch.sessions == {1: data}
+
+    watch, progress = send(TrickleStream(data), object_size=len(data))
+    assert watch.sessions == {1: data}
+    assert watch.committed == {1: stm32_crc.crc32(data)}
+
+    with pytest.raises(PutBytesError):
+        send(TrickleStream(data), object_size=len(data) + 1)
+
+
+def test_windowed_stream_falls_back_on_nack():
+    data = bytes(bytearray(range(256))) * 40
+    watch, progress = send(io.BytesIO(data), window_size=4, nack_put=3)
+    assert watch.sessions[2] == data
+    assert watch.committed == {2: stm32_crc.crc32(data)}
+
+
+def interrupted_transfer(data, sessions, window_size=1):
+    watch = FakePutBytesWatch(sessions=sessions, disconnect_after_puts=3)
+    putbytes = PutBytes(watch.pebble, PutBytesType.Resources, data, bank=0, window_size=window_size)
+    with pytest.raises(ConnectionError):
+        putbytes.send()
+    return putbytes.checkpoint
+
+
+def test_resume():
+    data = bytes(bytearray(range(256))) * 40
+    sessions = {}
+    checkpoint = interrupted_transfer(data, sessions)
+    assert checkpoint.cookie == 1
+    # Chunk sizes depend on timing, so we don't know exactly how far we got.
+    assert 0 < checkpoint.offset == len(sessions[1]) < len(data)
+
+    # The watch still knows about the session, so we carry on where we left off.
+    watch = FakePutBytesWatch(sessions=sessions, first_cookie=2)
+    progress = []
+    putbytes = PutBytes(watch.pebble, PutBytesType.Resources, io.BytesIO(data), bank=0, resume_from=checkpoint)
+    putbytes.register_handler("progress", lambda *args: progress.append(args))
+    putbytes.send()
+    # Exactly the rest of the data was sent.
+    assert sessions == {1: data}
+    assert watch.committed == {1: stm32_crc.crc32(data)}
+    assert sum(x[0] for x in progress) == len(data) - checkpoint.offset
+    assert putbytes.checkpoint.offset == len(data)
+
+
+def test_resume_forgotten_session():
+    data = bytes(bytearray(range(256))) * 40
+    checkpoint = interrupted_transfer(data, {})
+
+    # The watch has forgotten the session, so we have to start again.
+    watch = FakePutBytesWatch(first_cookie=2)
+    putbytes = PutBytes(watch.pebble, PutBytesType.Resources, data, bank=0, resume_from=checkpoint)
+    putbytes.send()
+    assert watch.sessions == {2: data}
+    assert watch.committed == {2: stm32_crc.crc32(data)}
+
+    with pytest.raises(PutBytesError):
+        PutBytes(watch.pebble, PutBytesType.Resources, data[1:], bank=0, resume_from=checkpoint).send()
+
+
+def test_resume_after_lost_acknowledgement():
+    data = bytes(bytearray(range(256))) * 40
+    sessions = {}
+    # The watch got a chunk that it never acknowledged, so the checkpoint is behind the watch.
+    checkpoint = interrupted_transfer(data, sessions, window_size=2)
+    assert checkpoint.offset < len(sessions[1])
+
+    # The CRC won't match, so we have to start again.
+    watch = FakePutBytesWatch(sessions=sessions, first_cookie=2)
+    PutBytes(watch.pebble, PutBytesType.Resources, data, bank=0, resume_from=checkpoint).send()
+    assert sessions == {2: data}
+    assert watch.committed == {2: stm32_crc.crc32(data)}
@@ -0,0 +1,42 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import threading
+import time
+
+from libpebble2.util.scheduler import Scheduler
+
+
+def test_scheduler_order():
+    scheduler = Scheduler()
+    calls = []
+    done = threading.Event()
+    scheduler.call_later(0.06, calls.append, 3)
+    scheduler.call_later(0.02, calls.append, 1)
+    cancelled = scheduler.call_later(0.03, calls.append, "cancelled")
+    scheduler.call_later(0.04, calls.append, 2)
+    scheduler.call_later(0.08, done.set)
+    cancelled.cancel()
+    assert done.wait(1)
+    assert calls == [1, 2, 3]
+    assert len(scheduler) == 0
+
+
+def test_scheduler_precision():
+    scheduler = Scheduler()
+    fired = []
+    done = threading.Event()
+    # An earlier call scheduled after a later one shouldn't have to wait for it.
+    scheduler.call_later(10, fired.append, "late")
+    start = time.time()
+    scheduler.call_later(0.05, lambda: (fired.append(time.time() - start), done.set()))
+    assert done.wait(1)
+    assert 0.05 <= fired[0] < 0.5
+
+
+def test_scheduler_survives_errors():
+    scheduler = Scheduler()
+    done = threading.Event()
+    scheduler.call_later(0, lambda: 1 / 0)
+    scheduler.call_later(0.01, done.set)
+    assert done.wait(1)
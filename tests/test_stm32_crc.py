@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import pytest
+
+from libpebble2.util import stm32_crc
+
+large = bytes(bytearray(range(256))) * 300
+
+
+@pytest.mark.parametrize('data,crc', [
+    (b'', 0xffffffff),
+    (b'1', 0x17f7ad5c),
+    (b'123', 0xa932511f),
+    (b'1234', 0xc2091428),
+    (b'123456789', 0xaff19057),
+    (large, 0x9c1c7e29),
+])
+def test_crc32(data, crc):
+    assert stm32_crc.crc32(data) == crc
+    assert stm32_crc.crc32(bytearray(data)) == crc
+
+
+def test_crc32_without_numpy(monkeypatch):
+    monkeypatch.setattr(stm32_crc, 'numpy', None)
+    assert stm32_crc.crc32(large) == 0x9c1c7e29
+
+
+def test_crc32_with_numpy(monkeypatch):
+    pytest.importorskip('numpy')
+    monkeypatch.setattr(stm32_crc, 'NUMPY_THRESHOLD', len(large))
+    expected = stm32_crc.crc32(large[:-3])
+    monkeypatch.setattr(stm32_crc, 'NUMPY_THRESHOLD', 0)
+    assert stm32_crc.crc32(large) == 0x9c1c7e29
+    assert stm32_crc.crc32(large[:-3]) == expected
+
+
+def test_incremental_crc32():
+    crc = stm32_crc.Crc32(b'1')
+    crc.update(b'23')
+    assert crc.value == 0xa932511f
+    crc.update(b'456789')
+    assert crc.value == 0xaff19057
+
+    crc = stm32_crc.Crc32()
+    for i in range(0, len(large), 1001):
+        crc.update(large[i:i+1001])
+    assert crc.value == 0x9c1c7e29
+
+
+def test_crc32_state():
+    crc = stm32_crc.Crc32(b'12345')
+    resumed = stm32_crc.Crc32.from_state(crc.state)
+    resumed.update(b'6789')
+    assert resumed.value == 0xaff19057
+    assert crc.value == stm32_crc.crc32(b'12345')